@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:         bench345
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:    Benchmark suite: header parsing, reading, writing, round trip
+                and pixels > 16 bits for synthetic images in all mar345 scan
+                sizes. The images are the same from run to run (fixed seeds),
+                so results of different versions can be compared:
+
+                python bench345.py -o new.json --compare old.json
+
+                Each size runs in a process of its own, so the peak RSS
+                (resident memory) is the one of that size.
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:         Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, json, platform, datetime, tempfile, subprocess, optparse
+import numpy as np
+path = os.path.dirname(__file__)
+sys.path.append(path)
+from mario import mar345
+from mario.version import __version__
+
+# Scan sizes of the mar345
+sizes = [ 1200, 1600, 1800, 2000, 2300, 2400, 3000, 3450 ]
+
+# Fraction of pixels > 16 bits: typical and worst case
+overflow = { 'typical' : 1e-4, 'heavy' : 1e-2 }
+
+###########################################################################
+## Function:    frame
+## Description: Synthetic image: circular detector, background falling off
+##              from the centre, Bragg spots and pixels > 16 bits
+###########################################################################
+def frame(size, high):
+    rng  = np.random.default_rng( size )
+    c    = ( size - 1 ) / 2.
+    y, x = np.ogrid[ :size, :size ]
+    r    = np.hypot( x - c, y - c ) / c
+    data = rng.poisson( 20. + 200. * np.exp( -2. * r ) ).astype(np.int32)
+
+    # Spots of 3x3 pixels with a long tail of intensities
+    n    = size * size // 2000
+    pos  = rng.integers( size + 1, size * ( size - 1 ) - 1, n )
+    val  = ( rng.pareto( 1.5, n ) * 300. ).astype(np.int64)
+    flat = data.reshape(-1)
+    for d, f in ( (0, 1.), (1, .5), (-1, .5), (size, .5), (-size, .5) ):
+        flat[pos + d] = np.minimum( flat[pos + d] + f * val, 65535 )
+
+    # The strongest spots go beyond 16 bits
+    nhigh = int( round( size * size * high ) )
+    top   = pos[ np.argsort( val )[::-1] ]
+    if nhigh > len(top): top = np.concatenate( ( top, rng.integers( 0, size*size, nhigh - len(top) ) ) )
+    flat[ top[:nhigh] ] = 65536 + ( rng.pareto( 1., nhigh ) * 20000. ).astype(np.int64).clip( 0, 1 << 30 )
+    data[ r > 1. ] = 0
+    return data.reshape(-1)
+
+###########################################################################
+## Function:    peakrss
+## Description: Peak resident memory of this process in kB (None on Windows)
+###########################################################################
+def peakrss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+###########################################################################
+## Function:    best
+## Description: Shortest of n runs of f, and the result of the last run
+###########################################################################
+def best(f, n):
+    t = None
+    for i in range( n ):
+        t0 = time.perf_counter()
+        r  = f()
+        t0 = time.perf_counter() - t0
+        t  = t0 if t == None else min( t, t0 )
+    return t, r
+
+###########################################################################
+## Function:    run
+## Description: Runs all cases for one size, returns list of results
+###########################################################################
+def run(size, n, nheader):
+    results = [ ]
+    pixels  = size * size
+    def result(case, t, nbytes=None, **kw):
+        r = { 'size' : size, 'case' : case, 'seconds' : t,
+              'pixels_per_s' : pixels / t if nbytes == None else None,
+              'mb_per_s' : ( 4 * pixels if nbytes == None else nbytes ) / t / 1e6 }
+        r.update( kw )
+        r['peak_rss_kb'] = peakrss()
+        results.append( r )
+
+    with tempfile.TemporaryDirectory() as d:
+        name = os.path.join( d, "bench.mar{}".format(size) )
+        for kind, high in overflow.items():
+            data = frame( size, high )
+            nhigh = int( np.count_nonzero( data > 65535 ) )
+            def write():
+                img = mar345.Mar345()
+                img.x, img.y, img.pixels = size, size, pixels
+                return img.write( name, data, img.header )
+            def read():
+                return mar345.Mar345().read( name )
+            if kind == 'typical':
+                # Write, then header and data of the written image
+                t, ok = best( write, n )
+                result( 'write', t, high=nhigh, file_bytes=os.path.getsize(name) )
+                t, img = best( lambda: [ mar345.Mar345().read( name, onlyheader=True ) for i in range(nheader) ], 1 )
+                result( 'header', t / nheader, nbytes=4096 )
+                t, img = best( read, n )
+                result( 'read', t, high=nhigh, exact=bool( img.success and np.array_equal( img.data.reshape(-1), data ) ) )
+                case = 'roundtrip'
+            else:
+                case = 'overflow'
+            # Write and read back, pixels must be the same
+            t, img = best( lambda: ( write(), read() )[1], n )
+            result( case, t, high=nhigh, file_bytes=os.path.getsize(name),
+                    exact=bool( img.success and np.array_equal( img.data.reshape(-1), data ) ) )
+    return results
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="%prog [options]")
+    p.add_option('-s', '--size',    default=[], type="int", action="append", help="Image size (default: all scan sizes)")
+    p.add_option('-n', '--nrun',    default=3, type="int",help="Number of runs per case (best is taken)")
+    p.add_option('--nheader',       default=200, type="int",help="Number of headers to parse")
+    p.add_option('-o', '--output',  default=None, help="Write results as JSON to this file ('-' for stdout)")
+    p.add_option('-c', '--compare', default=None, help="JSON file of an earlier run to compare with")
+    p.add_option('--child',         default=None, type="int", help=optparse.SUPPRESS_HELP)
+    p.add_option('--prg',default="bench345")
+    o,r  = p.parse_args()
+
+    # In a process of its own: one size, results as JSON to stdout
+    if o.child != None:
+        json.dump( run( o.child, o.nrun, o.nheader ), sys.stdout )
+        return
+
+    env = dict( os.environ, PYTHONPATH=os.pathsep.join( [ os.path.dirname(os.path.dirname(mar345.__file__)) ] + sys.path ) )
+    results = [ ]
+    for size in o.size or sizes:
+        out = subprocess.run( [ sys.executable, __file__, '--child', str(size), '-n', str(o.nrun), '--nheader', str(o.nheader) ],
+                              stdout=subprocess.PIPE, check=True, env=env ).stdout
+        results += json.loads( out )
+
+    report = { 'mario' : __version__, 'python' : platform.python_version(), 'numpy' : np.__version__,
+               'platform' : platform.platform(), 'machine' : platform.machine(), 'cpus' : os.cpu_count(),
+               'date' : datetime.datetime.now().isoformat( timespec='seconds' ), 'results' : results }
+    if o.output == '-':
+        json.dump( report, sys.stdout, indent=1 )
+        return
+    if o.output != None:
+        with open( o.output, 'w' ) as fp: json.dump( report, fp, indent=1 )
+
+    old = { }
+    if o.compare != None:
+        with open( o.compare ) as fp:
+            old = { ( r['size'], r['case'] ) : r['seconds'] for r in json.load( fp )['results'] }
+    print("{:>6s} {:10s} {:>10s} {:>12s} {:>9s} {:>7s} {:>10s} {:>6s}{}".format( "size", "case", "ms", "pixels/s", "MB/s", "high", "rss [MB]", "exact", "  vs. old" if old else "" ))
+    for r in results:
+        rss = "{:10.1f}".format( r['peak_rss_kb'] / 1024 ) if r['peak_rss_kb'] != None else "{:>10s}".format("-")
+        pps = "{:12.4g}".format( r['pixels_per_s'] ) if r['pixels_per_s'] != None else "{:>12s}".format("-")
+        cmp = ""
+        if ( r['size'], r['case'] ) in old:
+            cmp = "  {:7.2f}x".format( old[ (r['size'], r['case']) ] / r['seconds'] )
+        print("{:6d} {:10s} {:10.3f} {} {:9.1f} {:7s} {} {:>6s}{}".format( r['size'], r['case'], 1e3*r['seconds'], pps, r['mb_per_s'],
+              str( r.get('high', '') ), rss, { True : 'yes', False : 'NO', None : '' }[ r.get('exact') ], cmp ))
+    if any( r.get('exact') == False for r in results ):
+        print("ERROR ({}): images not read back exactly".format(o.prg))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:         dt345
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:    Benchmark and regression test of the pck decoder: decodes a
+                corpus of images in all mar345 scan sizes with one or more
+                builds of _libmar345, checks that every image is decoded
+                bit-exactly and prints the throughput.
+
+                The corpus is made on first use: images made from the
+                example image (diffraction-like), from noise (all chunk
+                sizes up to 32 bits) and from the 16-bit extremes 0, 32767,
+                32768 and 65535, with pixels > 16 bits. manifest.json holds
+                the md5 of the pixels of every image.
+
+                Compare with an older build of the library (before/after):
+
+                python dt345.py [-d corpus] [--lib old/_libmar345.so ...]
+
+                With --encode, the images are also written again (write,
+                write with 4 threads, write_rows) and must be byte-identical
+                to the images the other builds write with Putmar345Data16.
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:         Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, json, hashlib, optparse, tempfile, importlib.util
+import numpy as np
+import cffi
+path = os.path.dirname(__file__)
+sys.path.append(path)
+from mario import mar345
+
+# Scan sizes of the mar345
+sizes = [ 1200, 1600, 1800, 2000, 2300, 2400, 3000, 3450 ]
+
+###########################################################################
+## Function:    corpus
+## Description: Makes the images of the corpus in directory d
+###########################################################################
+def corpus(d):
+    os.makedirs( d, exist_ok=True )
+    src = mar345.Mar345().read( os.path.join( path, "a.mar1200" ) )
+    s   = src.data.reshape( src.y, src.x )
+    manifest = { }
+    for size in sizes:
+        rng = np.random.default_rng( size )
+        xtal  = np.tile( s, ( -(-size // src.y), -(-size // src.x) ) )[:size, :size].astype(np.int32)
+        noise = rng.gamma( 2., 400., (size, size) ).astype(np.int32)
+        noise[ rng.random( (size, size) ) < 1e-3 ] = 65535
+        edge  = rng.choice( np.array( [ 0, 32767, 32768, 65535 ], dtype=np.int32 ), (size, size) )
+        for kind, data in ( ('xtal', xtal), ('noise', noise), ('edge', edge) ):
+            hi = rng.integers( 0, size*size, 200 )
+            data.reshape(-1)[hi] = rng.integers( 65536, 1<<24, 200 )
+            name = "{}_{}.mar{}".format( kind, size, size )
+            img  = mar345.Mar345()
+            img.x, img.y = size, size
+            img.write( os.path.join( d, name ), data, dict( src.header, x=size, y=size, pixels=size*size ) )
+            manifest[name] = hashlib.md5( data.tobytes() ).hexdigest()
+    with open( os.path.join( d, "manifest.json" ), "w" ) as fp:
+        json.dump( manifest, fp, indent=1 )
+    return manifest
+
+###########################################################################
+## Function:    load
+## Description: Loads a build of _libmar345 from a file
+###########################################################################
+def load(name):
+    spec = importlib.util.spec_from_file_location( "_libmar345", name )
+    m    = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( m )
+    return m.lib, m.ffi
+
+###########################################################################
+## Function:    encode16
+## Description: Writes data as the original Mar345.write did: header and
+##              pixels > 16 bits (head) in Python, then the pck stream of
+##              the 16-bit pixels with Putmar345Data16 of a build of
+##              _libmar345. Returns the image
+###########################################################################
+libc = cffi.FFI()
+libc.cdef( "int fflush(void *fp);" )
+
+def encode16(lib, ffi, head, x, y, data, tmp):
+    with open( tmp, 'wb' ) as fp: fp.write( head )
+    d = np.clip( data, 0, 65535 ).astype(np.uint16).view(np.int16)
+    lib.Putmar345Data16( tmp.encode(), x, y, ffi.cast("short *", ffi.from_buffer(d) ) )
+    # The original library does not close the file: flush all open files
+    libc.dlopen( None ).fflush( libc.NULL )
+    with open( tmp, 'rb' ) as fp: return fp.read()
+
+###########################################################################
+## Function:    same
+## Description: True if buf is the image ref written by another build.
+##              The original library leaves what was in its buffer in the
+##              bits after the end of the stream in the last byte, so that
+##              byte only has to give the same pixels
+###########################################################################
+def same(buf, ref, data):
+    if buf == ref: return True
+    if len(buf) != len(ref) or buf[:-1] != ref[:-1]: return False
+    img = mar345.Mar345().decode( ref )
+    return img.success and np.array_equal( img.data.reshape( data.shape ), data )
+
+###########################################################################
+## Function:    encode
+## Description: Writes the image of h with data with all encoders of
+##              mario and returns dict of method: image
+###########################################################################
+def encode(h, data, tmp):
+    out = mar345.Mar345()
+    out.x, out.y = h.x, h.y
+    out.write_rows( tmp, ( data[row : row + 256] for row in range( 0, h.y, 256 ) ), header=h.raw_header )
+    with open( tmp, 'rb' ) as fp:
+        imgs = { 'write_rows' : fp.read() }
+    imgs['write']   = mar345.Mar345().encode( data, h.raw_header )
+    imgs['write/4'] = mar345.Mar345().encode( data, h.raw_header, workers=4 )
+    return imgs
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="%prog [options]")
+    p.add_option('-d', '--corpus',  default=os.path.join( tempfile.gettempdir(), "mar345corpus" ), help="Directory of the corpus (made if not there)")
+    p.add_option('-n', '--nread',   default=5, type="int",help="Number of times each image is decoded")
+    p.add_option('-l', '--lib',     default=[], action="append", help="Other build of _libmar345 to compare with")
+    p.add_option('-e', '--encode',  default=False, action="store_true", help="Check that images are written as with the other builds")
+    p.add_option('--prg',default="dt345")
+    o,r  = p.parse_args()
+
+    mf = os.path.join( o.corpus, "manifest.json" )
+    if os.path.exists( mf ):
+        with open( mf ) as fp: manifest = json.load( fp )
+    else:
+        print("{}: making corpus in {}".format( o.prg, o.corpus ))
+        manifest = corpus( o.corpus )
+
+    libs = [ ( "mario", ( mar345.lib, mar345.ffi ) ) ] + [ ( l, load(l) ) for l in o.lib ]
+    print("{:20s} {:>30s} {:>8s} {:>8s} {:>10s} {:>6s}".format("image", "library", "ms", "MB/s", "vs. mario", "exact"))
+    failed = 0
+    for name, md5 in manifest.items():
+        with open( os.path.join( o.corpus, name ), 'rb' ) as fp: buf = fp.read()
+        h = mar345.Mar345().decode( buf, onlyheader=True )
+        t0 = None
+        pixels = None
+        for lname, (lib, ffi) in libs:
+            if not hasattr( lib, 'Getmar345DataFromBuffer' ):   # Original library: no decoding from memory
+                print("{:20s} {:>30s} {:>8s} {:>8s} {:>10s} {:>6s}".format( name, lname[-30:], "-", "-", "-", "-" ))
+                continue
+            data = np.empty( h.x * h.y, dtype=np.int32 )
+            ptr  = ffi.cast( "int *", ffi.from_buffer(data) )
+            best = None
+            for i in range( o.nread ):
+                data[:] = -1
+                t = time.perf_counter()
+                n = lib.Getmar345DataFromBuffer( buf, len(buf), data.size, ptr )
+                t = time.perf_counter() - t
+                best = t if best == None else min( best, t )
+            exact = n == data.size and hashlib.md5( data.tobytes() ).hexdigest() == md5
+            failed += not exact
+            if t0 == None: t0 = best
+            print("{:20s} {:>30s} {:8.2f} {:8.1f} {:9.2f}x {:>6s}".format( name, lname[-30:], 1e3*best, data.nbytes/best/1e6, best/t0, "yes" if exact else "NO" ))
+            if lname == "mario" and exact: pixels = data.reshape( h.y, h.x )
+
+        # The same pck stream and pixels > 16 bits as the other builds. The
+        # header is the one of the corpus image for all
+        if o.encode and pixels is not None:
+            tmp  = os.path.join( o.corpus, ".dt345.tmp" )
+            imgs = encode( h, pixels, tmp )
+            img  = imgs['write_rows']
+            b    = 'little' if int.from_bytes( img[0:4], 'little' ) == 1234 else 'big'
+            head = img[:4096 + 8 * int.from_bytes( img[8:12], b )]
+            for lname, (lib, ffi) in libs[1:]:
+                ref = encode16( lib, ffi, head, h.x, h.y, pixels, tmp )
+                for method, buf in imgs.items():
+                    exact = same( buf, ref, pixels )
+                    failed += not exact
+                    print("{:20s} {:>30s} {:>8s} {:>8s} {:>10s} {:>6s}".format( name, "=" + lname[-29:], method, "", "", "yes" if exact else "NO" ))
+            os.remove( tmp )
+    if failed:
+        print("ERROR ({}): {} images not decoded or written exactly".format( o.prg, failed ))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    start()
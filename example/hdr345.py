@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:         hdr345
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:    Benchmark: parse mar345 image headers
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:         Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, optparse
+path = os.path.dirname(__file__)
+sys.path.append(path)
+from mario import mar345
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="%prog [options] [file ...]")
+    p.add_option('-n', '--nread',   default=5000, type="int",help="Number of headers to parse")
+    p.add_option('--prg',default="hdr345")
+    o,r  = p.parse_args()
+
+    if len(r) == 0: r = [ os.path.join( path, "a.mar1200" ) ]
+    bufs = [ ]
+    for name in r:
+        with open(name, 'rb') as fp: bufs.append( fp.read(4096) )
+    names = [ r[i % len(r)] for i in range( o.nread ) ]
+
+    # Parse headers already in memory
+    img = mar345.Mar345()
+    t = time.perf_counter()
+    for i in range( o.nread ):
+        img.readheader( buf=bufs[ i % len(bufs) ] )
+    t = time.perf_counter() - t
+    print("{}: parse       {:8d} headers in {:7.3f} s || {:8.0f} headers/s".format(o.prg, o.nread, t, o.nread/t))
+
+    # Open file, read and parse header
+    t = time.perf_counter()
+    for name in names:
+        img.read( name, onlyheader=True )
+    t = time.perf_counter() - t
+    print("{}: read+parse  {:8d} headers in {:7.3f} s || {:8.0f} headers/s".format(o.prg, o.nread, t, o.nread/t))
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:         mt345
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:    Benchmark: read mar345 images with 1...N threads
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:         Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, optparse
+path = os.path.dirname(__file__)
+sys.path.append(path)
+from mario import mar345
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="%prog [options] [file ...]")
+    p.add_option('-n', '--nread',   default=64, type="int",help="Number of images to read per run")
+    p.add_option('-w', '--workers', default=os.cpu_count() or 1, type="int",help="Maximum number of threads")
+    p.add_option('--prg',default="mt345")
+    o,r  = p.parse_args()
+
+    # Without file names, read the example image over and over again
+    if len(r) == 0: r = [ os.path.join( path, "a.mar1200" ) ]
+    names = [ r[i % len(r)] for i in range( o.nread ) ]
+
+    # Warm up the page cache
+    mar345.read_many( r, workers=1 )
+
+    print("{}: {} images, {} cpus".format( o.prg, len(names), os.cpu_count() ))
+    print("{:>8s} {:>10s} {:>10s} {:>8s} {:>10s}".format("threads", "seconds", "images/s", "speedup", "efficiency"))
+    t1 = None
+    for workers in range( 1, o.workers+1 ):
+        t = time.perf_counter()
+        img = mar345.read_many( names, workers=workers )
+        t = time.perf_counter() - t
+        if not all( i.success for i in img ):
+            print("ERROR ({}): not all images could be read".format(o.prg))
+            sys.exit(1)
+        if t1 == None: t1 = t
+        print("{:8d} {:10.3f} {:10.1f} {:8.2f} {:9.0f}%".format( workers, t, len(names)/t, t1/t, 100.*t1/t/workers ))
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:         pt345
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:    Benchmark: compress mar345 images with 1...N threads
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:         Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, optparse
+import numpy as np
+path = os.path.dirname(__file__)
+sys.path.append(path)
+from mario import mar345
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="%prog [options] [file]")
+    p.add_option('-n', '--nwrite',  default=5, type="int",help="Number of images to compress per run")
+    p.add_option('-s', '--size',    default=[], type="int", action="append", help="Image size (default: 2300 and 3450)")
+    p.add_option('-w', '--workers', default=os.cpu_count() or 1, type="int",help="Maximum number of threads")
+    p.add_option('--prg',default="pt345")
+    o,r  = p.parse_args()
+
+    # Large images are made by tiling the example image
+    img = mar345.Mar345().read( r[0] if r else os.path.join( path, "a.mar1200" ) )
+    if not img.success:
+        print("ERROR ({}): cannot read image".format(o.prg))
+        sys.exit(1)
+    src = img.data.reshape( img.y, img.x )
+
+    print("{}: {} images per run, {} cpus".format( o.prg, o.nwrite, os.cpu_count() ))
+    print("{:>6s} {:>8s} {:>10s} {:>10s} {:>8s} {:>10s}".format("size", "threads", "seconds", "MB/s", "speedup", "efficiency"))
+    for size in o.size or [ 2300, 3450 ]:
+        data = np.tile( src, ( -(-size // img.y), -(-size // img.x) ) )[:size, :size].copy()
+        out  = mar345.Mar345()
+        out.x, out.y = size, size
+        hdr  = out._header4k( dict( img.header, x=size, y=size, pixels=size*size ) )
+        ref  = None
+        t1   = None
+        for workers in range( 1, o.workers+1 ):
+            t = time.perf_counter()
+            for i in range( o.nwrite ):
+                buf = out.encode( data, hdr, workers=workers )
+            t = time.perf_counter() - t
+            # The stream must not depend on the number of threads
+            if ref == None: ref = buf
+            if buf != ref:
+                print("ERROR ({}): {} threads give a different image".format(o.prg, workers))
+                sys.exit(1)
+            if t1 == None: t1 = t
+            print("{:6d} {:8d} {:10.3f} {:10.1f} {:8.2f} {:9.0f}%".format( size, workers, t, o.nwrite*data.nbytes/t/1e6, t1/t, 100.*t1/t/workers ))
+
+if __name__ == "__main__":
+    start()
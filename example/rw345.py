@@ -66,28 +66,21 @@ def start():
                 sys.exit(0)
 
 
-    # Read 1st image: give filename
-    img1 = mar345.Mar345(name=o.file1, verbose=o.verbose)
-    print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.file1, img1.x, img1.y, img1.data.mean(),img1.data.max()))
-    if norm[0] != 1.0:
-        print("Scale factor for img1: {:.3f}".format(norm[0]))
-        img1.data = img1.data*norm[0]
-
-    if o.file2 != None:
-        # Read 2nd image: give filename
-        img2 = mar345.Mar345(name=o.file2, verbose=o.verbose)
-        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.file2, img2.x, img2.y, img2.data.mean(),img2.data.max()))
-        if len(norm) > 1:
-            print("Scale factor for img2: {:.3f}".format(norm[1]))
-            if norm[1] != 1.0:  img2.data = img2.data*norm[1]
-        # Combine data from images 1 and 2
-        img1.data = img1.data+img2.data
+    # Images are added in place into an int64 sum with their scale factors,
+    # no float copies of the images are made
+    acc  = mar345.Mar345Accumulator(verbose=o.verbose)
+    for name, scale in zip( ( o.file1, o.file2 ), norm ):
+        if name == None: continue
+        img = mar345.Mar345(name=name, verbose=o.verbose)
+        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, name, img.x, img.y, img.data.mean(),img.data.max()))
+        if scale != 1.0: print("Scale factor for {}: {:.3f}".format(name, scale))
+        acc.add( img, scale )
 
     if o.outfile != None:
-        # For image output, also give data array and 4k image header from file1
+        # The image is written with the 4k image header from file1
         # The no. of pixels > 16bit will be updated automatically
-        s = mar345.Mar345(name=o.outfile,data=img1.data,header=img1.raw_header)
-        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.outfile, img1.x, img1.y, img1.data.mean(),img1.data.max()))
+        s = acc.write( o.outfile )
+        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.outfile, s.x, s.y, s.imagestats.mean, s.imagestats.max))
 
 if __name__ == "__main__":
     start()
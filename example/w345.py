@@ -60,10 +60,8 @@ def start():
     # Update some important image header information
     img.header['x']         = img.x
     img.header['pixels']    = img.pixels
-    # Update some optional image header information
-    img.header['x']         = img.x
-    img.header['valmax']    = int(img.data.max())
-    img.header['valavg']    = img.data.mean()
+    # Intensity statistics (min, max, average, sigma, histogram) are filled
+    # in by write (imagestats=True) while the image is compressed
     # Now, make the header and give it back to me as 4k byte string
     img.raw_header          = img.makeheader()
 
@@ -73,8 +71,9 @@ def start():
 
     # Write out mar345 image
     if o.outfile != None:
-        img.write (o.outfile, img.data, img.raw_header)
-        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.outfile, img.x, img.y, img.data.mean(),img.data.max()))
+        img.write (o.outfile, img.data, img.raw_header, imagestats=True)
+        s = img.imagestats
+        print ("{}: {} || {}x{} pixels || mean: {:6.1f} || max: {:6.0f}".format(o.prg, o.outfile, img.x, img.y, s.mean, s.max))
 
 if __name__ == "__main__":
     start()
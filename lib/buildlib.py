@@ -21,12 +21,20 @@ else:
 with open(pre+"marpck.h") as f:
     ffibuilder.cdef(f.read())
 
+# The pck kernels are the hot path of reading and writing images: always
+# optimize, whatever the flags python has been built with
+if platform.system() == "Windows":
+    cflags = ['/O2']
+else:
+    cflags = ['-g', '-fPIC', '-O3']
+
 ffibuilder.set_source(
     "_libmar345", """
+    #include <stdio.h>
     #include "marpck.h"
     """,
 	sources=[pre+'marpck.c'],
-    extra_compile_args=['-g', '-fPIC']
+    extra_compile_args=cflags
 )
 ffibuilder.compile(verbose=True, target=sotarget)
 
@@ -0,0 +1,1251 @@
+/*
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Module:          marpck.c
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Description:     pck (de)compression of mar345 images. The pck format
+ *                  is the CCP4 packed image format (V1) by J.P. Abrahams:
+ *                  every pixel is predicted from its neighbours and the
+ *                  differences are stored in chunks of 1..128 values with
+ *                  0..32 bits each. Bits are packed LSB first.
+ *
+ *                  Layout of a mar345 image:
+ *                  bytes    0-4095:     header (first int is 1234)
+ *                  bytes 4096-...:      nhigh (address,value) int pairs
+ *                                       for pixels > 16 bits
+ *                  then:                "\nCCP4 packed image, X: ..., Y: ...\n"
+ *                                       followed by the pck stream
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Author:          Claudio Klein
+ *                  marXperts GmbH
+ *                  Werkstr.3
+ *                  22844 Norderstedt / Germany
+ *                  Claudio.Klein@marxperts.com
+ *                  www.marxperts.com
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include "marpck.h"
+
+#define HEADER_BYTES            4096
+#define DIFFBUFSIZ              PCKBLOCK
+#define PACKIDENTIFIER          "\nCCP4 packed image, X: %04d, Y: %04d\n"
+#define PCKMARK                 "CCP4 packed image"
+#define ROWBLOCK                64      /* Rows decoded at a time by unpack_rows */
+#define CLIP16(v)               ( (v) < 0 ? 0 : (v) > 65535 ? 65535 : (v) )
+
+/* Pixels are signed 16-bit: predictions and differences wrap around in
+ * signed 16-bit arithmetic. Files written by mar345 depend on this */
+typedef short                   WORD;
+
+typedef struct {
+    unsigned char  *buf;
+    size_t          size;       /* Allocated bytes */
+    size_t          used;       /* Completed bytes */
+    int             bitmark;    /* Bits in use in buf[used] */
+} PCKBUF;
+
+/* State of the decoder between calls of unpack_word */
+typedef struct {
+    const unsigned char *pck;
+    size_t      len;
+    size_t      pos;        /* Next byte to load */
+    uint64_t    window;     /* Loaded, unused bits */
+    int         valids;     /* Number of bits in window */
+    int         pixnum;     /* Values left in the current chunk ... */
+    int         bitnum;     /* ... and their size in bits */
+    int         x;
+    long        pixel;      /* Pixels decoded so far */
+    WORD       *hist;       /* x+1 last pixels (unpack_rows only) */
+} UNPACK;
+
+/* Row by row decoder */
+struct pckrows {
+    UNPACK      u;
+    const unsigned char *buf;   /* Complete image for the high intensity pixels */
+    int         y;
+    int         nhigh;
+    int         swap;
+};
+
+/* Row by row encoder */
+struct pckpack {
+    int         x;
+    int         y;
+    long        first;      /* First pixel (parts of an image only) */
+    long        done;       /* Pixels added so far */
+    WORD       *hist;       /* x+1 last pixels added */
+    int        *diffs;      /* Differences not compressed yet */
+    int         ndiffs;
+    int32_t    *high;       /* (address, value) of pixels > 16 bits */
+    long        nhigh;
+    long        maxhigh;
+    unsigned int *counts;   /* Histogram of the pixels added or NULL */
+    PCKBUF      p;
+};
+
+/* Number of bits per value for the 3-bit code in a chunk descriptor */
+static const int bitdecode[8] = { 0, 4, 5, 6, 7, 8, 16, 32 };
+
+/* ... and the other way round */
+static const int bitencode[33] = { 0, 0, 0, 0, 1, 2, 3, 4, 5, 0, 0, 0, 0, 0, 0,
+                                   0, 6, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                                   0, 0, 7 };
+
+/* Sign bit of a value with n bits, for sign extension by (v ^ s) - s */
+static const uint32_t signbits[33] = {
+    0x00000000, 0x00000001, 0x00000002, 0x00000004,
+    0x00000008, 0x00000010, 0x00000020, 0x00000040,
+    0x00000080, 0x00000100, 0x00000200, 0x00000400,
+    0x00000800, 0x00001000, 0x00002000, 0x00004000,
+    0x00008000, 0x00010000, 0x00020000, 0x00040000,
+    0x00080000, 0x00100000, 0x00200000, 0x00400000,
+    0x00800000, 0x01000000, 0x02000000, 0x04000000,
+    0x08000000, 0x10000000, 0x20000000, 0x40000000,
+    0x80000000 };
+
+static const uint32_t setbits[33] = {
+    0x00000000, 0x00000001, 0x00000003, 0x00000007,
+    0x0000000F, 0x0000001F, 0x0000003F, 0x0000007F,
+    0x000000FF, 0x000001FF, 0x000003FF, 0x000007FF,
+    0x00000FFF, 0x00001FFF, 0x00003FFF, 0x00007FFF,
+    0x0000FFFF, 0x0001FFFF, 0x0003FFFF, 0x0007FFFF,
+    0x000FFFFF, 0x001FFFFF, 0x003FFFFF, 0x007FFFFF,
+    0x00FFFFFF, 0x01FFFFFF, 0x03FFFFFF, 0x07FFFFFF,
+    0x0FFFFFFF, 0x1FFFFFFF, 0x3FFFFFFF, 0x7FFFFFFF,
+    0xFFFFFFFF };
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    swap4
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int32_t swap4( int32_t i )
+{
+    uint32_t u = (uint32_t)i;
+    return (int32_t)( (u >> 24) | ((u >> 8) & 0xFF00) | ((u << 8) & 0xFF0000) | (u << 24) );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    find_pck
+ * Description: Looks for the pck identifier in buf starting at pos.
+ *              Returns the offset of the first byte of the pck stream
+ *              or 0 if there is none.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static size_t find_pck( const unsigned char *buf, size_t len, size_t pos, int *x, int *y )
+{
+    size_t  n = strlen( PCKMARK );
+    size_t  i;
+    char    line[64];
+
+    for ( ; pos + n <= len; pos++ ) {
+        if ( buf[pos] != 'C' || memcmp( buf + pos, PCKMARK, n ) ) continue;
+
+        /* Found: "CCP4 packed image, X: 1200, Y: 1200\n" */
+        for ( i = 0; i < sizeof(line) - 1 && pos + i < len && buf[pos+i] != '\n'; i++ )
+            line[i] = (char)buf[pos+i];
+        line[i] = '\0';
+        if ( pos + i >= len || buf[pos+i] != '\n' ) return 0;
+        if ( sscanf( line + n, ", X: %d, Y: %d", x, y ) != 2 ) return 0;
+        if ( *x <= 0 || *y <= 0 ) return 0;
+        return pos + i + 1;
+    }
+    return 0;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    unpack_init
+ * Description: Prepares decoding of a pck stream with x pixels per row
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static void unpack_init( UNPACK *u, const unsigned char *pck, size_t len, int x )
+{
+    memset( u, 0, sizeof(UNPACK) );
+    u->pck  = pck;
+    u->len  = len;
+    u->x    = x;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    load64
+ * Description: 8 bytes of the stream as little endian integer
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static uint64_t load64( const unsigned char *p )
+{
+    uint64_t    v;
+
+    memcpy( &v, p, 8 );
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+    v = __builtin_bswap64( v );
+#endif
+    return v;
+}
+
+/* Loads the bit window up to at least 57 bits, or up to the end of the
+ * stream. Away from the end, 8 bytes are read at once: the bits above the
+ * window that are read again later are the same, so OR-ing them is fine */
+#define REFILL()                                                        \
+    if ( pos + 8 <= len ) {                                             \
+        window |= load64( pck + pos ) << valids;                        \
+        pos    += ( 63 - valids ) >> 3;                                 \
+        valids |= 56;                                                   \
+    }                                                                   \
+    else {                                                              \
+        while ( valids <= 56 && pos < len ) {                           \
+            window |= (uint64_t)pck[pos++] << valids;                   \
+            valids += 8;                                                \
+        }                                                               \
+    }
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    unpack_word
+ * Description: Decodes the next n pixels of the pck stream into img.
+ *              The predictor reads the x+1 pixels before img[0], so they
+ *              must hold the previous pixels unless decoding starts at
+ *              pixel 0. Returns the number of pixels decoded, which is
+ *              less than n if the stream is truncated.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static long unpack_word( UNPACK *u, long n, WORD *img )
+{
+    const unsigned char *pck = u->pck;
+    size_t      len     = u->len;
+    size_t      pos     = u->pos;
+    uint64_t    window  = u->window;
+    int         valids  = u->valids;
+    int         pixnum  = u->pixnum;
+    int         bitnum  = u->bitnum;
+    long        x       = u->x;
+    long        pixel   = u->pixel;
+    long        i       = 0, i0, end;
+    uint32_t    mask    = setbits[bitnum], sign = signbits[bitnum];
+    uint32_t    nextint;            /* Sign extended difference, mod 2^32 */
+    int         eos     = 0;        /* Stream is truncated */
+
+    while ( i < n ) {
+        if ( pixnum == 0 ) {
+            /* Chunk descriptor: 3 bits log2(count), 3 bits bit-size code */
+            if ( valids < 6 ) {
+                REFILL();
+                if ( valids < 6 ) break;
+            }
+            pixnum  = 1 << ( window & 7 );
+            bitnum  = bitdecode[ ( window >> 3 ) & 7 ];
+            mask    = setbits[bitnum];
+            sign    = signbits[bitnum];
+            window >>= 6;
+            valids -= 6;
+        }
+
+        /* Values of this chunk that are needed */
+        i0  = i;
+        end = i + ( pixnum < n - i ? pixnum : n - i );
+        if ( pixel > x ) {
+            /* Predictor: average of 4 neighbours. Values are sign
+             * extended with the tables, bitnum 0 gives 0. The left
+             * neighbour stays in a register: it is the critical path.
+             * Differences of corrupted streams may be any 32-bit value:
+             * they are added unsigned (mod 2^32), the pixel is cut to
+             * 16 bits when it is stored */
+            const WORD *up = img - x;
+            WORD        left = img[i-1];
+            for ( ; i < end; i++ ) {
+                if ( valids < bitnum ) {
+                    REFILL();
+                    if ( valids < bitnum ) { eos = 1; break; }
+                }
+                nextint = ( ( (uint32_t)window & mask ) ^ sign ) - sign;
+                window >>= bitnum;
+                valids -= bitnum;
+                left    = (WORD)( nextint + (uint32_t)( ( left + up[i+1] + up[i] + up[i-1] + 2 ) / 4 ) );
+                img[i]  = left;
+            }
+        }
+        else {
+            /* First row: left neighbour */
+            for ( ; i < end && pixel + i - i0 <= x; i++ ) {
+                if ( valids < bitnum ) {
+                    REFILL();
+                    if ( valids < bitnum ) { eos = 1; break; }
+                }
+                nextint = ( ( (uint32_t)window & mask ) ^ sign ) - sign;
+                window >>= bitnum;
+                valids -= bitnum;
+                img[i] = (WORD)( pixel + i - i0 == 0 ? nextint : (uint32_t)img[i-1] + nextint );
+            }
+        }
+        pixnum -= (int)( i - i0 );
+        pixel  += i - i0;
+        if ( eos ) break;
+    }
+    u->pos      = pos;
+    u->window   = window;
+    u->valids   = valids;
+    u->pixnum   = pixnum;
+    u->bitnum   = bitnum;
+    u->pixel    = pixel;
+    return i;
+}
+#undef REFILL
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    unpack_rows
+ * Description: Decodes the stream up to row r1 and widens rows r0...r1-1
+ *              into img. Only the x+1 last pixels are kept of the rows
+ *              before r0. Returns the number of pixels stored in img.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static long unpack_rows( UNPACK *u, int r0, int r1, int *img )
+{
+    long    x = u->x, row, nrows, n, i, done = 0;
+    WORD   *w;
+
+    row = u->pixel / x;
+    if ( u->pixel % x || row > r0 || r1 <= r0 ) return 0;
+
+    /* Work buffer: x+1 pixels of history followed by ROWBLOCK rows */
+    nrows = r1 - row < ROWBLOCK ? r1 - row : ROWBLOCK;
+    w = (WORD *)calloc( x + 1 + nrows * x, sizeof(WORD) );
+    if ( w == NULL ) return 0;
+    if ( u->hist != NULL ) memcpy( w, u->hist, ( x + 1 ) * sizeof(WORD) );
+
+    while ( row < r1 ) {
+        if ( nrows > r1 - row ) nrows = r1 - row;
+        n = unpack_word( u, nrows * x, w + x + 1 );
+        i = ( r0 - row ) * x;
+        for ( i = i > 0 ? i : 0; i < n; i++ )
+            img[done++] = (unsigned short)w[x + 1 + i];
+        memmove( w, w + n, ( x + 1 ) * sizeof(WORD) );
+        if ( n < nrows * x ) break;
+        row += nrows;
+    }
+    if ( u->hist != NULL ) memcpy( u->hist, w, ( x + 1 ) * sizeof(WORD) );
+    free( w );
+    return done;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    unpack_seek
+ * Description: Continues decoding from position s, which is the start of
+ *              pixel. Returns 1 if s is a valid position.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int unpack_seek( UNPACK *u, const PCKSEEK *s, long pixel )
+{
+    size_t      pos = (size_t)( s->bit / 8 );
+    int         skip = (int)( s->bit % 8 );
+
+    if ( s->bit < 0 || pos > u->len || ( skip && pos == u->len ) ) return 0;
+    if ( s->pixnum < 0 || s->pixnum > 128 ) return 0;
+    if ( s->bitnum < 0 || s->bitnum > 32 || ( s->bitnum && !bitencode[s->bitnum] ) ) return 0;
+    u->pos      = pos;
+    u->window   = 0;
+    u->valids   = 0;
+    if ( skip ) {
+        u->window = (uint64_t)( u->pck[u->pos++] >> skip );
+        u->valids = 8 - skip;
+    }
+    u->pixnum   = s->pixnum;
+    u->bitnum   = s->bitnum;
+    u->pixel    = pixel;
+    return 1;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    seek_rows
+ * Description: Walks through the chunks of a pck stream for an image with
+ *              x*y pixels without decoding them and stores the position
+ *              of rows 0, step, 2*step ... in seek. Returns the number of
+ *              positions, which is less than (y+step-1)/step if the stream
+ *              is truncated.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int seek_rows( const unsigned char *pck, size_t len, int x, int y, int step, PCKSEEK *seek )
+{
+    uint64_t    bit = 0, nbits = 8 * (uint64_t)len;
+    long        pixel = 0, next = 0, tot = (long)x * y, m;
+    int         pixnum = 0, bitnum = 0, n = 0, v;
+    size_t      pos;
+
+    while ( 1 ) {
+        if ( pixel == next && next < tot ) {
+            seek[n].bit     = (long long)bit;
+            seek[n].pixnum  = pixnum;
+            seek[n].bitnum  = bitnum;
+            n++;
+            next += (long)step * x;
+        }
+        if ( pixel >= tot ) break;
+        if ( pixnum == 0 ) {
+            /* Chunk descriptor: 3 bits log2(count), 3 bits bit-size code */
+            if ( bit + 6 > nbits ) break;
+            pos = (size_t)( bit / 8 );
+            v   = pck[pos] | ( pos + 1 < len ? pck[pos+1] << 8 : 0 );
+            v >>= bit % 8;
+            pixnum  = 1 << ( v & 7 );
+            bitnum  = bitdecode[ ( v >> 3 ) & 7 ];
+            bit    += 6;
+        }
+        m = ( next < tot ? next : tot ) - pixel;
+        if ( m > pixnum ) m = pixnum;
+        if ( bit + (uint64_t)m * bitnum > nbits ) break;
+        bit    += (uint64_t)m * bitnum;
+        pixnum -= (int)m;
+        pixel  += m;
+    }
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    bits
+ * Description: Number of bits needed to store n differences
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int bits( const int *chunk, int n )
+{
+    int size, maxsize, i;
+
+    for ( i = 1, maxsize = abs( chunk[0] ); i < n; ++i )
+        if ( abs( chunk[i] ) > maxsize ) maxsize = abs( chunk[i] );
+    if ( maxsize == 0 )             size = 0;
+    else if ( maxsize < 8 )         size = 4 * n;
+    else if ( maxsize < 16 )        size = 5 * n;
+    else if ( maxsize < 32 )        size = 6 * n;
+    else if ( maxsize < 64 )        size = 7 * n;
+    else if ( maxsize < 128 )       size = 8 * n;
+    else if ( maxsize < 65536 )     size = 16 * n;
+    else                            size = 32 * n;
+    return size;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_longs
+ * Description: Appends n values of size bits each to the bit stream
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static void pack_longs( PCKBUF *p, const int *lng, int n, int size )
+{
+    uint64_t    v;
+    int         i, nbits;
+
+    if ( size <= 0 ) return;
+    for ( i = 0; i < n; i++ ) {
+        v = (uint64_t)( (uint32_t)lng[i] & setbits[size] ) << p->bitmark;
+        p->buf[p->used] |= (unsigned char)v;
+        nbits = p->bitmark + size;
+        while ( nbits >= 8 ) {
+            v >>= 8;
+            p->buf[++p->used] = (unsigned char)v;
+            nbits -= 8;
+        }
+        p->bitmark = nbits;
+    }
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_chunk
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int pack_chunk( PCKBUF *p, const int *lng, int nmbr, int bitsize )
+{
+    int             descriptor[2], i, j;
+    unsigned char  *b;
+
+    /* Room for descriptor and 128 values of 32 bits */
+    if ( p->used + 520 > p->size ) {
+        b = (unsigned char *)realloc( p->buf, 2 * p->size + 520 );
+        if ( b == NULL ) return 0;
+        memset( b + p->size, 0, p->size + 520 );
+        p->buf  = b;
+        p->size = 2 * p->size + 520;
+    }
+    for ( i = nmbr, j = 0; i > 1; i /= 2, ++j );
+    descriptor[0] = j;
+    descriptor[1] = bitencode[bitsize];
+    pack_longs( p, descriptor, 2, 3 );
+    pack_longs( p, lng, nmbr, bitsize );
+    return 1;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_diffs
+ * Description: Compresses n differences into p, in chunks of 1...128
+ *              values. Returns 1 on success.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int pack_diffs( PCKBUF *p, int *buffer, int n )
+{
+    int     chunksiz, packsiz, nbits, next_nbits, tot_nbits;
+    int    *diffs = buffer, *end = buffer + n - 1;
+
+    while ( diffs <= end ) {
+        packsiz  = 0;
+        chunksiz = 1;
+        nbits    = bits( diffs, 1 );
+        while ( packsiz == 0 ) {
+            if ( end <= diffs + chunksiz * 2 )
+                packsiz = chunksiz;
+            else {
+                next_nbits = bits( diffs + chunksiz, chunksiz );
+                tot_nbits  = 2 * ( nbits > next_nbits ? nbits : next_nbits );
+                if ( tot_nbits >= nbits + next_nbits + 6 )
+                    packsiz = chunksiz;
+                else {
+                    nbits = tot_nbits;
+                    if ( chunksiz == 64 )
+                        packsiz = 128;
+                    else
+                        chunksiz *= 2;
+                }
+            }
+        }
+        if ( !pack_chunk( p, diffs, packsiz, nbits / packsiz ) ) return 0;
+        diffs += packsiz;
+    }
+    return 1;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_join
+ * Description: Appends the bit stream of q to p. Returns 1 on success.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int pack_join( PCKBUF *p, const PCKBUF *q )
+{
+    size_t          i, n = q->used + ( q->bitmark > 0 ), nbits;
+    int             m = p->bitmark;
+    unsigned char  *b;
+
+    if ( p->used + n + 520 > p->size ) {
+        b = (unsigned char *)realloc( p->buf, p->used + n + p->size + 520 );
+        if ( b == NULL ) return 0;
+        memset( b + p->size, 0, p->used + n + 520 );
+        p->buf  = b;
+        p->size = p->used + n + p->size + 520;
+    }
+    if ( m == 0 )
+        memcpy( p->buf + p->used, q->buf, n );
+    else {
+        for ( i = 0; i < n; i++ ) {
+            p->buf[p->used+i  ] |= (unsigned char)( q->buf[i] << m );
+            p->buf[p->used+i+1]  = (unsigned char)( q->buf[i] >> ( 8 - m ) );
+        }
+    }
+    nbits       = (size_t)m + 8 * q->used + q->bitmark;
+    p->used    += nbits / 8;
+    p->bitmark  = (int)( nbits % 8 );
+    return 1;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_open
+ * Description: New encoder for an image with x*y pixels. The pck stream
+ *              starts with the identifier line.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static PCKPACK *pack_open( int x, int y )
+{
+    PCKPACK    *k;
+
+    if ( x <= 0 || y <= 0 ) return NULL;
+    k = (PCKPACK *)calloc( 1, sizeof(PCKPACK) );
+    if ( k == NULL ) return NULL;
+    k->x        = x;
+    k->y        = y;
+    k->hist     = (WORD *)calloc( x + 1, sizeof(WORD) );
+    k->diffs    = (int *)malloc( DIFFBUFSIZ * sizeof(int) );
+    k->p.size   = 4096;
+    k->p.buf    = (unsigned char *)calloc( k->p.size, 1 );
+    if ( k->hist == NULL || k->diffs == NULL || k->p.buf == NULL ) {
+        Putmar345RowsClose( k );
+        return NULL;
+    }
+    k->p.used   = sprintf( (char *)k->p.buf, PACKIDENTIFIER, x, y );
+    return k;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    count_words
+ * Description: Adds n 16-bit pixels to the histogram counts (65536 bins)
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static void count_words( unsigned int *counts, const WORD *w, long n )
+{
+    long        i;
+
+    for ( i = 0; i < n; i++ ) counts[ (unsigned short)w[i] ]++;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_words
+ * Description: Adds the next n pixels to the encoder. Differences to the
+ *              predictions are compressed in blocks of DIFFBUFSIZ, as in
+ *              the original pack_wordimage, so the stream does not depend
+ *              on how the image is split. The differences of the signed
+ *              16-bit pixels are not cut to 16 bits (up to +-65535), as
+ *              in the original, since they decide the size of the chunks.
+ *              Returns 1 on success.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+#define PIX(j)  ( (j) >= 0 ? w[j] : k->hist[ x + 1 + (j) ] )
+
+static int pack_words( PCKPACK *k, const WORD *w, long n )
+{
+    long    x = k->x, i, h;
+    long    tot = (long)k->x * k->y;
+
+    if ( k->done + n > tot ) return 0;
+    if ( k->counts ) count_words( k->counts, w, n );
+    for ( i = 0; i < n; i++, k->done++ ) {
+        if ( k->done == 0 )
+            k->diffs[k->ndiffs] = w[i];
+        else if ( k->done <= x )
+            k->diffs[k->ndiffs] = w[i] - PIX(i-1);
+        else if ( i > x )
+            k->diffs[k->ndiffs] = w[i] - ( w[i-1] + w[i-x+1] + w[i-x] + w[i-x-1] + 2 ) / 4;
+        else
+            k->diffs[k->ndiffs] = w[i] - ( PIX(i-1) + PIX(i-x+1) + PIX(i-x) + PIX(i-x-1) + 2 ) / 4;
+        if ( ++k->ndiffs == DIFFBUFSIZ || k->done + 1 == tot ) {
+            if ( !pack_diffs( &k->p, k->diffs, k->ndiffs ) ) return 0;
+            k->ndiffs = 0;
+        }
+    }
+
+    /* Keep the last x+1 pixels for the next call */
+    h = x + 1;
+    if ( n >= h )
+        memcpy( k->hist, w + n - h, h * sizeof(WORD) );
+    else {
+        memmove( k->hist, k->hist + n, ( h - n ) * sizeof(WORD) );
+        memcpy( k->hist + h - n, w, n * sizeof(WORD) );
+    }
+    return 1;
+}
+#undef PIX
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    pack_ints
+ * Description: Adds the next N pixels of a 32-bit image, see Putmar345Rows.
+ *              Returns 1 on success.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int pack_ints( PCKPACK *k, const int *img, long N )
+{
+    WORD        w[DIFFBUFSIZ];
+    long        i, j, n;
+    int32_t    *h;
+
+    for ( i = 0; i < N; i += n ) {
+        n = N - i < DIFFBUFSIZ ? N - i : DIFFBUFSIZ;
+        for ( j = 0; j < n; j++ ) {
+            if ( img[i+j] < 0 )
+                w[j] = 0;
+            else if ( img[i+j] <= 65535 )
+                w[j] = (WORD)img[i+j];
+            else {
+                /* Pixel > 16 bits: keep (address, value) */
+                w[j] = (WORD)65535;
+                if ( k->nhigh == k->maxhigh ) {
+                    h = (int32_t *)realloc( k->high, 2 * ( 2 * k->maxhigh + 256 ) * sizeof(int32_t) );
+                    if ( h == NULL ) return 0;
+                    k->high     = h;
+                    k->maxhigh  = 2 * k->maxhigh + 256;
+                }
+                k->high[ 2 * k->nhigh     ] = (int32_t)( k->done + j );
+                k->high[ 2 * k->nhigh + 1 ] = img[i+j];
+                k->nhigh++;
+            }
+        }
+        if ( !pack_words( k, w, n ) ) return 0;
+    }
+    return 1;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    put_pck
+ * Description: Appends identifier and pck stream to file name
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static int put_pck( char *name, PCKPACK *k )
+{
+    FILE           *fp;
+    unsigned char  *pck;
+    size_t          len;
+    int             ok = 1;
+
+    pck = Putmar345RowsData( k, &len );
+    if ( name == NULL || pck == NULL ) return 0;
+    fp = fopen( name, "ab" );
+    if ( fp == NULL ) {
+        fprintf( stderr, "mario: ERROR in put_pck: cannot open %s\n", name );
+        return 0;
+    }
+    if ( fwrite( pck, 1, len, fp ) != len ) {
+        fprintf( stderr, "mario: ERROR in put_pck (fwrite): %s\n", name );
+        ok = 0;
+    }
+    if ( fclose( fp ) ) ok = 0;
+    return ok ? k->x * k->y : 0;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    read_all
+ * Description: Reads the rest of fp into a newly allocated buffer
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static unsigned char *read_all( FILE *fp, size_t *len )
+{
+    unsigned char  *buf = NULL, *b;
+    size_t          size = 0, n;
+
+    *len = 0;
+    do {
+        if ( *len == size ) {
+            size = size ? 2 * size : 1 << 20;
+            b = (unsigned char *)realloc( buf, size );
+            if ( b == NULL ) {
+                free( buf );
+                return NULL;
+            }
+            buf = b;
+        }
+        n = fread( buf + *len, 1, size - *len, fp );
+        *len += n;
+    } while ( n > 0 );
+    return buf;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    parse_buffer
+ * Description: Checks a complete mar345 image in memory. Returns the offset
+ *              of the pck stream or 0 if the image is not valid.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static size_t parse_buffer( const unsigned char *buf, size_t len, int *x, int *y, int *nhigh, int *swap )
+{
+    int32_t     h32[3];
+    int         i;
+
+    if ( buf == NULL || len < HEADER_BYTES ) return 0;
+
+    /* First integer is 1234, otherwise swap bytes */
+    memcpy( h32, buf, sizeof(h32) );
+    *swap = 0;
+    if ( h32[0] != 1234 ) {
+        for ( i = 0; i < 3; i++ ) h32[i] = swap4( h32[i] );
+        *swap = 1;
+    }
+    if ( h32[0] != 1234 ) return 0;
+    *nhigh = h32[2] > 0 ? h32[2] : 0;
+    if ( HEADER_BYTES + 8 * (size_t)*nhigh > len ) return 0;
+
+    return find_pck( buf, len, HEADER_BYTES + 8 * (size_t)*nhigh, x, y );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    apply_high
+ * Description: Sets the high intensity pixels with addresses lo...hi-1
+ *              in img, which starts at pixel lo. If counts is not NULL,
+ *              the histogram of img is updated (values clipped to 16 bits)
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+static void apply_high( const unsigned char *buf, int nhigh, int swap, long lo, long hi, int *img, unsigned int *counts )
+{
+    int32_t     rec[2];
+    int         i;
+
+    for ( i = 0; i < nhigh; i++ ) {
+        memcpy( rec, buf + HEADER_BYTES + 8 * (size_t)i, sizeof(rec) );
+        if ( swap ) {
+            rec[0] = swap4( rec[0] );
+            rec[1] = swap4( rec[1] );
+        }
+        if ( rec[0] < lo || rec[0] >= hi ) continue;
+        if ( counts ) {
+            counts[ CLIP16( img[ rec[0] - lo ] ) ]--;
+            counts[ CLIP16( rec[1] ) ]++;
+        }
+        img[ rec[0] - lo ] = rec[1];
+    }
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345DataFromBuffer
+ * Description: Decodes N pixels of a complete mar345 image in memory
+ *              into img, including the pixels > 16 bits.
+ *              Returns the number of pixels decoded.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345DataFromBuffer( unsigned char *buf, size_t len, int N, int *img )
+{
+    return Getmar345DataCountFromBuffer( buf, len, N, img, NULL );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345DataCountFromBuffer
+ * Description: As Getmar345DataFromBuffer. If counts is not NULL, the
+ *              decoded pixels are added to the histogram counts (65536
+ *              bins, pixels > 16 bits in the last one) while they are
+ *              widened, so without another pass over the image.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345DataCountFromBuffer( unsigned char *buf, size_t len, int N, int *img, unsigned int *counts )
+{
+    int         i, j, m, n, x, y, nhigh, swap;
+    size_t      pos;
+    WORD       *w, block[ROWBLOCK * 64];
+    UNPACK      u;
+
+    if ( img == NULL || N <= 0 ) return 0;
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 ) return 0;
+    if ( (long)N > (long)x * y ) N = x * y;
+
+    /* The 16-bit pixels go into the upper half of img and are widened
+     * in place, block by block through a copy (memcpy, so the compiler
+     * keeps the order of the accesses): img[i] never overwrites w[j] for
+     * j > i */
+    w = (WORD *)img + N;
+    unpack_init( &u, buf + pos, len - pos, x );
+    n = (int)unpack_word( &u, N, w );
+    for ( i = 0; i < n; i += m ) {
+        m = n - i < ROWBLOCK * 64 ? n - i : ROWBLOCK * 64;
+        memcpy( block, w + i, m * sizeof(WORD) );
+        if ( counts ) count_words( counts, block, m );
+        for ( j = 0; j < m; j++ ) img[i+j] = (unsigned short)block[j];
+    }
+
+    /* High intensity pixels */
+    apply_high( buf, nhigh, swap, 0, n, img, counts );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345Data16FromBuffer
+ * Description: Decodes N 16-bit pixels of a complete mar345 image in memory
+ *              into img. Pixels > 16 bits are not applied.
+ *              Returns the number of pixels decoded.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345Data16FromBuffer( unsigned char *buf, size_t len, int N, short *img )
+{
+    int         x, y, nhigh, swap;
+    size_t      pos;
+    UNPACK      u;
+
+    if ( img == NULL || N <= 0 ) return 0;
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 ) return 0;
+    if ( (long)N > (long)x * y ) N = x * y;
+
+    unpack_init( &u, buf + pos, len - pos, x );
+    return (int)unpack_word( &u, N, (WORD *)img );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345RowsFromBuffer
+ * Description: Decodes rows row0...row0+nrows-1 of a complete mar345 image
+ *              in memory into img (nrows*nx pixels), including the pixels
+ *              > 16 bits. The stream is decoded up to the last row only.
+ *              nx, ny is the size of the image the caller expects, e.g.
+ *              from the text header. Returns the number of pixels decoded
+ *              or 0 if the pck stream is for an image of another size.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345RowsFromBuffer( unsigned char *buf, size_t len, int nx, int ny, int row0, int nrows, int *img )
+{
+    int         x, y, nhigh, swap;
+    long        n;
+    size_t      pos;
+    UNPACK      u;
+
+    if ( img == NULL || row0 < 0 || nrows <= 0 ) return 0;
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 || x != nx || y != ny || row0 + nrows > y ) return 0;
+
+    unpack_init( &u, buf + pos, len - pos, x );
+    n = unpack_rows( &u, row0, row0 + nrows, img );
+    apply_high( buf, nhigh, swap, (long)row0 * x, (long)row0 * x + n, img, NULL );
+    return (int)n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345Seek
+ * Description: Stores the positions of rows 0, step, 2*step ... of a
+ *              complete mar345 image in memory in seek, which must have
+ *              room for (ny+step-1)/step entries. Returns the number of
+ *              positions or 0 if the image is not valid or the pck stream
+ *              is not for an image of nx*ny pixels.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345Seek( unsigned char *buf, size_t len, int nx, int ny, int step, PCKSEEK *seek )
+{
+    int         x, y, nhigh, swap;
+    size_t      pos;
+
+    if ( seek == NULL || step <= 0 ) return 0;
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 || x != nx || y != ny ) return 0;
+    return seek_rows( buf + pos, len - pos, x, y, step, seek );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345RowsFromSeek
+ * Description: As Getmar345RowsFromBuffer, but decoding starts at row
+ *              (<= row0) with the position seek and the x+1 pixels hist
+ *              before row, e.g. from Getmar345Seek. Bands of rows can be
+ *              decoded this way independently of each other. hist has
+ *              nx+1 pixels, img room for nrows*nx.
+ *              Returns the number of pixels decoded or 0 if the pck
+ *              stream is not for an image of nx*ny pixels.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345RowsFromSeek( unsigned char *buf, size_t len, int nx, int ny, PCKSEEK *seek, int row, short *hist, int row0, int nrows, int *img )
+{
+    int         x, y, nhigh, swap;
+    long        n;
+    size_t      pos;
+    UNPACK      u;
+
+    if ( img == NULL || seek == NULL || hist == NULL ) return 0;
+    if ( row < 0 || row > row0 || nrows <= 0 ) return 0;
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 || x != nx || y != ny || row0 + nrows > y ) return 0;
+
+    unpack_init( &u, buf + pos, len - pos, x );
+    if ( !unpack_seek( &u, seek, (long)row * x ) ) return 0;
+    /* unpack_rows updates the history, so it works on a copy */
+    u.hist = (WORD *)malloc( ( x + 1 ) * sizeof(WORD) );
+    if ( u.hist == NULL ) return 0;
+    memcpy( u.hist, hist, ( x + 1 ) * sizeof(WORD) );
+    n = unpack_rows( &u, row0, row0 + nrows, img );
+    free( u.hist );
+    apply_high( buf, nhigh, swap, (long)row0 * x, (long)row0 * x + n, img, NULL );
+    return (int)n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345Data16
+ * Description: Decodes N 16-bit pixels of the pck stream following the
+ *              current position of fp. Pixels > 16 bits are not applied.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345Data16( FILE *fp, int N, short *img )
+{
+    unsigned char  *buf;
+    size_t          len, pos;
+    int             x, y, n = 0;
+    UNPACK          u;
+
+    if ( fp == NULL || img == NULL || N <= 0 ) return 0;
+    buf = read_all( fp, &len );
+    if ( buf == NULL ) return 0;
+    pos = find_pck( buf, len, 0, &x, &y );
+    if ( pos > 0 ) {
+        if ( (long)N > (long)x * y ) N = x * y;
+        unpack_init( &u, buf + pos, len - pos, x );
+        n = (int)unpack_word( &u, N, (WORD *)img );
+    }
+    free( buf );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345Data32
+ * Description: Decodes N 32-bit pixels of the mar345 image in fp
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345Data32( FILE *fp, int N, int *img )
+{
+    unsigned char  *buf;
+    size_t          len;
+    int             n;
+
+    if ( fp == NULL ) return 0;
+    if ( fseek( fp, 0, SEEK_SET ) ) return 0;
+    buf = read_all( fp, &len );
+    if ( buf == NULL ) return 0;
+    n = Getmar345DataFromBuffer( buf, len, N, img );
+    free( buf );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345DataFromName
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345DataFromName( char *name, int N, int *img )
+{
+    FILE   *fp;
+    int     n;
+
+    if ( name == NULL ) return 0;
+    fp = fopen( name, "rb" );
+    if ( fp == NULL ) {
+        fprintf( stderr, "mario: ERROR in Getmar345DataFromName: cannot open %s\n", name );
+        return 0;
+    }
+    n = Getmar345Data32( fp, N, img );
+    fclose( fp );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345RowsOpen
+ * Description: Starts decoding a complete mar345 image in memory row by
+ *              row. buf must not be freed before Getmar345RowsClose.
+ *              Returns NULL if the pck stream is not for an image of
+ *              nx*ny pixels, the size the caller expects.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+PCKROWS *Getmar345RowsOpen( unsigned char *buf, size_t len, int nx, int ny )
+{
+    PCKROWS    *r;
+    int         x, y, nhigh, swap;
+    size_t      pos;
+
+    pos = parse_buffer( buf, len, &x, &y, &nhigh, &swap );
+    if ( pos == 0 || x != nx || y != ny ) return NULL;
+    r = (PCKROWS *)calloc( 1, sizeof(PCKROWS) );
+    if ( r == NULL ) return NULL;
+    unpack_init( &r->u, buf + pos, len - pos, x );
+    r->u.hist   = (WORD *)calloc( x + 1, sizeof(WORD) );
+    if ( r->u.hist == NULL ) {
+        free( r );
+        return NULL;
+    }
+    r->buf      = buf;
+    r->y        = y;
+    r->nhigh    = nhigh;
+    r->swap     = swap;
+    return r;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345RowsNext
+ * Description: Decodes the next nrows rows into img, which has room for
+ *              N pixels, including the pixels > 16 bits. Only as many
+ *              rows as fit into img are decoded.
+ *              Returns the number of pixels decoded.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Getmar345RowsNext( PCKROWS *r, int nrows, int N, int *img )
+{
+    long    x, row, n;
+
+    if ( r == NULL || img == NULL || nrows <= 0 || N <= 0 ) return 0;
+    x   = r->u.x;
+    row = r->u.pixel / x;
+    if ( nrows > N / x ) nrows = (int)( N / x );
+    if ( row + nrows > r->y ) nrows = r->y - row;
+    if ( nrows <= 0 ) return 0;
+    n = unpack_rows( &r->u, row, row + nrows, img );
+    apply_high( r->buf, r->nhigh, r->swap, row * x, row * x + n, img, NULL );
+    return (int)n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345RowsClose
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+void Getmar345RowsClose( PCKROWS *r )
+{
+    if ( r == NULL ) return;
+    free( r->u.hist );
+    free( r );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Getmar345Count
+ * Description: Adds n pixels of a 32-bit image to the histogram counts
+ *              (65536 bins), pixels are clipped to 16 bits. For images
+ *              not decoded by Getmar345DataCountFromBuffer
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+void Getmar345Count( int *img, long n, unsigned int *counts )
+{
+    WORD        w[DIFFBUFSIZ];
+    long        i, j, m;
+
+    if ( img == NULL || counts == NULL ) return;
+    for ( i = 0; i < n; i += m ) {
+        m = n - i < DIFFBUFSIZ ? n - i : DIFFBUFSIZ;
+        for ( j = 0; j < m; j++ ) w[j] = (WORD)CLIP16( img[i+j] );
+        count_words( counts, w, m );
+    }
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsOpen
+ * Description: Starts encoding an image with x*y pixels row by row
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+PCKPACK *Putmar345RowsOpen( int x, int y )
+{
+    return pack_open( x, y );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Rows
+ * Description: Adds the next nrows rows of a 32-bit image. Pixels are
+ *              clipped to 16 bits, so the high intensity records must be
+ *              written by the caller. Returns the number of pixels added.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Rows( PCKPACK *k, int nrows, int *img )
+{
+    if ( k == NULL || img == NULL || nrows <= 0 ) return 0;
+    if ( !pack_ints( k, img, (long)nrows * k->x ) ) return 0;
+    return nrows * k->x;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Rows16
+ * Description: As Putmar345Rows for 16-bit images
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Rows16( PCKPACK *k, int nrows, short *img )
+{
+    if ( k == NULL || img == NULL || nrows <= 0 ) return 0;
+    if ( !pack_words( k, (const WORD *)img, (long)nrows * k->x ) ) return 0;
+    return nrows * k->x;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsCount
+ * Description: The pixels added from now on are also added to the
+ *              histogram counts (65536 bins, clipped to 16 bits as in the
+ *              pck stream). counts belongs to the caller, NULL: stop.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+void Putmar345RowsCount( PCKPACK *k, unsigned int *counts )
+{
+    if ( k != NULL ) k->counts = counts;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsData
+ * Description: Returns identifier and pck stream when all rows have been
+ *              added, otherwise NULL. The memory belongs to k.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+unsigned char *Putmar345RowsData( PCKPACK *k, size_t *len )
+{
+    if ( k == NULL || k->done != (long)k->x * k->y ) return NULL;
+    /* Last byte is always written, even if empty */
+    *len = k->p.used + 1;
+    return k->p.buf;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsHigh
+ * Description: Returns the (address, value) pairs of the pixels > 16 bits
+ *              given to Putmar345Rows. The memory belongs to k.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int *Putmar345RowsHigh( PCKPACK *k, int *nhigh )
+{
+    if ( k == NULL ) return NULL;
+    *nhigh = (int)k->nhigh;
+    return (int *)k->high;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsClose
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+void Putmar345RowsClose( PCKPACK *k )
+{
+    if ( k == NULL ) return;
+    free( k->hist );
+    free( k->diffs );
+    free( k->high );
+    free( k->p.buf );
+    free( k );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345PartOpen
+ * Description: Starts encoding the part of an image from pixel first on.
+ *              first must be a multiple of PCKBLOCK, so that the blocks of
+ *              differences are the same as in the complete image and the
+ *              joined stream is identical to the one of Putmar345Rows.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+PCKPACK *Putmar345PartOpen( int x, int y, long first )
+{
+    PCKPACK    *k;
+
+    if ( first < 0 || first % DIFFBUFSIZ || first >= (long)x * y ) return NULL;
+    k = pack_open( x, y );
+    if ( k == NULL ) return NULL;
+    /* No identifier: the stream is appended to another one */
+    memset( k->p.buf, 0, k->p.used );
+    k->p.used   = 0;
+    k->first    = first;
+    k->done     = first;
+    return k;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Part
+ * Description: Adds the next n pixels of the 32-bit image img to part k,
+ *              i.e. img[k->done]...img[k->done+n-1]. The part must end at
+ *              a multiple of PCKBLOCK or at the end of the image. Returns
+ *              the number of pixels added.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Part( PCKPACK *k, long n, int *img )
+{
+    long        i, j;
+
+    if ( k == NULL || img == NULL || n <= 0 ) return 0;
+    /* Predictions need the x+1 pixels before the part, clipped as in pack_ints */
+    for ( i = 0, j = k->done - k->x - 1; i <= k->x; i++, j++ )
+        k->hist[i] = j < 0 || img[j] < 0 ? 0 : img[j] > 65535 ? (WORD)65535 : (WORD)img[j];
+    if ( !pack_ints( k, img + k->done, n ) ) return 0;
+    return (int)n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Part16
+ * Description: As Putmar345Part for 16-bit images
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Part16( PCKPACK *k, long n, short *img )
+{
+    long        i, j;
+
+    if ( k == NULL || img == NULL || n <= 0 ) return 0;
+    for ( i = 0, j = k->done - k->x - 1; i <= k->x; i++, j++ )
+        k->hist[i] = j < 0 ? 0 : (WORD)img[j];
+    if ( !pack_words( k, (const WORD *)img + k->done, n ) ) return 0;
+    return (int)n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345RowsJoin
+ * Description: Appends the stream and the pixels > 16 bits of part to k.
+ *              part must start where k ends. Returns the number of pixels
+ *              joined.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345RowsJoin( PCKPACK *k, PCKPACK *part )
+{
+    int32_t    *h;
+
+    if ( k == NULL || part == NULL || k->x != part->x || k->y != part->y ) return 0;
+    if ( part->first != k->done || k->ndiffs || part->ndiffs ) return 0;
+    if ( part->nhigh ) {
+        h = (int32_t *)realloc( k->high, 2 * ( k->nhigh + part->nhigh ) * sizeof(int32_t) );
+        if ( h == NULL ) return 0;
+        memcpy( h + 2 * k->nhigh, part->high, 2 * part->nhigh * sizeof(int32_t) );
+        k->high     = h;
+        k->nhigh   += part->nhigh;
+        k->maxhigh  = k->nhigh;
+    }
+    if ( !pack_join( &k->p, &part->p ) ) return 0;
+    /* History for rows added to k after the part */
+    memcpy( k->hist, part->hist, ( k->x + 1 ) * sizeof(WORD) );
+    k->done = part->done;
+    return (int)( part->done - part->first );
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Data16
+ * Description: Appends the pck compressed 16-bit image to file name.
+ *              Returns the number of pixels written.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Data16( char *name, int x, int y, short *img )
+{
+    PCKPACK    *k;
+    int         n = 0;
+
+    k = pack_open( x, y );
+    if ( k != NULL && Putmar345Rows16( k, y, img ) ) n = put_pck( name, k );
+    Putmar345RowsClose( k );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Data32
+ * Description: As Putmar345Data16 for 32-bit images. Pixels are clipped
+ *              to 16 bits, so the high intensity records must be written
+ *              by the caller.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Data32( char *name, int x, int y, int *img )
+{
+    PCKPACK    *k;
+    int         n = 0;
+
+    k = pack_open( x, y );
+    if ( k != NULL && Putmar345Rows( k, y, img ) ) n = put_pck( name, k );
+    Putmar345RowsClose( k );
+    return n;
+}
+
+/* +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Function:    Putmar345Data
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ */
+int Putmar345Data( char *name, int x, int y, int *img )
+{
+    return Putmar345Data32( name, x, y, img );
+}
@@ -0,0 +1,76 @@
+/*
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Module:          marpck.h
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Description:     Public interface of the mar345 pck (de)compression
+ *                  library _libmar345
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ * Note:            This file is also parsed by cffi (see buildlib.py), so it
+ *                  must not contain preprocessor directives except simple
+ *                  integer #defines. Include <stdio.h> before this file.
+ * +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+ */
+#define N_GAPS                  8
+#define PCKBLOCK                16384   /* Pixels per block of differences */
+
+typedef struct pckrows  PCKROWS;
+typedef struct pckpack  PCKPACK;
+
+/* State of the decoder at the start of a row */
+typedef struct {
+    long long   bit;        /* Bits from the start of the pck stream */
+    int         pixnum;     /* Values left in the current chunk ... */
+    int         bitnum;     /* ... and their size in bits */
+} PCKSEEK;
+
+/* Decode from an open file */
+int Getmar345Data16( FILE *fp, int N, short *img );
+int Getmar345Data32( FILE *fp, int N, int *img );
+
+/* Decode from a file given by name */
+int Getmar345DataFromName( char *name, int N, int *img );
+
+/* Decode a complete mar345 image (header, high records, pck) in memory */
+int Getmar345DataFromBuffer( unsigned char *buf, size_t len, int N, int *img );
+int Getmar345Data16FromBuffer( unsigned char *buf, size_t len, int N, short *img );
+
+/* Histograms of the pixels (65536 bins, clipped to 16 bits): while decoding
+ * a complete image in memory, or of a 32-bit image */
+int Getmar345DataCountFromBuffer( unsigned char *buf, size_t len, int N, int *img, unsigned int *counts );
+void Getmar345Count( int *img, long n, unsigned int *counts );
+
+/* Decode rows row0...row0+nrows-1 of a complete mar345 image in memory */
+int Getmar345RowsFromBuffer( unsigned char *buf, size_t len, int nx, int ny, int row0, int nrows, int *img );
+
+/* Positions of rows 0, step, 2*step ... in the pck stream of a complete
+ * mar345 image in memory and decoding of rows from such a position on.
+ * hist holds the x+1 (16-bit) pixels before row */
+int Getmar345Seek( unsigned char *buf, size_t len, int nx, int ny, int step, PCKSEEK *seek );
+int Getmar345RowsFromSeek( unsigned char *buf, size_t len, int nx, int ny, PCKSEEK *seek, int row, short *hist, int row0, int nrows, int *img );
+
+/* Decode a complete mar345 image in memory row by row */
+PCKROWS *Getmar345RowsOpen( unsigned char *buf, size_t len, int nx, int ny );
+int Getmar345RowsNext( PCKROWS *r, int nrows, int N, int *img );
+void Getmar345RowsClose( PCKROWS *r );
+
+/* Encode an image row by row into identifier and pck stream in memory */
+PCKPACK *Putmar345RowsOpen( int x, int y );
+int Putmar345Rows( PCKPACK *k, int nrows, int *img );
+int Putmar345Rows16( PCKPACK *k, int nrows, short *img );
+void Putmar345RowsCount( PCKPACK *k, unsigned int *counts );
+unsigned char *Putmar345RowsData( PCKPACK *k, size_t *len );
+int *Putmar345RowsHigh( PCKPACK *k, int *nhigh );
+void Putmar345RowsClose( PCKPACK *k );
+
+/* Encode parts of an image independently (e.g. in several threads) and
+ * join them in order into the stream of an encoder from Putmar345RowsOpen.
+ * Parts start at multiples of PCKBLOCK pixels, img is the complete image */
+PCKPACK *Putmar345PartOpen( int x, int y, long first );
+int Putmar345Part( PCKPACK *k, long n, int *img );
+int Putmar345Part16( PCKPACK *k, long n, short *img );
+int Putmar345RowsJoin( PCKPACK *k, PCKPACK *part );
+
+/* Append the pck compressed image to a file given by name */
+int Putmar345Data( char *name, int x, int y, int *img );
+int Putmar345Data16( char *name, int x, int y, short *img );
+int Putmar345Data32( char *name, int x, int y, int *img );
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:		    convert
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:	Batch conversion of mar345 images into NumPy (.npy) or raw
+                32-bit files. Images are decoded in a pool of processes
+                which hand the pixels back through shared memory.
+
+                python -m mario.convert [options] dir|glob|file ...
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:		    Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, optparse
+import concurrent.futures
+from   multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from   mario import mar345
+from   mario.mar345 import find, mar345_name
+
+# Output formats and their file extensions
+formats = { 'npy' : '.npy', 'raw' : '.raw32' }
+
+###########################################################################
+## Function:    _decode
+## Description: Runs in a worker process. Decodes one image straight into
+##              the shared memory block shmname that the parent made for it
+##              and keeps until the image has been written.
+###########################################################################
+def _decode(name, shmname, shape):
+    shm = shared_memory.SharedMemory(name=shmname)
+    try:
+        img = mar345.Mar345().read(name, out=np.ndarray( shape, dtype=np.int32, buffer=shm.buf ))
+        ok  = img.success
+        del img                 # No views of the block may be left
+    finally:
+        shm.close()
+    if not ok:
+        raise IOError("Cannot decode '{}'".format(name))
+    return os.path.getsize(name)
+
+###########################################################################
+## Function:    _alloc
+## Description: Makes the shared memory block for image name from the
+##              size in its header. Returns (block, shape)
+###########################################################################
+def _alloc(name):
+    h = mar345.Mar345().read(name, onlyheader=True)
+    if not h.success:
+        raise IOError("Cannot read header of '{}'".format(name))
+    shm = shared_memory.SharedMemory(create=True, size=h.x * h.y * np.dtype(np.int32).itemsize)
+    return shm, (h.y, h.x)
+
+###########################################################################
+## Function:    convert
+## Arguments:   names:      list of mar345 images
+##              outdir:     output directory, default: next to the image
+##              fmt:        output format 'npy' or 'raw'
+##              workers:    number of processes, default: number of CPUs
+##              verbose:    default=0
+###########################################################################
+def convert(names, outdir=None, fmt='npy', workers=None, verbose=0):
+    '''convert: converts mar345 images into .npy or .raw32 files.
+    Returns dict with statistics and a list of (name, error) failures'''
+    if not fmt in formats:
+        raise ValueError("Unknown output format '{}'".format(fmt))
+    if workers == None: workers = os.cpu_count() or 1
+    if outdir != None: os.makedirs(outdir, exist_ok=True)
+
+    # Workers must share the resource tracker of this process,
+    # otherwise it cleans up the shared memory behind our back
+    resource_tracker.ensure_running()
+
+    stats    = { 'files' : 0, 'bytes_in' : 0, 'bytes_out' : 0, 'seconds' : 0.0 }
+    failures = [ ]
+    todo     = iter(names)
+    running  = { }
+    t0       = time.perf_counter()
+    tty      = sys.stderr.isatty()
+
+    def fail(name, e):
+        failures.append( (name, str(e)) )
+        if verbose: print("ERROR (convert): {}: {}".format(name, e))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # The shared memory of an image is made here and kept open until
+        # it has been written: on Windows, a block is freed when its last
+        # handle is closed. Keep at most 2 images per worker in flight, so
+        # that shared memory does not pile up if writing is slower than
+        # decoding
+        def submit():
+            for name in todo:
+                try:
+                    shm, shape = _alloc( name )
+                except Exception as e:
+                    fail( name, e )
+                    continue
+                try:
+                    f = pool.submit(_decode, name, shm.name, shape)
+                except BaseException:
+                    shm.close()
+                    shm.unlink()
+                    raise
+                running[f] = ( name, shm, shape )
+                if len(running) >= 2*workers: break
+        submit()
+        while running:
+            done, _ = concurrent.futures.wait( running, return_when=concurrent.futures.FIRST_COMPLETED )
+            for f in done:
+                name, shm, shape = running.pop(f)
+                try:
+                    size = f.result()
+                    stats['bytes_out'] += _write( name, shm, shape, outdir, fmt )
+                    stats['bytes_in']  += size
+                    stats['files']     += 1
+                except Exception as e:
+                    fail( name, e )
+                finally:
+                    shm.close()
+                    shm.unlink()
+                n = stats['files'] + len(failures)
+                if verbose > 1:
+                    print("convert: [{:{w}d}/{}] {}".format(n, len(names), name, w=len(str(len(names)))))
+                elif tty:
+                    t = time.perf_counter() - t0
+                    sys.stderr.write("\rconvert: {}/{} files {:.1f} files/s ".format(n, len(names), n/t if t>0 else 0.))
+            submit()
+    if tty and verbose < 2: sys.stderr.write("\n")
+    stats['seconds'] = time.perf_counter() - t0
+    return stats, failures
+
+###########################################################################
+## Function:    _write
+## Description: Writes one decoded image from shared memory and returns
+##              the number of bytes written
+###########################################################################
+def _write(name, shm, shape, outdir, fmt):
+    data = np.ndarray( shape, dtype=np.int32, buffer=shm.buf )
+    out  = os.path.join( outdir if outdir != None else os.path.dirname(name),
+                         os.path.basename(name) + formats[fmt] )
+    try:
+        if fmt == 'npy':
+            np.save( out, data )
+        else:
+            data.tofile( out )
+    finally:
+        del data
+    return os.path.getsize(out)
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="python -m mario.convert [options] dir|glob|file ...")
+    p.add_option('-o', '--outdir',  default=None, help="Output directory (default: next to images)")
+    p.add_option('-f', '--format',  default='npy', choices=list(formats), help="Output format: npy or raw")
+    p.add_option('-j', '--workers', default=None, type="int", help="Number of processes (default: number of CPUs)")
+    p.add_option('-r', '--recursive', default=False, action="store_true", help="Descend into subdirectories")
+    p.add_option('-v', '--verbose', default=0, action="count", help="Increase verbosity level")
+    p.add_option('--prg',default="convert")
+    o,r  = p.parse_args()
+
+    names = find( r, o.recursive )
+    if len(names) == 0:
+        print("{}: no mar345 images found".format(o.prg))
+        sys.exit(1)
+
+    stats, failures = convert( names, o.outdir, o.format, o.workers, o.verbose )
+    t = stats['seconds']
+    print("{}: {} files converted, {} failed in {:.2f} s || {:.1f} files/s || {:.1f} MB/s read || {:.1f} MB/s written".format(
+        o.prg, stats['files'], len(failures), t, stats['files']/t, stats['bytes_in']/t/1e6, stats['bytes_out']/t/1e6 ))
+    for name, error in failures:
+        print("{}: FAILED {}: {}".format(o.prg, name, error))
+    if failures: sys.exit(1)
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:		    index
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:	Persistent index of mar345 image headers in an SQLite file.
+                The index is updated incrementally: only images with a new
+                (path, size, mtime) are parsed again. Queries are done with
+                NumPy on whole columns.
+
+                python -m mario.index [options] index.db [dir|glob|file ...]
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:		    Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, sqlite3, optparse
+import concurrent.futures
+import numpy as np
+from   mario import mar345
+from   mario.mar345 import find
+
+# Header fields in the index and their SQL types.
+# Lists in the header are stored as field_x, field_y
+fields = [
+	( 'x',		    'INTEGER' ),
+	( 'y',		    'INTEGER' ),
+	( 'pixels',	    'INTEGER' ),
+	( 'high',	    'INTEGER' ),
+	( 'serial',	    'INTEGER' ),
+	( 'program',	'TEXT' ),
+	( 'date',	    'TEXT' ),
+	( 'detector',	'TEXT' ),
+	( 'type',	    'TEXT' ),
+	( 'time',	    'REAL' ),
+	( 'wavelength',	'REAL' ),
+	( 'distance',	'REAL' ),
+	( 'resolution',	'REAL' ),
+	( 'phibeg',	    'REAL' ),
+	( 'phiend',	    'REAL' ),
+	( 'phiosc',	    'INTEGER' ),
+	( 'omebeg',	    'REAL' ),
+	( 'omeend',	    'REAL' ),
+	( 'omeosc',	    'INTEGER' ),
+	( 'theta',	    'REAL' ),
+	( 'chi',	    'REAL' ),
+	( 'gain',	    'REAL' ),
+	( 'multiplier',	'REAL' ),
+	( 'pixelsize_x','REAL' ),
+	( 'pixelsize_y','REAL' ),
+	( 'center_x',	'REAL' ),
+	( 'center_y',	'REAL' ),
+	( 'dose_n',	    'INTEGER' ),
+	( 'dosebeg',	'REAL' ),
+	( 'doseend',	'REAL' ),
+	( 'dosemin',	'REAL' ),
+	( 'dosemax',	'REAL' ),
+	( 'doseavg',	'REAL' ),
+	( 'dosesig',	'REAL' ),
+	( 'valmin',	    'INTEGER' ),
+	( 'valmax',	    'INTEGER' ),
+	( 'valavg',	    'REAL' ),
+	( 'valsig',	    'REAL' ),
+	( 'histbeg',	'INTEGER' ),
+	( 'histend',	'INTEGER' ),
+	( 'histmax',	'INTEGER' ),
+	( 'source',	    'TEXT' ),
+	( 'kV',		    'REAL' ),
+	( 'mA',		    'REAL' ),
+]
+
+###########################################################################
+## Function:    _header
+## Description: Parses the header of one image, returns a row of the index
+###########################################################################
+def _header(name):
+    img = mar345.Mar345().read(name, onlyheader=True)
+    if not img.success: return None
+    h = img.header
+    row = [ ]
+    for f, t in fields:
+        if f.endswith('_x') or f.endswith('_y'):
+            v = h[ f[:-2] ][ 0 if f.endswith('_x') else 1 ]
+        else:
+            v = h[f]
+        row.append( str(v) if t == 'TEXT' else v )
+    return row
+
+###########################################################################
+## Class:       HeaderIndex
+## Arguments:   name:      filename of the index (SQLite database)
+##              verbose:   default=0
+###########################################################################
+class HeaderIndex( ):
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         __init__
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def __init__(self, name, verbose=0):
+        '''HeaderIndex::__init__: opens or creates the index'''
+        self.filename   = name
+        self.verbose    = verbose
+        self.db         = sqlite3.connect(name)
+        self._columns   = None
+        cols = ", ".join( '"{}" {}'.format(f, t) for f, t in fields )
+        self.db.execute( 'CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, {})'.format(cols) )
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute( 'SELECT COUNT(*) FROM headers' ).fetchone()[0]
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         close
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def close(self):
+        '''HeaderIndex::close: closes the index'''
+        if self.db != None: self.db.close()
+        self.db = None
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         update
+    # Arguments:        args:       list of directories, glob patterns or files
+    #                   recursive:  descend into subdirectories, default=False
+    #                   workers:    number of processes for parsing, default=1
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def update(self, args, recursive=False, workers=1):
+        '''HeaderIndex::update: adds new and changed images to the index and
+        removes images that do not exist any more or whose header cannot be
+        read any more. Returns a dict of counts'''
+        t0      = time.perf_counter()
+        known   = { p : (s, m) for p, s, m in self.db.execute( 'SELECT path, size, mtime FROM headers' ) }
+        todo    = [ ]
+        stat    = { }
+        count   = { 'unchanged' : 0, 'added' : 0, 'updated' : 0, 'removed' : 0, 'failed' : 0 }
+
+        # Only images with a new (path, size, mtime) are parsed
+        for name in find(args, recursive):
+            name = os.path.abspath(name)
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            stat[name] = ( st.st_size, st.st_mtime_ns )
+            if known.get(name) == stat[name]:
+                count['unchanged'] += 1
+            else:
+                todo.append(name)
+
+        # Images in the index that are gone
+        gone = [ (p,) for p in known if not p in stat and not os.path.exists(p) ]
+        self.db.executemany( 'DELETE FROM headers WHERE path=?', gone )
+        count['removed'] = len(gone)
+
+        # Parse headers, optionally in a pool of processes
+        if workers > 1 and len(todo) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = list( pool.map(_header, todo, chunksize=64) )
+        else:
+            rows = [ _header(name) for name in todo ]
+
+        insert = 'INSERT OR REPLACE INTO headers VALUES ({})'.format( ",".join( (len(fields)+3)*'?' ) )
+        for name, row in zip(todo, rows):
+            if row == None:
+                # The row of an image that changed no longer holds its header
+                count['failed'] += 1
+                if name in known: self.db.execute( 'DELETE FROM headers WHERE path=?', (name,) )
+                if self.verbose: print("ERROR (HeaderIndex::update): Cannot read header of '{}'".format(name))
+                continue
+            count[ 'updated' if name in known else 'added' ] += 1
+            self.db.execute( insert, [ name, stat[name][0], stat[name][1] ] + row )
+        self.db.commit()
+        self._columns = None
+
+        if self.verbose:
+            print("HeaderIndex::update: {} in {:.2f} s".format( count, time.perf_counter()-t0 ))
+        return count
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         columns
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def columns(self):
+        '''HeaderIndex::columns: returns dict of NumPy arrays, one per field'''
+        if self._columns == None:
+            names = [ 'path' ] + [ f for f, t in fields ]
+            rows  = self.db.execute( 'SELECT {} FROM headers ORDER BY path'.format( ",".join('"{}"'.format(n) for n in names) ) ).fetchall()
+            cols  = list( zip(*rows) ) if rows else [ () ] * len(names)
+            types = { 'INTEGER' : np.int64, 'REAL' : np.float64, 'TEXT' : object }
+            self._columns = { 'path' : np.array( cols[0], dtype=object ) }
+            for (f, t), c in zip( fields, cols[1:] ):
+                self._columns[f] = np.array( c, dtype=types[t] )
+        return self._columns
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         select
+    # Arguments:        field=value or field=(min, max), e.g.
+    #                   select(phibeg=(30,60), distance=150)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def select(self, **kw):
+        '''HeaderIndex::select: returns array of paths of all images matching
+        all conditions. A (min, max) tuple is an inclusive range, None in a
+        tuple means open-ended. Floats are compared with np.isclose'''
+        c    = self.columns()
+        mask = np.ones( len(c['path']), dtype=bool )
+        for f, v in kw.items():
+            if not f in c:
+                raise KeyError("Unknown header field '{}'".format(f))
+            col = c[f]
+            if isinstance(v, (tuple, list)):
+                if v[0] != None: mask &= col >= v[0]
+                if v[1] != None: mask &= col <= v[1]
+            elif col.dtype == np.float64:
+                mask &= np.isclose( col, v )
+            else:
+                mask &= col == v
+        return c['path'][mask]
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="python -m mario.index [options] index.db [dir|glob|file ...]")
+    p.add_option('-q', '--query',   default=[], action="append", help="Condition field=value or field=min:max, e.g. phibeg=30:60")
+    p.add_option('-j', '--workers', default=1, type="int", help="Number of processes for parsing headers")
+    p.add_option('-r', '--recursive', default=False, action="store_true", help="Descend into subdirectories")
+    p.add_option('-v', '--verbose', default=0, action="count", help="Increase verbosity level")
+    p.add_option('--prg',default="index")
+    o,r  = p.parse_args()
+    if len(r) == 0:
+        p.print_usage()
+        sys.exit(1)
+
+    with HeaderIndex( r[0], verbose=o.verbose ) as idx:
+        if len(r) > 1:
+            count = idx.update( r[1:], o.recursive, o.workers )
+            print("{}: {} images in index || {}".format( o.prg, len(idx), ", ".join("{} {}".format(v,k) for k,v in count.items()) ))
+
+        if len(o.query) == 0: return
+        kw = { }
+        for q in o.query:
+            f, v = q.split('=', 1)
+            if ':' in v:
+                kw[f] = tuple( float(x) if x else None for x in v.split(':', 1) )
+            else:
+                try:    kw[f] = float(v)
+                except: kw[f] = v
+        for path in idx.select( **kw ):
+            print(path)
+
+if __name__ == "__main__":
+    start()
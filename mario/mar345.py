@@ -18,7 +18,9 @@ Version         Date        Description
 1.0             23/01/2020  Original version
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 """
-import os, sys, array, time, datetime, re, math
+import os, sys, array, time, datetime, re, math, threading, glob, warnings
+import concurrent.futures
+from   collections import OrderedDict, deque
 import numpy as np
 path = os.path.dirname(__file__)
 sys.path.append(path)
@@ -93,6 +95,570 @@ h345 = {
 	'histmax'	:	0,
 }
 
+# Fresh copy of the h345 defaults. Faster than copy.deepcopy: the only
+# mutable values are flat lists
+def _newheader():
+    return { k : list(v) if isinstance(v, list) else v for k, v in h345.items() }
+
+###########################################################################
+## Class:       FrameCache
+## Arguments:   maxbytes:  memory budget for headers and data arrays
+###########################################################################
+class FrameCache( ):
+    '''LRU cache of decoded mar345 images, keyed by (realpath, size, mtime_ns).
+    Data arrays in the cache are read-only'''
+    def __init__(self, maxbytes=1<<30):
+        self.maxbytes   = maxbytes
+        self.nbytes     = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self._entries   = OrderedDict()     # key: [raw_header, data]
+        self._paths     = { }               # realpath: key
+        self._lock      = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         key
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def key(self, name):
+        '''FrameCache::key: returns (realpath, size, mtime_ns) or None'''
+        try:
+            st = os.stat(name)
+        except (OSError, TypeError, ValueError):
+            return None
+        return ( os.path.realpath(name), st.st_size, st.st_mtime_ns )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         get
+    # Arguments:        key:    as returned by key()
+    #                   data:   data array is required, default=True
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get(self, key, data=True):
+        '''FrameCache::get: returns (raw_header, data) or None'''
+        with self._lock:
+            e = self._entries.get(key) if key != None else None
+            if e == None or ( data and e[1] is None ):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return tuple(e)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         put
+    # Arguments:        key:        as returned by key()
+    #                   raw_header: first 4k bytes of the image
+    #                   data:       data array (optional)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def put(self, key, raw_header, data=None):
+        '''FrameCache::put: adds an image, evicts least recently used images.
+        The data array is made read-only'''
+        if key == None: return
+        if data is not None:
+            if len(raw_header) + data.nbytes > self.maxbytes:
+                data = None
+            else:
+                data.flags.writeable = False
+        with self._lock:
+            # An image that has been changed replaces its old entry
+            old = self._paths.get(key[0])
+            if old != None and old != key: self._remove(old)
+            e = self._entries.get(key)
+            if e == None:
+                e = self._entries[key] = [ raw_header, None ]
+                self._paths[key[0]] = key
+                self.nbytes += len(raw_header)
+            if data is not None and e[1] is None:
+                e[1] = data
+                self.nbytes += data.nbytes
+            self._entries.move_to_end(key)
+            while self.nbytes > self.maxbytes and len(self._entries) > 1:
+                self._remove( next(iter(self._entries)) )
+                self.evictions += 1
+
+    def _remove(self, key):
+        raw_header, data = self._entries.pop(key)
+        del self._paths[key[0]]
+        self.nbytes -= len(raw_header) + ( 0 if data is None else data.nbytes )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         clear
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def clear(self):
+        '''FrameCache::clear: removes all images, resets the counters'''
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''FrameCache::stats: returns dict with counters and memory usage'''
+        return { 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                 'images' : len(self._entries), 'nbytes' : self.nbytes, 'maxbytes' : self.maxbytes }
+
+# Cache used by Mar345::read. Off by default, see enable_cache()
+_cache = None
+
+###########################################################################
+## Function:    enable_cache
+## Arguments:   maxbytes:  memory budget, default=1 GB
+###########################################################################
+def enable_cache(maxbytes=1<<30):
+    '''enable_cache: all images read by file name go through a FrameCache.
+    Returns the cache'''
+    global _cache
+    _cache = FrameCache(maxbytes)
+    return _cache
+
+def disable_cache():
+    '''disable_cache: images are always read from file'''
+    global _cache
+    _cache = None
+
+###########################################################################
+## Class:       Mar345Stats
+## Description: Time spent in the phases of reading and writing images and
+##              counters of images, bytes and pixels > 16 bits. An instance
+##              is called by Mar345 as stats(phase, seconds, **counts), as
+##              any other callable given as Mar345.stats
+###########################################################################
+class Mar345Stats( ):
+    phases   = ( 'open', 'read', 'header', 'decode', 'high', 'encode', 'write', 'close' )
+    counters = ( 'images_read', 'images_written', 'bytes_read', 'bytes_written',
+                 'high_read', 'high_written', 'errors' )
+
+    def __init__(self):
+        '''Mar345Stats::__init__: all times and counters are 0'''
+        self._lock  = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        '''Mar345Stats::clear: sets all times and counters to 0'''
+        with self._lock:
+            self.seconds = dict.fromkeys( self.phases, 0. )
+            self.calls   = dict.fromkeys( self.phases, 0 )
+            self.counts  = dict.fromkeys( self.counters, 0 )
+
+    def __call__(self, phase, seconds, **counts):
+        '''Mar345Stats::__call__: adds the time of a phase and counts'''
+        with self._lock:
+            self.seconds[phase] = self.seconds.get( phase, 0. ) + seconds
+            self.calls[phase]   = self.calls.get( phase, 0 ) + 1
+            for k, v in counts.items():
+                self.counts[k]  = self.counts.get( k, 0 ) + v
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''Mar345Stats::stats: returns dict with the counters and, for every
+        phase, a dict with seconds and calls'''
+        with self._lock:
+            d = { p : { 'seconds' : self.seconds[p], 'calls' : self.calls[p] } for p in self.seconds }
+            d.update( self.counts )
+        return d
+
+# Process-wide statistics of all images. Off by default, see enable_stats()
+_stats = None
+
+###########################################################################
+## Function:    enable_stats
+###########################################################################
+def enable_stats():
+    '''enable_stats: all images read and written add to one Mar345Stats.
+    Returns it'''
+    global _stats
+    _stats = Mar345Stats()
+    return _stats
+
+def disable_stats():
+    '''disable_stats: nothing is recorded for images without own stats'''
+    global _stats
+    _stats = None
+
+def stats():
+    '''stats: returns the process-wide statistics as dict, {} if disabled'''
+    return _stats.stats() if _stats != None else { }
+
+###########################################################################
+## Function:    _counts
+## Description: Pointer to a histogram (uint32 array) for the library
+###########################################################################
+def _counts(counts):
+    return ffi.cast("unsigned int *", ffi.from_buffer(counts) )
+
+###########################################################################
+## Function:    _trace
+## Description: Prints what would be recorded, used for verbose > 1
+###########################################################################
+def _trace(phase, seconds, **counts):
+    print("Mar345: {:8s} {:9.3f} ms {}".format( phase, 1e3*seconds,
+          " ".join( "{}={}".format(k, v) for k, v in counts.items() ) ))
+
+###########################################################################
+## Class:       CompactData
+## Arguments:   x, y:      dimensions
+##              data16:    16-bit pixels as stored in the pck stream
+##              idx, val:  addresses and values of the pixels > 16 bits
+###########################################################################
+class CompactData( ):
+    '''Image data as stored in a mar345 file: 16-bit pixels plus a table of
+    pixels > 16 bits. Uses half the memory of the 32-bit array, which is
+    only made on request'''
+    def __init__(self, x, y, data16, idx, val):
+        self.x      = x
+        self.y      = y
+        self.data16 = data16
+        self.idx    = idx
+        self.val    = val
+        self.size   = data16.size
+
+    def __len__(self):
+        return self.size
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.toarray()
+        return a if dtype == None else a.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.data16.nbytes + self.idx.nbytes + self.val.nbytes
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         toarray
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def toarray(self):
+        '''CompactData::toarray: returns the 32-bit image (1D)'''
+        a = self.data16.astype(np.int32)
+        a[ self.idx ] = self.val
+        return a
+
+    def _low(self):
+        # 16-bit pixels without those replaced by the table (rarely needed)
+        return np.delete( self.data16, self.idx )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Reductions on the compact data
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def sum(self):
+        '''CompactData::sum: sum of all pixels'''
+        s = int( self.data16.sum(dtype=np.int64) )
+        if self.idx.size:
+            s += int( self.val.sum(dtype=np.int64) ) - int( self.data16[self.idx].sum(dtype=np.int64) )
+        return s
+
+    def mean(self):
+        '''CompactData::mean: mean of all pixels'''
+        return self.sum() / self.size
+
+    def max(self):
+        '''CompactData::max: maximum of all pixels'''
+        m = int( self.data16.max() )
+        if self.idx.size:
+            v = int( self.val.max() )
+            if m > v and ( self.data16[self.idx] == m ).any():
+                m = int( self._low().max() ) if self.idx.size < self.size else v
+            m = max( m, v )
+        return m
+
+    def min(self):
+        '''CompactData::min: minimum of all pixels'''
+        m = int( self.data16.min() )
+        if self.idx.size:
+            v = int( self.val.min() )
+            if m < v and ( self.data16[self.idx] == m ).any():
+                m = int( self._low().min() ) if self.idx.size < self.size else v
+            m = min( m, v )
+        return m
+
+    def histogram(self, bins=10, range=None):
+        '''CompactData::histogram: as numpy.histogram of all pixels'''
+        if range == None: range = ( self.min(), self.max() )
+        h, edges = np.histogram( self.data16, bins, range )
+        if self.idx.size:
+            h -= np.histogram( self.data16[self.idx], edges )[0]
+            h += np.histogram( self.val, edges )[0]
+        return h, edges
+
+###########################################################################
+## Class:       ImageStats
+## Arguments:   counts:    histogram of the pixels (65536 bins) as filled
+##                         by the library, pixels > 16 bits in the last bin
+##              high:      values of the pixels > 16 bits
+###########################################################################
+class ImageStats( ):
+    '''Intensity statistics of an image, made from the histogram that is
+    filled while the image is decoded or encoded, not in passes of their
+    own over the pixels. Pixels that are 0 (outside the scanned area) are
+    left out of min, max, mean and sigma'''
+    def __init__(self, counts, high=None):
+        high        = np.zeros( 0, dtype=np.int64 ) if high is None else np.asarray( high, dtype=np.int64 )
+        high        = high[ high > 65535 ]
+        self.hist   = counts.astype(np.int64)   # Pixels > 16 bits not included
+        self.hist[65535] -= high.size
+        self.values = high
+        self.high   = high.size
+        self.zero   = int( self.hist[0] )
+        self.pixels = int( self.hist.sum() ) + self.high
+        n           = self.pixels - self.zero
+        v           = np.arange( 65536, dtype=np.float64 )
+        h           = self.hist.copy()
+        h[0]        = 0
+        nz          = np.flatnonzero( h )
+        self.min    = int( nz[0] ) if nz.size else int( high.min() ) if high.size else 0
+        self.max    = int( high.max() ) if high.size else int( nz[-1] ) if nz.size else 0
+        self.mean   = ( float( v @ h ) + float( high.sum() ) ) / n if n else 0.
+        self.sigma  = math.sqrt( ( float( ( v - self.mean )**2 @ h ) + float( ( ( high - self.mean )**2 ).sum() ) ) / n ) if n else 0.
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''ImageStats::stats: returns dict with number of pixels, of pixels
+        that are 0 and > 16 bits, min, max, mean and sigma'''
+        return { 'pixels' : self.pixels, 'zero' : self.zero, 'high' : self.high,
+                 'min' : self.min, 'max' : self.max, 'mean' : self.mean, 'sigma' : self.sigma }
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         header
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def header(self):
+        '''ImageStats::header: returns the fields of the INTENSITY and
+        HISTOGRAM lines of the header. The histogram runs from the 1st to
+        the 99th percentile of the pixels > 0, its maximum is the most
+        frequent value > 0'''
+        n = self.pixels - self.zero
+        if n == 0:
+            beg = end = top = 0
+        else:
+            c   = np.cumsum( self.hist[1:] )
+            beg = min( int( np.searchsorted( c, .01 * n ) ) + 1, 65535 )
+            end = min( int( np.searchsorted( c, .99 * n ) ) + 1, 65535 )
+            top = int( np.argmax( self.hist[1:] ) ) + 1
+        return { 'valmin' : self.min, 'valmax' : self.max, 'valavg' : self.mean, 'valsig' : self.sigma,
+                 'histbeg' : beg, 'histend' : end, 'histmax' : top }
+
+###########################################################################
+## Class:       BufferPool
+## Arguments:   size:      number of free arrays kept per image size
+###########################################################################
+class BufferPool( ):
+    '''Pool of int32 arrays for reading image after image without new
+    allocations: give the pool as out= to Mar345.read; Mar345.release
+    puts the array back into the pool'''
+    def __init__(self, size=4):
+        self.size   = size
+        self._free  = { }               # Number of pixels: list of arrays
+        self._lock  = threading.Lock()
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         get
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get(self, n):
+        '''BufferPool::get: returns an int32 array with n elements'''
+        with self._lock:
+            free = self._free.get(n)
+            if free: return free.pop()
+        return np.empty( n, dtype=np.int32 )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         put
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def put(self, a):
+        '''BufferPool::put: gives an array back. It must not be used any more'''
+        with self._lock:
+            free = self._free.setdefault( a.size, [ ] )
+            if len(free) < self.size: free.append( a if a.ndim == 1 else a.reshape(-1) )
+
+###########################################################################
+## Class:       PckIndex
+## Arguments:   x, y:      image size
+##              step:      number of rows between positions
+##              seek:      positions in the pck stream (PckIndex.dtype)
+##              hist:      x+1 pixels (int16) before each position
+##              stat:      (size, mtime_ns) of the image file
+###########################################################################
+class PckIndex( ):
+    '''Positions of every step-th row in the pck stream of an image with the
+    pixels needed for the predictions there. Bands of rows are decoded
+    independently from them, e.g. in parallel threads, or without decoding
+    the rows before. Kept next to the image in name + PckIndex.suffix, the
+    image itself is not changed'''
+    dtype   = np.dtype( [ ('bit', np.int64), ('pixnum', np.int32), ('bitnum', np.int32) ] )
+    suffix  = '.pckidx'
+
+    def __init__(self, x, y, step, seek, hist, stat=None):
+        self.x      = x
+        self.y      = y
+        self.step   = step
+        self.seek   = seek
+        self.hist   = hist
+        self.stat   = stat
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         build
+    # Arguments:        buf: complete image, data: its decoded pixels,
+    #                   step: rows between positions
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    @classmethod
+    def build(cls, buf, x, y, data, step=128):
+        '''PckIndex::build: returns the index of an image or None'''
+        n    = -( -y // step )
+        seek = np.zeros( n, dtype=cls.dtype )
+        if lib.Getmar345Seek( ffi.from_buffer("unsigned char[]", buf), len(buf), x, y, step,
+                              ffi.cast("PCKSEEK *", ffi.from_buffer(seek)) ) != n:
+            return None
+        # The predictor works on the 16-bit pixels as stored in the stream
+        w    = np.clip( np.asarray(data).reshape(-1), 0, 65535 ).astype(np.uint16).view(np.int16)
+        hist = np.zeros( (n, x+1), dtype=np.int16 )
+        for i in range( 1, n ):
+            p = i * step * x
+            a = max( p - x - 1, 0 )
+            hist[i, x+1-(p-a):] = w[a:p]
+        return cls( x, y, step, seek, hist )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         load
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    @classmethod
+    def load(cls, name):
+        '''PckIndex::load: returns the index of image name or None if there
+        is none or it does not match the image any more'''
+        try:
+            st = os.stat(name)
+            with np.load( name + cls.suffix, allow_pickle=False ) as z:
+                x, y, step, size, mtime = [ int(v) for v in z['meta'] ]
+                seek, hist = z['seek'], z['hist']
+        except Exception:
+            return None
+        if ( size, mtime ) != ( st.st_size, st.st_mtime_ns ): return None
+        if seek.dtype != cls.dtype or len(seek) != -( -y // step ) or hist.shape != ( len(seek), x+1 ) or hist.dtype != np.int16:
+            return None
+        return cls( x, y, step, seek, hist, (size, mtime) )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         save
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def save(self, name):
+        '''PckIndex::save: writes the index of image name (as it is now)'''
+        st = os.stat(name)
+        self.stat = ( st.st_size, st.st_mtime_ns )
+        meta = np.array( [ self.x, self.y, self.step, st.st_size, st.st_mtime_ns ], dtype=np.int64 )
+        tmp  = name + self.suffix + '.tmp'
+        with open( tmp, 'wb' ) as fp:
+            np.savez( fp, meta=meta, seek=self.seek, hist=self.hist )
+        os.replace( tmp, name + self.suffix )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         decode
+    # Arguments:        buf: complete image, a, b: rows a...b-1,
+    #                   out: int32 array for (b-a)*x pixels,
+    #                   workers: number of threads, None: number of CPUs
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def decode(self, buf, a, b, out, workers=1):
+        '''PckIndex::decode: decodes rows a...b-1 band by band, starting at
+        the position before a. Returns the number of pixels decoded, 0 if
+        the index or out do not fit the image'''
+        if not 0 <= a < b <= self.y or out.size < ( b - a ) * self.x: return 0
+        if len(self.seek) != -( -self.y // self.step ) or self.hist.shape != ( len(self.seek), self.x+1 ) or self.hist.dtype != np.int16:
+            return 0
+        pck  = ffi.from_buffer("unsigned char[]", buf)
+        seek = ffi.cast("PCKSEEK *", ffi.from_buffer(self.seek))
+        img  = out.reshape(-1)
+        def _band(i):
+            r      = i * self.step
+            r0, r1 = max( a, r ), min( b, r + self.step )
+            return lib.Getmar345RowsFromSeek( pck, len(buf), self.x, self.y, seek + i, r, ffi.cast("short *", ffi.from_buffer(self.hist[i])),
+                                              r0, r1 - r0, ffi.cast("int *", ffi.from_buffer(img[ (r0-a)*self.x : ]) ) )
+        bands = range( a // self.step, ( b - 1 ) // self.step + 1 )
+        if workers == None: workers = os.cpu_count() or 1
+        if workers > 1 and len(bands) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(bands))) as pool:
+                return sum( pool.map( _band, bands ) )
+        return sum( map( _band, bands ) )
+
+# Header lines that change from image to image: format and h345 fields.
+# Used by makeheader and HeaderTemplate
+h345_format = {
+	'DATE'		:	( 'DATE           {}',					('date',) ),
+	'HIGH'		:	( 'HIGH           {}',					('high',) ),
+	'WAVELENGTH'	:	( 'WAVELENGTH     {:.6f}',				('wavelength',) ),
+	'DISTANCE'	:	( 'DISTANCE       {:.3f}',				('distance',) ),
+	'PHI'		:	( 'PHI            START {:.3f} END {:.3f}  OSC {}',	('phibeg', 'phiend', 'phiosc') ),
+	'OMEGA'		:	( 'OMEGA          START {:.3f} END {:.3f}  OSC {}',	('omebeg', 'omeend', 'omeosc') ),
+	'CHI'		:	( 'CHI            {:.3f}',				('chi',) ),
+	'TWOTHETA'	:	( 'TWOTHETA       {:.3f}',				('theta',) ),
+	'INTENSITY'	:	( 'INTENSITY      MIN {} MAX {} AVE {:.1f} SIG {:.1f}',	('valmin', 'valmax', 'valavg', 'valsig') ),
+	'HISTOGRAM'	:	( 'HISTOGRAM      START {} END {} MAX {}',		('histbeg', 'histend', 'histmax') ),
+}
+
+# Integers in the first 128 bytes of the header and their h345 fields
+# with scale factors
+h345_int = {
+	'high'		:	( 2,	1 ),
+	'wavelength'	:	( 8,	1000000 ),
+	'distance'	:	( 9,	1000 ),
+	'phibeg'	:	( 10,	1000 ),
+	'phiend'	:	( 11,	1000 ),
+	'omebeg'	:	( 12,	1000 ),
+	'omeend'	:	( 13,	1000 ),
+	'chi'		:	( 14,	1000 ),
+	'theta'		:	( 15,	1000 ),
+}
+
+###########################################################################
+## Class:       HeaderTemplate
+## Arguments:   h:         h345 dict, default: h345 defaults
+###########################################################################
+class HeaderTemplate( ):
+    '''4k header made once from a h345 dict. For each image, only the
+    fields that change are patched, e.g.
+        tpl = HeaderTemplate(img.header)
+        hdr = tpl.header(phibeg=10., phiend=11.)'''
+    def __init__(self, h=None):
+        h           = _newheader() if h == None else { k : list(v) if isinstance(v, list) else v for k, v in h.items() }
+        self.buf    = bytearray( Mar345().makeheader(h) )
+        self.h      = h
+        self.lines  = { }               # Keyword: offset of its line
+        for pos in range( 192, 4096, 64 ):
+            key = bytes( self.buf[pos:pos+15] ).split()
+            if key and key[0] == b'END': break
+            if key: self.lines.setdefault( key[0].decode('ascii', 'ignore'), pos )
+        # Which lines to patch for a given field
+        self.fields = { f : key for key, (fmt, fields) in h345_format.items() if key in self.lines for f in fields }
+        self.order  = 'little' if int.from_bytes( self.buf[0:4], 'little' ) == 1234 else 'big'
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         header
+    # Arguments:        fields of h345_format, e.g. phibeg=..., phiend=...
+    #                   date: default: now
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def header(self, **kw):
+        '''HeaderTemplate::header: patches the given fields and the date,
+        returns the 4k header as bytes'''
+        if not 'date' in kw: kw['date'] = datetime.datetime.utcnow().ctime()
+        keys = set()
+        for f, v in kw.items():
+            if not f in self.fields:
+                raise KeyError("HeaderTemplate: cannot patch field '{}'".format(f))
+            self.h[f] = v
+            keys.add( self.fields[f] )
+            if f in h345_int:
+                i, scale = h345_int[f]
+                self.buf[4*i:4*i+4] = int( v * scale ).to_bytes( 4, self.order, signed=True )
+        for key in keys:
+            fmt, fields = h345_format[key]
+            line = fmt.format( *[ self.h[f] for f in fields ] )[:63]
+            pos  = self.lines[key]
+            self.buf[pos:pos+64] = ( line.ljust(63) + '\n' ).encode()
+        return bytes( self.buf )
+
 h345_keywords = ['PROGRAM', 'DATE', 'SCANNER', 'FORMAT', 'HIGH',
 		 'PIXEL', 'OFFSET', 'GAPS', 'ADC', 'MULTIPLIER',
 		 'GAIN', 'WAVELENGTH', 'DISTANCE', 'RESOLUTION',
@@ -161,21 +727,90 @@ h345_line  = {
 	( 'COUNTS', 'NMEAS' )	: 0
 }
 
+# Parser for header lines: (keyword, subkeyword) -> (conversion, field, ...)
+# Without subkeyword, the value is the first token after the keyword or,
+# for str, the rest of the line. With subkeyword, the value is the token
+# following the subkeyword. Conversion None: the subkeyword is the value.
+# A field (name, i) sets element i of a list in the header.
+h345_parse = {
+	( 'PROGRAM', '' )	: ( str,	'program' ),
+	( 'DATE', '' )		: ( str,	'date' ),
+	( 'DETECTOR', '' )	: ( str,	'detector' ),
+	( 'GENERATOR', '' )	: ( str,	'source' ),
+	( 'SCANNER', '' )	: ( int,	'serial' ),
+	( 'FORMAT', '' )	: ( int,	'x', 'y' ),
+	( 'FORMAT', 'PCK' )	: ( int,	'pixels' ),
+	( 'HIGH', '' )		: ( int,	'high' ),
+	( 'DISTANCE', '' )	: ( float,	'distance' ),
+	( 'WAVELENGTH', '' )	: ( float,	'wavelength' ),
+	( 'CHI', '' )		: ( float,	'chi' ),
+	( 'TIME', '' )		: ( float,	'time' ),
+	( 'GAIN', '' )		: ( float,	'gain' ),
+	( 'MULTIPLIER', '' )	: ( float,	'multiplier' ),
+	( 'OFFSET', 'ROFF' )	: ( float,	'roff' ),
+	( 'OFFSET', 'TOFF' )	: ( float,	'toff' ),
+	( 'MODE', 'TIME' )	: ( None,	'type' ),
+	( 'MODE', 'DOSE' )	: ( None,	'type' ),
+	( 'ADC', 'A' )		: ( int,	('adc', 0) ),
+	( 'ADC', 'B' )		: ( int,	('adc', 1) ),
+	( 'ADC', 'ADD_A' )	: ( int,	('adc_add', 0) ),
+	( 'ADC', 'ADD_B' )	: ( int,	('adc_add', 1) ),
+	( 'CENTER', 'X' )	: ( float,	('center', 0) ),
+	( 'CENTER', 'Y' )	: ( float,	('center', 1) ),
+	( 'PIXEL', 'LENGTH' )	: ( int,	('pixelsize', 0) ),
+	( 'PIXEL', 'HEIGHT' )	: ( int,	('pixelsize', 1) ),
+	( 'PHI', 'START' )	: ( float,	'phibeg' ),
+	( 'PHI', 'END' )	: ( float,	'phiend' ),
+	( 'PHI', 'OSC' )	: ( int,	'phiosc' ),
+	( 'OMEGA', 'START' )	: ( float,	'omebeg' ),
+	( 'OMEGA', 'END' )	: ( float,	'omeend' ),
+	( 'OMEGA', 'OSC' )	: ( int,	'omeosc' ),
+	( 'HISTOGRAM', 'START')	: ( int,	'histbeg' ),
+	( 'HISTOGRAM', 'END' )	: ( int,	'histend' ),
+	( 'HISTOGRAM', 'MAX' )	: ( int,	'histmax' ),
+	( 'INTENSITY', 'MIN' )	: ( int,	'valmin' ),
+	( 'INTENSITY', 'MAX' )	: ( int,	'valmax' ),
+	( 'INTENSITY', 'AVE' )	: ( float,	'valavg' ),
+	( 'INTENSITY', 'SIG' )	: ( float,	'valsig' ),
+	( 'COUNTS', 'START' )	: ( float,	'dosebeg' ),
+	( 'COUNTS', 'END' )	: ( float,	'doseend' ),
+	( 'COUNTS', 'MIN' )	: ( float,	'dosemin' ),
+	( 'COUNTS', 'MAX' )	: ( float,	'dosemax' ),
+	( 'COUNTS', 'AVE' )	: ( float,	'doseavg' ),
+	( 'COUNTS', 'SIG' )	: ( float,	'dosesig' ),
+	( 'COUNTS', 'NMEAS' )	: ( int,	'dose_n' ),
+}
+
 ###########################################################################
 ## Class:       Mar345
 ## Arguments:   name:      filename
 ##              data:      image array for image output
 ##              header:    4k image header for image output
 ##              verbose:   default=0
+##              lazy:      parse only the header, decode data on first access
 ###########################################################################
 class Mar345( ):
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:         __init__
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def __init__(self, name=None, data=None, header=None, verbose=0):
+    def __init__(self, name=None, data=None, header=None, verbose=0, lazy=False, stats=None):
         '''Mar345::__init__: initialize class'''
         self.__name__   = 'mar345'
         self.verbose    = verbose
+        self.stats      = stats     # Mar345Stats or f(phase, seconds, **counts)
+        self.lazy       = lazy
+        self._data      = None
+        self._pending   = False     # Data not decoded yet (lazy mode)
+        self._buffer    = None      # Image in memory for lazy decoding
+        self._key       = None      # Key of the image in the FrameCache
+        self.rows       = None      # (first, last+1) rows in data, None: all
+        self.compact    = None      # CompactData in compact mode
+        self._out       = None      # Output array or BufferPool for data
+        self._pool      = None      # BufferPool data has been taken from
+        self._index     = None      # PckIndex of the image being decoded
+        self.workers    = 1         # Threads for decoding with a PckIndex
+        self.imagestats = None      # ImageStats if asked for (imagestats=True)
+        self._counting  = False     # Make imagestats while decoding
         self.x		    = 1
         self.y		    = 1
         self.pixels	    = 0
@@ -183,16 +818,71 @@ class Mar345( ):
         self.filename   = name
         self.success    = False
         self.data       = None
-        self.header     = h345      # Fill header with defaults
+        self.header     = _newheader()   # Fill header with defaults
         self.raw_header = None
         self.bpp        = 2
-        if self.verbose > 1: print("Mar345::__init__: ")
         # Has a file name been given?
         if name != None:
             if isinstance(data, np.ndarray):    # Datar given: write image
-                self.write( name, data, h345 if header == None else header)
+                self.write( name, data, self.header if header == None else header)
             else:                               # No data given: read image
-                self.read(name)
+                self.read(name, lazy=lazy)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _clock
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _clock(self):
+        '''Mar345::_clock: start time of a phase, None if nothing is recorded'''
+        if self.stats is None and _stats is None and self.verbose < 2: return None
+        return time.perf_counter()
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _record
+    # Arguments:        phase: name of the phase, t: start time from _clock,
+    #                   seconds: duration of the phase if it is not the
+    #                   time since t (optional), counts: counters to add
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _record(self, phase, t, seconds=None, **counts):
+        '''Mar345::_record: gives the time since t (or seconds) and the counts
+        to the stats of the image and to the process-wide stats'''
+        if t is None: return
+        t = time.perf_counter() - t if seconds == None else seconds
+        f = self.stats if self.stats is not None else _trace if self.verbose > 1 else None
+        if f is not None: f( phase, t, **counts )
+        if _stats is not None and _stats is not f: _stats( phase, t, **counts )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         data
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    @property
+    def data(self):
+        '''Mar345::data: image array. In lazy mode, decoded on first access.
+        In compact mode, made from the compact data on first access'''
+        if self._pending:
+            self._pending = False
+            self._getdata( self._buffer )
+        elif self._data is None and self.compact != None:
+            self._data = self.compact.toarray()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data      = value
+        self._pending   = False
+        self.compact    = None
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         release
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def release(self):
+        '''Mar345::release: frees the image array. In lazy mode, it is 
+        decoded again on the next access. An array from a BufferPool goes
+        back into the pool'''
+        if self._pool != None and self._data is not None:
+            self._pool.put( self._data )
+        self._pool      = None
+        self._data      = None
+        self._pending   = self.lazy and self.success
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:         string64
@@ -207,12 +897,12 @@ class Mar345( ):
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     def makeheader(self, h=None):
         '''Mar345::_makeheader: returns a 4k header string'''
-        # Optional argument is a h345 dictionary
-        if h == None: h = h345
+        # Optional argument is a h345 dictionary, default is my own header
+        if h == None: h = self.header if self.header != None else _newheader()
 
         # Check contents of dictionary, use defaults for missing stuff
-        if not 'x' in h:                h['x'] = self.x
-        if not 'pixels' in h:           h['pixels'] = self.x*self.y
+        if not h.get('x'):              h['x'] = self.x
+        if not h.get('pixels'):         h['pixels'] = self.x*self.y
         if not 'high' in h:             h['high'] = 0
         if not 'pixelsize' in h:        h['pixelsize'] = [ 0.15, 0.15 ]
         if not 'wavelength' in h:       h['wavelength'] = 1.5417890
@@ -290,7 +980,7 @@ class Mar345( ):
         s.append(self.string64("DATE           {}".format( datetime.datetime.utcnow().ctime()) ))
         s.append(self.string64("FORMAT         {}  PCK {}".format(h['x'],h['pixels'])))
         s.append(self.string64("SCANNER        000") )
-        s.append(self.string64("HIGH           {}".format(h['high']) ))
+        s.append(self.string64(h345_format['HIGH'][0].format(h['high']) ))
         s.append(self.string64('PIXEL          LENGTH {:.0f} HEIGHT {:.0f}'.format(h['pixelsize'][0]*1000.,h['pixelsize'][1]*1000.)))
         s.append(self.string64('OFFSET         ROFF {} TOFF {}'.format(h['roff'],h['toff'])))
         s.append(self.string64('GAPS           {}'.format(re.sub( '[,\[\]]','',str(h['gaps'])))))
@@ -298,20 +988,20 @@ class Mar345( ):
         s.append(self.string64('MULTIPLIER     {:.3f}'.format(h['multiplier'])))
 
         s.append(self.string64('GAIN           {:.3f}'.format(h['gain'])))
-        s.append(self.string64('WAVELENGTH     {:.6f}'.format(h['wavelength'])))
-        s.append(self.string64('DISTANCE       {:.3f}'.format(h['distance'])))
+        s.append(self.string64(h345_format['WAVELENGTH'][0].format(h['wavelength'])))
+        s.append(self.string64(h345_format['DISTANCE'][0].format(h['distance'])))
         s.append(self.string64('RESOLUTION     {:.3f}'.format(h['resolution'])))
-        s.append(self.string64('PHI            START {:.3f} END {:.3f}  OSC {}'.format(h['phibeg'],h['phiend'],h['phiosc'])))
-        s.append(self.string64('OMEGA          START {:.3f} END {:.3f}  OSC {}'.format(h['omebeg'],h['omeend'],h['omeosc'])))
-        s.append(self.string64('CHI            {:.3f}'.format(h['chi'])))
-        s.append(self.string64('TWOTHETA       {:.3f}'.format(h['theta'])))
+        s.append(self.string64(h345_format['PHI'][0].format(h['phibeg'],h['phiend'],h['phiosc'])))
+        s.append(self.string64(h345_format['OMEGA'][0].format(h['omebeg'],h['omeend'],h['omeosc'])))
+        s.append(self.string64(h345_format['CHI'][0].format(h['chi'])))
+        s.append(self.string64(h345_format['TWOTHETA'][0].format(h['theta'])))
         s.append(self.string64('CENTER         X {:.3f} Y {:.3f}'.format(h['center'][0],h['center'][1])))
         s.append(self.string64('MODE           TIME'))
         s.append(self.string64('COUNTS         START {:.1f} END {:.1f} NMEAS {}'.format(h['dosebeg'],h['doseend'],h['dose_n'])))
         s.append(self.string64('COUNTS         MIN {} MAX {}'.format(h['dosemin'],h['dosemax'])))
         s.append(self.string64('COUNTS         AVE {:.1f} SIG {:.1f}'.format(h['doseavg'],h['dosesig'])))
-        s.append(self.string64('INTENSITY      MIN {} MAX {} AVE {:.1f} SIG {:.1f}'.format(h['valmin'],h['valmax'],h['valavg'],h['valsig'])))
-        s.append(self.string64('HISTOGRAM      START {} END {} MAX {}'.format(h['histbeg'],h['histend'],h['histmax'])))
+        s.append(self.string64(h345_format['INTENSITY'][0].format(h['valmin'],h['valmax'],h['valavg'],h['valsig'])))
+        s.append(self.string64(h345_format['HISTOGRAM'][0].format(h['histbeg'],h['histend'],h['histmax'])))
         s.append(self.string64('GENERATOR      {} kV {:.1f} mA {:.1f}'.format(h['source'], h['kV'],h['mA'])))
         s.append(self.string64('MONOCHROMATOR  {} POLAR {:.1f}'.format(h['filter'],h['polarization'])))
         s.append(self.string64('COLLIMATOR     WIDTH {:.1f} HEIGHT {:.1f}'.format(h['slits'][0],h['slits'][1])))
@@ -320,39 +1010,271 @@ class Mar345( ):
         s.append(self.string64('END OF HEADER\n'))
 
         # Put all items in list into one string with lenght 4k
-        s = ''.join(s)
-        while len(s) < 4096-128: s=s+" "
+        s = ''.join(s).ljust(4096-128)
 
         # s.append( bytes(h32) )  # First 128 bytes
         return ( bytes(h32)  + bytes(s.encode()) )
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:         write
-    # Arguments:        name (mandatory), onlyheader (optional, False|True)
+    # Arguments:        name or file-like object (mandatory),
+    #                   onlyheader (optional, False|True),
+    #                   atomic (optional, False|True): write to a temporary
+    #                   file that is renamed to name
+    #                   workers (optional): number of threads for compression
+    #                   index (optional, False|True): write a PckIndex
+    #                   imagestats (optional, False|True): see encode
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def write(self, name, data=None, header=None, onlyheader=False):
+    def write(self, name, data=None, header=None, onlyheader=False, atomic=False, workers=1, index=False, imagestats=False):
         '''Mar345::write: writes an image in mar345 format '''
         # Optional argument header can be a 4k string or a h345 dictionary
-        self.filename   = name
+        self.filename   = getattr(name, 'name', None) if hasattr(name, 'write') else name
         self.success    = False
+
+        # Complete image in memory, written in one go
+        buf = self.encode( data, header, onlyheader, workers, imagestats )
+        if buf == None: return self
+        if not self._output_image( name, buf, atomic ):
+            return self
+        elif index and not onlyheader:
+            self._saveindex( name, buf, self.data if data is None else data )
+        self.success = True
+        return self.success
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         encode
+    # Arguments:        data: 32-bit image (optional), default: self.data
+    #                   header: None, h345 dict or 4k header as bytes
+    #                   onlyheader (optional, False|True)
+    #                   workers: number of threads for compression, 
+    #                   None: number of CPUs
+    #                   imagestats (optional, False|True): make imagestats
+    #                   while compressing and put them into the header
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def encode(self, data=None, header=None, onlyheader=False, workers=1, imagestats=False):
+        '''Mar345::encode: returns the complete image in mar345 format as
+        bytes or None if the header is not valid'''
+        if data is None and not onlyheader: data = self.data
         if isinstance( data, np.ndarray):
-            self.pixels	    = data.shape[0]
+            self.pixels	    = data.size
             # Watch out: for mar345 images x may be != y (e.g.Dectris detectors)
-            if self.x == 1:
+            if self.x == 1 and data.ndim == 2:
+                self.y, self.x  = data.shape
+            elif self.x == 1:
                 self.x		    = int(math.sqrt( self.pixels ))
                 self.y		    = self.x
-        if self.verbose > 1: print("Mar345::write: {} header={}".format(self.filename,onlyheader))
-        fp = self.open( name=name, doread=False)
-        if fp == None: return self
 
-        # Open has been successful, so get image header
+        t = self._clock()
+        header = self._header4k( header )
+        self._record( 'header', t )
+        if header == None or onlyheader: return header
+
+        # Pixels > 16 bits are split off while the image is compressed, all
+        # in one pass in the library. So the header gets the right number of
+        # high intensity pixels from the start
+        t = self._clock()
+        counts = np.zeros( 65536, dtype=np.uint32 ) if imagestats else None
+        k = self._pack( data, workers, counts )
+        self._record( 'encode', t )
+        if counts is not None: header = self._imagestats( header, k, counts )
+        return self._image( header, k )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         tobytes
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def tobytes(self):
+        '''Mar345::tobytes: returns data and header in mar345 format as bytes'''
+        return self.encode()
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _image
+    # Arguments:    header: 4k header, k: encoder with the complete image
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _image(self, header, k):
+        '''Mar345::_image: returns header, high intensity records and pck
+        stream as bytes'''
+        t    = self._clock()
+        high = self._high( k, header )
+        self._record( 'high', t, high_written=len(high) // 8 )
+        n    = ffi.new("size_t *")
+        pck  = lib.Putmar345RowsData( k, n )
+        return b''.join( ( self._patchhigh( header, len(high) // 8 ), high, ffi.buffer( pck, n[0] ) ) )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _output_image
+    # Arguments:    name: file name or file-like object, buf: complete image,
+    #               atomic: see _writefile
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _output_image(self, name, buf, atomic=False):
+        '''Mar345::_output_image: writes buf to name, returns True if ok'''
+        t = self._clock()
+        if hasattr(name, 'write'):      # File-like object, e.g. io.BytesIO
+            name.write( buf )
+        elif not self._writefile( name, buf, atomic ):
+            self._record( 'write', t, errors=1 )
+            return False
+        self._record( 'write', t, images_written=1, bytes_written=len(buf) )
+        return True
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _writefile
+    # Arguments:    name: file name, buf: complete image,
+    #               atomic: write to temporary file and rename
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _writefile(self, name, buf, atomic=False):
+        '''Mar345::_writefile: writes buf to file name in one go'''
+        if not atomic:
+            fp = self.open( name=name, doread=False)
+            if fp == None: return False
+            with fp: fp.write( buf )
+            return True
+
+        # Readers of name see either the old or the complete new image.
+        # An image that is replaced keeps its mode, a new one gets the mode
+        # of files made with open (0o666 and the umask)
+        tmp = None
+        try:
+            try:
+                mode = os.stat( name ).st_mode & 0o7777
+            except OSError:
+                mode = None
+            tmp = os.path.join( os.path.dirname(os.path.abspath(name)),
+                                '.{}.{}'.format( os.path.basename(name), os.urandom(6).hex() ) )
+            fd  = os.open( tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666 )
+            with os.fdopen( fd, 'wb' ) as fp:
+                fp.write( buf )
+            if mode != None: os.chmod( tmp, mode )
+            os.replace( tmp, name )
+            return True
+        except OSError as e:
+            print("ERROR (Mar345::write): Cannot write '{}': {}".format(name, e))
+            if tmp != None and os.path.exists(tmp): os.remove(tmp)
+            return False
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _pack
+    # Arguments:    data: 32-bit image, 1D or 2D
+    #               workers: number of threads, None: number of CPUs
+    #               counts: histogram to add the pixels to (optional)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _pack(self, data, workers=1, counts=None):
+        '''Mar345::_pack: compresses an image in the library, returns the
+        encoder with pck stream and pixels > 16 bits'''
+        # int32 arrays go to the library as they are, others are converted
+        if data.dtype != np.int32:
+            data = np.clip( data, 0, np.iinfo(np.int32).max ).astype(np.int32)
+        data = np.ascontiguousarray( data )
+        if data.size != self.x * self.y:
+            raise ValueError("Mar345: image has {} pixels, not {}x{}".format(data.size, self.x, self.y))
+        k = lib.Putmar345RowsOpen( self.x, self.y )
+        if k == ffi.NULL: raise MemoryError("Mar345: Cannot compress {}x{} image".format(self.x, self.y))
+        k = ffi.gc( k, lib.Putmar345RowsClose )
+        img = ffi.cast("int *", ffi.from_buffer(data) )
+
+        # Parts of whole blocks of differences are compressed independently
+        # in threads and joined in order. The stream is the same as in one go
+        if workers == None: workers = os.cpu_count() or 1
+        nblock = -( -data.size // lib.PCKBLOCK )
+        nparts = min( workers, nblock )
+        if nparts > 1:
+            first = [ ( i * nblock // nparts ) * lib.PCKBLOCK for i in range(nparts) ] + [ data.size ]
+            pc    = [ np.zeros_like( counts ) for i in range(nparts) ] if counts is not None else None
+            def _part(i):
+                p = lib.Putmar345PartOpen( self.x, self.y, first[i] )
+                if p == ffi.NULL: return None
+                p = ffi.gc( p, lib.Putmar345RowsClose )
+                if pc != None: lib.Putmar345RowsCount( p, _counts( pc[i] ) )
+                return p if lib.Putmar345Part( p, first[i+1]-first[i], img ) == first[i+1]-first[i] else None
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nparts) as pool:
+                parts = list( pool.map( _part, range(nparts) ) )
+            for i, p in enumerate(parts):
+                if p is None or lib.Putmar345RowsJoin( k, p ) != first[i+1]-first[i]:
+                    raise MemoryError("Mar345: Cannot compress {}x{} image".format(self.x, self.y))
+            if pc != None: np.sum( pc, axis=0, out=counts )
+            return k
+
+        if counts is not None: lib.Putmar345RowsCount( k, _counts( counts ) )
+        if lib.Putmar345Rows( k, self.y, img ) != data.size:
+            raise MemoryError("Mar345: Cannot compress {}x{} image".format(self.x, self.y))
+        return k
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _high
+    # Arguments:    k: encoder, header: 4k header
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _high(self, k, header):
+        '''Mar345::_high: returns the high intensity records of encoder k in
+        the byte order of the header'''
+        n = ffi.new("int *")
+        p = lib.Putmar345RowsHigh( k, n )
+        h = n[0]
+        if self.header != None:
+            if 'high' in self.header: self.header['high'] = h
+        if h == 0: return b''
+        h32 = np.frombuffer( ffi.buffer( p, 8 * h ), dtype=np.int32 )
+        if ( int.from_bytes( header[0:4], sys.byteorder ) == 1234 ) == False:
+            h32 = h32.byteswap()
+        return h32.tobytes()
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _imagestats
+    # Arguments:    header: 4k header, k: encoder, counts: its histogram
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _imagestats(self, header, k, counts):
+        '''Mar345::_imagestats: makes imagestats of the image in encoder k,
+        returns header with them'''
+        n = ffi.new("int *")
+        p = lib.Putmar345RowsHigh( k, n )
+        high = np.frombuffer( ffi.buffer( p, 8 * n[0] ), dtype=np.int32 )[1::2] if n[0] else None
+        self.imagestats = ImageStats( counts, high )
+        h = self.imagestats.header()
+        if isinstance(self.header, dict): self.header.update( h )
+        return self._patchstats( header, h )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _patchstats
+    # Arguments:    header: 4k header, h: dict with fields of INTENSITY and
+    #               HISTOGRAM
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _patchstats(self, header, h):
+        '''Mar345::_patchstats: returns header with INTENSITY and HISTOGRAM
+        lines made from h'''
+        header = bytearray( header )
+        for pos in range( 192, 4096, 64 ):
+            key = bytes( header[pos:pos+15] ).split()
+            if key and key[0] == b'END': break
+            if key and key[0] in ( b'INTENSITY', b'HISTOGRAM' ):
+                fmt, fields = h345_format[ key[0].decode() ]
+                line = fmt.format( *[ h[f] for f in fields ] )[:63]
+                header[pos:pos+64] = ( line.ljust(63) + '\n' ).encode()
+        return header
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _patchhigh
+    # Arguments:    header: 4k header, h: number of high intensity pixels
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _patchhigh(self, header, h):
+        '''Mar345::_patchhigh: returns header with h high intensity pixels'''
+        header = bytearray( header )
+        b = 'little' if int.from_bytes( header[0:4], 'little' ) == 1234 else 'big'
+        header[8:12] = h.to_bytes( 4, b )
+        if header[448:452] == b'HIGH':  # Entry "HIGH" starts at byte 448 of header
+            header[448:495] = 'HIGH           {:32s}'.format(str(h)).encode()
+        return header
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _header4k
+    # Arguments:    header: None, h345 dict or 4k header as bytes
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _header4k(self, header):
+        '''Mar345::_header4k: returns the 4k header to write or None'''
         if header == None:              # Makes image header out of thin air
             header = self.makeheader()
         elif isinstance(header, dict):  # Uses a given h345 dict
             header = self.makeheader(header)
         elif isinstance(header, str):   # Uses a full 4k header string
             print ("ERROR (Mar345::write:): header must be bytes not string")
-            return self
+            return None
         elif isinstance(header, bytes): # Uses a full 4k header string
             # Get byteorder, nx and pixels from header, don't rely on sqrt
             b = int.from_bytes( header[ 0: 4], 'little')
@@ -363,78 +1285,136 @@ class Mar345( ):
             self.x = int.from_bytes( header[ 4: 8], b)
             self.pixels = int.from_bytes( header[20:24], b)
             self.y = int(self.pixels/self.x)
-        ##################
-        fp.write( header )
-        ##################
-        if onlyheader:
-            fp.close()
-            return self
-
-        # Write high intensity records if some pixels are > 16 bits
-        data = self.writehigh( fp, header, data.flatten() )
-
-        # Close open file before going into library
-        if fp != None: fp.close()
-
-        # Write compressed data array
-        self.writedata( data.flatten() )
-        return self.success
+        return header
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:     writehigh
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     def writehigh(self,fp,header,data):
-        '''Mar345::writehigh: writes mar345 high intensity pixels '''
-        if data.max() < 65536 or fp == None: return data
-        i = 0
-        h = 0
-        fp.seek( 4096 )
-        h32=np.zeros(2, dtype=np.uint32)
-        for n in data:
-            if n > 65535:
-                h32[0] = i
-                h32[1] = np.uint32(n)
-                fp.write( h32 )
-                data[i] = 65535
-                h+=1
-                # print("qqq {:5d} @ {:-8d} {:6d} -> {}".format(h,i,int(n), int(data[i])))
-            i+=1
-        pos = fp.tell()
+        '''Mar345::writehigh: writes mar345 high intensity pixels to fp,
+        which holds the 4k header. Returns data with the pixels > 16 bits
+        set to 65535. Deprecated: write and encode do it all in one go'''
+        warnings.warn("Mar345::writehigh is deprecated, use write or encode", DeprecationWarning, stacklevel=2)
+        if fp == None: return data
+        high = self._high( self._pack( data ), header )
+        h = len(high) // 8
+        if h == 0: return data
 
         if self.verbose > 1: print("Mar345::writehigh: {} > 16-bits".format(h))
+        fp.seek( 4096 )
+        fp.write( high )
+        pos = fp.tell()
 
-        if self.header != None:
-            if 'high' in self.header: self.header['high'] = h
-
-
-        # Update the number of high intensity pixels in header:
+        # Update the number of high intensity pixels in header
+        header = self._patchhigh( header, h )
         fp.seek( 8 )
-        h32=np.zeros(1, dtype=np.uint32)
-        h32[0] = h
-        fp.write(h32)
-
-        try:
-            fp.seek( 448 )      # Entry "HIGH" starts at byte 448 of header
-            s = 'HIGH           {:32s}'.format(str(h))
-            fp.write(s.encode())
-        except:
-            pass
-        fp.seek(pos)
+        fp.write( header[8:12] )
+        fp.seek( 448 )
+        fp.write( header[448:495] )
+        fp.seek( pos )
+        data[ data > 65535 ] = 65535
         return data
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    # Function:     _writedata
+    # Function:     writedata
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     def writedata(self,data):
-        '''Mar345::writedata: writes mar345 data array'''
+        '''Mar345::writedata: appends the pck stream of the 16-bit pixels of
+        data to the file self.filename. Deprecated: write and encode do it
+        all in one go'''
+        warnings.warn("Mar345::writedata is deprecated, use write or encode", DeprecationWarning, stacklevel=2)
         if self.verbose > 1: print("Mar345::writedata: ", self.x, self.y)
-        if not data.dtype == np.int16: data = data.astype(np.int16)
-        # Data I/O is via mario.c using CFFI
-        # r should return the number of pixels read from file
-        s = self.filename.encode('ascii', 'ignore') # self.filename is unicode!
-        r = lib.Putmar345Data16(s,self.x,self.y,ffi.cast("short int *", ffi.from_buffer(data) ) )
-        # r = mario.GetmarData32(s, 0, N, self.data )
-        if r == self.x*self.y:  self.success = True
+        if data.dtype == np.int16: data = data.view(np.uint16)
+        k   = self._pack( np.clip( data, 0, 65535 ) )
+        n   = ffi.new("size_t *")
+        pck = lib.Putmar345RowsData( k, n )
+        with open( self.filename, 'ab' ) as fp:
+            fp.write( ffi.buffer( pck, n[0] ) )
+        self.success = True
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     iter_rows
+    # Arguments:    block: number of rows per block, default=64
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def iter_rows(self, block=64):
+        '''Mar345::iter_rows: generator of (first row, array with block rows).
+        The pck stream is decoded one block at a time, so only one block of
+        the 32-bit image is in memory, e.g. with
+            for row, a in Mar345(name, lazy=True).iter_rows(256): ...'''
+        if block < 1: raise ValueError("Mar345::iter_rows: block must be >= 1")
+        if self._data is not None and self.rows == None and self._data.size == self.x * self.y:
+            # Image has been decoded already
+            data = self._data.reshape( self.y, self.x )
+            for row in range( 0, self.y, block ):
+                yield row, data[ row : row + block ]
+            return
+
+        buf = self._buffer
+        if buf is None:                 # Nothing in memory: read complete file
+            fp = self.open()
+            if fp == None: raise IOError("Mar345::iter_rows: Cannot open '{}'".format(self.filename))
+            buf = fp.read()
+            fp.close()
+        pck = ffi.from_buffer("unsigned char[]", buf)
+        r   = lib.Getmar345RowsOpen( pck, len(buf), self.x, self.y )
+        if r == ffi.NULL: raise IOError("Mar345::iter_rows: Not a mar345 image of {}x{} pixels '{}'".format(self.x, self.y, self.filename))
+        r   = ffi.gc( r, lib.Getmar345RowsClose )
+        for row in range( 0, self.y, block ):
+            a = np.empty( ( min(block, self.y - row), self.x ), dtype=np.int32 )
+            if lib.Getmar345RowsNext( r, a.shape[0], a.size, ffi.cast("int *", ffi.from_buffer(a) ) ) != a.size:
+                raise IOError("Mar345::iter_rows: Cannot decode rows {}... of '{}'".format(row, self.filename))
+            yield row, a
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     write_rows
+    # Arguments:    name: output file
+    #               blocks: iterable of row blocks or of (first row, block)
+    #               as from iter_rows
+    #               header: None, h345 dict or 4k header as bytes
+    #               atomic: see write
+    #               imagestats: see encode
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def write_rows(self, name, blocks, header=None, atomic=False, imagestats=False):
+        '''Mar345::write_rows: writes an image given block by block. Only
+        the compressed image and the pixels > 16 bits are kept in memory'''
+        self.filename   = getattr(name, 'name', None) if hasattr(name, 'write') else name
+        self.success    = False
+        header = self._header4k( header )
+        if header == None: return self
+        x, y = self.x, self.y
+        k = lib.Putmar345RowsOpen( x, y )
+        if k == ffi.NULL: raise ValueError("Mar345::write_rows: Invalid image size {}x{}".format(x, y))
+        k = ffi.gc( k, lib.Putmar345RowsClose )
+        counts = np.zeros( 65536, dtype=np.uint32 ) if imagestats else None
+        if counts is not None: lib.Putmar345RowsCount( k, _counts( counts ) )
+
+        # Only the time spent in the library is recorded, not the time
+        # spent in making the blocks
+        row = 0
+        dt  = 0.
+        t0  = self._clock()
+        for a in blocks:
+            if isinstance(a, tuple): a = a[1]
+            a = np.asarray( a )
+            if a.size % x or row + a.size // x > y:
+                raise ValueError("Mar345::write_rows: Block of {} pixels after row {} does not fit {}x{} image".format(a.size, row, x, y))
+            if a.dtype != np.int32:
+                a = np.clip( a, 0, np.iinfo(np.int32).max ).astype(np.int32)
+            n = a.size // x
+            t = time.perf_counter() if t0 is not None else None
+            if n and lib.Putmar345Rows( k, n, ffi.cast("int *", ffi.from_buffer( np.ascontiguousarray(a) ) ) ) != a.size:
+                raise IOError("Mar345::write_rows: Cannot compress rows {}...".format(row))
+            if t is not None: dt += time.perf_counter() - t
+            row += n
+        if row != y:
+            raise ValueError("Mar345::write_rows: Got {} rows for image with {} rows".format(row, y))
+        self._record( 'encode', t0, seconds=dt )
+        if counts is not None: header = self._imagestats( header, k, counts )
+        buf = self._image( header, k )
+        if not self._output_image( name, buf, atomic ):
+            return self
+        self.success = True
+        return self
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:         open
@@ -450,66 +1430,377 @@ class Mar345( ):
             print("ERROR (Mar345::open): Cannot open '{}' for {} ".format(name, "reading" if doread else "writing"))
             return None
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _readfile
+    # Arguments:        name: file name (default: self.filename),
+    #                   n: number of bytes, -1: complete file
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _readfile(self, name=None, n=-1):
+        '''Mar345::_readfile: returns the first n bytes of a file or None'''
+        t  = self._clock()
+        fp = self.open(name)
+        if fp == None:
+            self._record( 'open', t, errors=1 )
+            return None
+        self._record( 'open', t )
+        t   = self._clock()
+        buf = fp.read( n )
+        self._record( 'read', t, bytes_read=len(buf) )
+        t   = self._clock()
+        fp.close()
+        self._record( 'close', t )
+        return buf
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:         read
-    # Arguments:        filename (mandatory), onlyheader (optional, False|True)
+    # Arguments:        filename or file-like object (mandatory),
+    #                   onlyheader (optional, False|True)
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def read(self, name, onlyheader=False):
-        """Mar345::read: reads an image in mar345 format """
+    def read(self, name, onlyheader=False, lazy=False, rows=None, compact=False, out=None, index=False, workers=1, imagestats=False):
+        """Mar345::read: reads an image in mar345 format. With rows=slice(a,b)
+        only rows a...b-1 are decoded into data. With compact=True, the
+        16-bit pixels and the pixels > 16 bits go into compact. out is an
+        int32 array or a BufferPool to decode into. With index=True, the
+        PckIndex next to the image is used (and made if there is none), so
+        bands of rows are decoded in parallel (workers) or directly. With
+        imagestats=True, ImageStats of the data are made while decoding """
         self.data       = None
         self.header     = None
-        self.filename   = name
         self.success    = False
-        if self.verbose > 1: print("Mar345::read: {} onlyheader={}".format(self.filename,onlyheader))
+        self.rows       = None
+        self._out       = out
+        self.imagestats = None
+        self._counting  = imagestats
+        if hasattr(name, 'read'):       # File-like object, e.g. io.BytesIO
+            self.filename = getattr(name, 'name', None)
+            t   = self._clock()
+            buf = name.read(4096 if onlyheader else -1)
+            self._record( 'read', t, bytes_read=len(buf) )
+            return self.decode( buf, onlyheader, lazy, rows, compact, out, workers=workers, imagestats=imagestats )
 
-        fp = self.open(name)
-        if fp == None: return self
+        self.filename   = name
 
-        # Open has been successful, so get image header
-        self.readheader( fp=fp )
-        if self.success == False or ( onlyheader ):
-            fp.close()
+        # Try the cache first. Data arrays from the cache are read-only
+        cache = _cache if not compact else None
+        key   = cache.key(name) if cache != None else None
+        if key != None:
+            e = cache.get( key, data=not (onlyheader or lazy) )
+            if e != None:
+                self.readheader( buf=e[0] )
+                self.lazy       = lazy
+                self._key       = key
+                if self.success and not onlyheader:
+                    self.rows   = self._rowrange( rows )
+                    if lazy:    self._pending = True
+                    else:       self._getdata( entry=e )
+                return self
+
+        # Read header or complete image in one go. In lazy mode, the rest of
+        # the file is read on first access to data
+        buf = self._readfile( name, 4096 if onlyheader or lazy else -1 )
+        if buf == None: return self
+        idx = PckIndex.load( name ) if index and not ( onlyheader or compact ) else None
+        self.decode( buf, onlyheader or lazy, rows=rows, compact=compact, out=out, index=idx, workers=workers, imagestats=imagestats )
+        self.lazy       = lazy
+
+        # No index or an index of an older image: make one from this image
+        if index and idx == None and self.success and self.rows == None and not ( onlyheader or lazy or compact ):
+            self._saveindex( name, buf, self._data )
+        self._pending   = lazy and self.success and not onlyheader
+        self._key       = key
+        if key != None and self.success:
+            full = not ( onlyheader or lazy or self.rows or out is not None )
+            cache.put( key, self.raw_header, self._data if full else None )
+        return self
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         decode
+    # Arguments:        buf: complete image as bytes, bytearray, mmap etc.
+    #                   onlyheader (optional, False|True)
+    #                   lazy (optional, False|True): keep buf, decode data
+    #                   on first access
+    #                   rows (optional): slice or (first, last+1) of rows
+    #                   compact (optional, False|True): see CompactData
+    #                   out (optional): int32 array or BufferPool for data
+    #                   index (optional): PckIndex of the image
+    #                   workers (optional): threads for decoding with index
+    #                   imagestats (optional, False|True): see read
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def decode(self, buf, onlyheader=False, lazy=False, rows=None, compact=False, out=None, index=None, workers=1, imagestats=False):
+        """Mar345::decode: decodes an image in mar345 format held in memory """
+        if compact and ( lazy or rows is not None or out is not None ):
+            raise ValueError("Mar345::decode: compact cannot be combined with lazy, rows or out")
+        self.data       = None
+        self._out       = out
+        self._index     = index
+        self.workers    = workers
+        self.imagestats = None
+        self._counting  = imagestats
+        self.header     = None
+        self.success    = False
+        self.lazy       = lazy
+        self.rows       = None
+        self._buffer    = None
+        self._key       = None
+        if len(buf) < 4096:
+            print("ERROR (Mar345::decode): Image is too short: {} bytes".format(len(buf)))
             return self
 
-        # Open has been successful, so get image data
-        self.readdata( )
+        # Get image header
+        t = self._clock()
+        self.readheader( buf=buf[:4096] )
+        self._record( 'header', t )
         if self.success == False:
-            self.x      = 1
-            self.y      = 1
-            self.data   = np.resize(np.array([0], np.int), [1,1] )
-            fp.close()
+            return self
+        self.rows = self._rowrange( rows )
+        if onlyheader:
+            return self
+        if compact:
+            return self.readcompact( buf )
+        if lazy:
+            self._buffer    = buf
+            self._pending   = True
             return self
 
-        # Return
-        fp.close()
+        # Get image data
+        return self._getdata( buf )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _getdata
+    # Arguments:    buf: complete image in memory (optional)
+    #               entry: (raw_header, data) of the image from the cache
+    #               if it has been looked up already (optional)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _getdata(self, buf=None, entry=None):
+        '''Mar345::_getdata: decodes image data, 1x1 image on failure'''
+        cache = _cache
+        if self._key != None and cache != None:
+            e = entry if entry != None else cache.get( self._key )
+            if e != None:
+                data = e[1] if self.rows == None else e[1][ self.rows[0]*self.x : self.rows[1]*self.x ]
+                if self._out is not None:
+                    out = self._output( self._out, data.size )
+                    np.copyto( out.reshape(-1), data )
+                    data = out
+                self.data       = data
+                self.success    = True
+                if self._counting: self.imagestats = self._count( data )
+                return self
+        self.readdata( buf, out=self._out )
+        if self.success == False:
+            self.x      = 1
+            self.y      = 1
+            self.rows   = None
+            self.data   = np.zeros( (1,1), dtype=np.int32 )
+        elif self._key != None and cache != None and self.rows == None and self._out is None:
+            cache.put( self._key, self.raw_header, self._data )
         return self
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _output
+    # Arguments:    out: None, int32 array or BufferPool, n: number of pixels
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _output(self, out, n):
+        '''Mar345::_output: returns the array to decode n pixels into'''
+        if out is None:
+            return np.empty( n, dtype=np.int32 )
+        if isinstance(out, BufferPool):
+            self._pool = out
+            return out.get( n )
+        if not isinstance(out, np.ndarray):
+            raise TypeError("Mar345: out must be a numpy array or a BufferPool, not {}".format(type(out).__name__))
+        if out.dtype != np.int32:
+            raise TypeError("Mar345: out must have dtype int32, not {}".format(out.dtype))
+        if out.size != n or out.ndim > 2 or ( out.ndim == 2 and out.shape[1] != self.x ):
+            raise ValueError("Mar345: out has shape {}, image needs ({},) or ({}, {})".format(out.shape, n, n // self.x, self.x))
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError("Mar345: out must be C-contiguous and writeable")
+        return out
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _rowrange
+    # Arguments:    rows: slice, (first, last+1) or None
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _rowrange(self, rows):
+        '''Mar345::_rowrange: returns (first, last+1) or None for all rows'''
+        if rows is None: return None
+        if not isinstance(rows, slice): rows = slice( *rows )
+        if rows.step not in (None, 1):
+            raise ValueError("Mar345: rows must be contiguous, not {}".format(rows))
+        a, b, _ = rows.indices( self.y )
+        if a >= b:
+            raise ValueError("Mar345: no rows in {} for image with {} rows".format(rows, self.y))
+        return None if (a, b) == (0, self.y) else (a, b)
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:     readdata
+    # Arguments:    buf: complete image in memory (optional)
+    #               rows: slice or (first, last+1) of rows (optional),
+    #               default: rows given to read or decode
+    #               out: int32 array or BufferPool to decode into (optional)
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def readdata(self):
+    def readdata(self, buf=None, rows=None, out=None):
         '''Mar345::readdata: reads mar345 image data'''
-        if self.verbose > 1: print("Mar345::readdata: ", self.x, self.y)
+        if rows is not None: self.rows = self._rowrange( rows )
         self.success = False
-        N = self.x * self.y
-        self.data = np.zeros( self.x * self.y, dtype=np.int32 )
-        # Data I/O is via libmar345 using CFFI
-        # r should return the number of pixels read from file
-        s = self.filename.encode('ascii', 'ignore') # self.filename is unicode!
-        r = lib.Getmar345DataFromName(s,N,ffi.cast("int *", ffi.from_buffer(self.data) ) )
+        self._pool   = None
+        if buf is None:                 # Nothing in memory: read complete file
+            buf = self._readfile()
+            if buf == None: return self
+        # Data I/O is via libmar345 using CFFI: decodes header, high intensity
+        # records and pck stream from buf.
+        # r should return the number of pixels decoded
+        pck = ffi.from_buffer("unsigned char[]", buf)
+        a, b = self.rows if self.rows != None else ( 0, self.y )
+        N = ( b - a ) * self.x
+        self.data = self._output( out, N )
+
+        # With an index, bands of rows are decoded independently. If that
+        # fails, the stream is decoded from the start as without index
+        t   = self._clock()
+        r   = 0
+        idx = self._index
+        counts = np.zeros( 65536, dtype=np.uint32 ) if self._counting else None
+        if idx != None and ( idx.x, idx.y ) == ( self.x, self.y ):
+            r = idx.decode( buf, a, b, self._data, self.workers )
+        if r != N and self.rows == None:
+            # The histogram is filled while decoding, no pass of its own
+            r = lib.Getmar345DataCountFromBuffer( pck, len(buf), N, ffi.cast("int *", ffi.from_buffer(self._data) ),
+                                                  ffi.NULL if counts is None else _counts( counts ) )
+            h32 = self._records( buf ) if r == N and counts is not None else None
+            if h32 is not None:
+                self.imagestats = ImageStats( counts, h32[:,1] )
+        elif r != N:
+            # Only a band of rows: the pck stream is decoded up to its last row
+            # The size of the pck stream must be the one of the header
+            r = lib.Getmar345RowsFromBuffer( pck, len(buf), self.x, self.y, a, b - a,
+                                             ffi.cast("int *", ffi.from_buffer(self._data) ) )
+        if r == N and self._counting and self.imagestats == None:
+            self.imagestats = self._count( self._data )
         if r == N:  self.success = True
+        if r == N:  self._record( 'decode', t, images_read=1, high_read=self.high )
+        else:       self._record( 'decode', t, errors=1 )
         return self
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _records
+    # Arguments:    buf: complete image in memory
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _records(self, buf):
+        '''Mar345::_records: returns the (address, value) pairs of the pixels
+        > 16 bits with addresses within the image, None if they do not fit
+        into buf. Their number is the one of the binary header, as for the
+        decoder, not HIGH of the text header'''
+        dt  = '>i4' if self.header['swap'] else '<i4'
+        n   = max( int( np.frombuffer( buf, dtype=dt, count=1, offset=8 )[0] ), 0 )
+        if n > ( len(buf) - 4096 ) // 8:
+            print("ERROR (Mar345::_records): {} pixels > 16 bits do not fit into {} bytes".format(n, len(buf)))
+            return None
+        h32 = np.frombuffer( buf, dtype=dt, count=2*n, offset=4096 ).reshape( -1, 2 )
+        return h32[ ( h32[:,0] >= 0 ) & ( h32[:,0] < self.x * self.y ) ]
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _count
+    # Arguments:    data: 32-bit pixels
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _count(self, data):
+        '''Mar345::_count: returns ImageStats of data that has been decoded
+        without histogram (index, rows, cache)'''
+        data   = np.ascontiguousarray( data, dtype=np.int32 ).reshape(-1)
+        counts = np.zeros( 65536, dtype=np.uint32 )
+        lib.Getmar345Count( ffi.cast("int *", ffi.from_buffer(data) ), data.size, _counts( counts ) )
+        return ImageStats( counts, data[ data > 65535 ] )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _saveindex
+    # Arguments:    name: file name, buf: complete image, data: its pixels
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _saveindex(self, name, buf, data):
+        '''Mar345::_saveindex: writes the PckIndex of image name'''
+        idx = PckIndex.build( buf, self.x, self.y, data )
+        if idx == None: return
+        try:
+            idx.save( name )
+            self._index = idx
+        except OSError as e:
+            if self.verbose: print("ERROR (Mar345::_saveindex): Cannot write index of {}: {}".format(name, e))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     readcompact
+    # Arguments:    buf: complete image in memory (optional)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def readcompact(self, buf=None):
+        '''Mar345::readcompact: reads mar345 image data into a CompactData'''
+        self.success = False
+        if buf is None:                 # Nothing in memory: read complete file
+            buf = self._readfile()
+            if buf == None: return self
+        N = self.x * self.y
+        data16 = np.empty( N, dtype=np.uint16 )
+        t = self._clock()
+        r = lib.Getmar345Data16FromBuffer( ffi.from_buffer("unsigned char[]", buf), len(buf), N,
+                                           ffi.cast("short *", ffi.from_buffer(data16) ) )
+        if r != N:
+            self._record( 'decode', t, errors=1 )
+            return self
+        self._record( 'decode', t, images_read=1 )
+
+        # Table of pixels > 16 bits: (address, value) pairs after the header
+        t   = self._clock()
+        h32 = self._records( buf )
+        if h32 is None:
+            self._record( 'high', t, errors=1 )
+            return self
+        self.data       = None
+        self.compact    = CompactData( self.x, self.y, data16, h32[:,0].astype(np.intp), h32[:,1].astype(np.int32) )
+        self._record( 'high', t, high_read=len(self.compact.idx) )
+        if self._counting:
+            c = self.compact
+            counts = np.bincount( c.data16, minlength=65536 )
+            np.subtract.at( counts, c.data16[c.idx], 1 )
+            np.add.at( counts, np.clip( c.val, 0, 65535 ), 1 )
+            self.imagestats = ImageStats( counts, c.val )
+        self.success    = True
+        return self
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:     _parsevalue
+    # Arguments:    h: header dict, p: entry of h345_parse, v: value string
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _parsevalue(self, h, p, v):
+        '''Mar345::_parsevalue: puts value v of a header line into h'''
+        try:
+            if p[0] != None: v = p[0](v)
+        except ValueError:
+            if self.verbose: print("WARNING (Mar345::readheader): cannot convert '%s' for %s" % (v, p[1]))
+            return
+        for f in p[1:]:
+            if isinstance(f, tuple):
+                h[ f[0] ][ f[1] ] = v
+            else:
+                h[f] = v
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function:     readheader
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def readheader(self, name=None, fp=None):
-        '''Mar345::readheader: reads mar345 image header'''
-        if fp == None:
-            fp = self.open( name if name != None else self.filename )
+    def readheader(self, name=None, fp=None, buf=None):
+        '''Mar345::readheader: reads mar345 image header from buf (4k bytes),
+        from open file fp or from file name'''
+        if buf is None:
+            if fp == None:
+                fp = self.open( name if name != None else self.filename )
+                if fp == None: return None
+                buf = fp.read(4096)
+                fp.close()
+            else:
+                fp.seek( 0 )
+                buf = fp.read(4096)
+        if len(buf) < 128:
+            print("ERROR (Mar345::readheader): Header is too short: %d bytes" % len(buf))
+            return None
 
         n = 0
-        h345_keys = list(h345_line.keys())
+        h = _newheader()     # Each image gets its own header
 
         # First 32 integers contain:
         # byteorder[0], size_x[1], nhigh[2], format[3], timemode[4],
@@ -517,12 +1808,12 @@ class Mar345( ):
         # wavelength[8], distance[9], phibeg[10], phiend[11],
         # omebeg[12], omeend[13], chi[14], theta[15], [16-31]:ununsed
         h32 = array.array('i')
-        h32.fromfile(fp, 32)
+        h32.frombytes( buf[:128] )
         # First integer should be 1234, otherwise we need to swap bytes
         swap = False
         if h32[0] != 1234:
             h32.byteswap()
-            h345['swap'] = 1
+            h['swap'] = 1
         if h32[0] != 1234:
             print("ERROR (Mar345::readheader): First integer in header should be 1234 but is %d.\nThis is NOT a mar345 image!" % h32[0])
             return None
@@ -531,7 +1822,6 @@ class Mar345( ):
         if self.verbose > 1: print(60*'+',"\nFirst 16 integers contain:\nItem Value\n",60*'+')
         while n < 16:
             i = h32[n]
-            if h345['swap']: i.byteswap()
             if self.verbose > 1: print("%2d: %d" % ( n+1, i ))
             n += 1
         if self.verbose > 1: print(60*'+')
@@ -544,8 +1834,7 @@ class Mar345( ):
         self.success = True
 
         # Byte 128: mar research
-        fp.seek(128)
-        line = fp.read(64)
+        line = buf[128:192]
         if line[:12] != b'mar research':
             print("WARNING (Mar345::readheader): byte 128 should start with string 'mar research' but starts with '%s'" % line[:12])
         else:
@@ -553,8 +1842,9 @@ class Mar345( ):
 
         # Bytes 192-4096: 64-chars/line
         remarks = 0
-        while fp.tell()  < 4096:
-            barr = fp.read(64)
+        pos     = 128
+        for pos in range( 192, min( len(buf), 4096 ), 64 ):
+            barr = buf[pos:pos+64]
             # Last meaningful line in header is marked END OF HEADER
             if barr.startswith(b'END OF HEADER'): break
             try:
@@ -564,210 +1854,108 @@ class Mar345( ):
             if self.verbose > 1: print(line[:-1].replace('\n','\0'))
             # Split each line in individual words starting with 'key'
             token = line.split()
+            if len(token) == 0: continue
             key = token[0]
-            # Check key against h345_keys
-            for x in h345_keys:
-                keypair = list(x)
-                mainkey = keypair[0]
-                subkey 	= keypair[1]
-                # Only 1 keyword in line
-                if (len(subkey) == 0 ) and ( key == mainkey ):
-                    if self.verbose > 2: print("No subkey for %s" % mainkey)
-                    if key == 'HIGH':
-                        h345['high'] = int(token[1])
-                    elif key == 'FORMAT':
-                        h345['x'] = int(token[1])
-                        h345['y'] = int(token[1])
-                    elif key == 'SCANNER':
-                        h345['serial'] = int(token[1])
-                    elif key == 'DISTANCE':
-                        h345['distance'] = float(token[1])
-                    elif key == 'WAVELENGTH':
-                        h345['wavelength'] = float(token[1])
-                    elif key == 'THETA':
-                        h345['theta'] = float(token[1])
-                    elif key == 'CHI':
-                        h345['chi'] = float(token[1])
-                    elif key == 'TIME':
-                        h345['time'] = float(token[1])
-                    elif key == 'GAIN':
-                        h345['gain'] = float(token[1])
-                    elif key == 'MULTIPLIER':
-                        h345['multiplier'] = float(token[1])
-                    elif key == 'REMARK':
-                        h345['extra'] = " ".join(list(token[1:]))
-                        h345['remark'].append( h345['extra']  )
-                        remarks += 1
-                    elif key == 'POLARIZATION':
-                        h345['polarization'] = " ".join(list(token[1:]))
-                    elif key == 'GENERATOR':
-                        h345['source'] = " ".join(list(token[1:]))
-                    elif key == 'DETECTOR':
-                        h345['detector'] = " ".join(list(token[1:]))
-                    elif key == 'PROGRAM':
-                        h345['program'] = " ".join(list(token[1:]))
-                    elif key == 'DATE':
-                        h345['date'] = " ".join(list(token[1:]))
-
-                # Line with keywords and subkeywords
-                # print "keypair %s \t%s\t%s" % (keypair, mainkey, subkey)
-                n = 1
-                for y in token[1:]:
-                    n += 1
-                    if ( y == subkey ) and (key == mainkey):
-                        if self.verbose > 2: print("Found key %s subkey %s" % ( key, subkey ))
-
-                        if subkey == 'PCK' or subkey == 'IMGE':
-                            h345['pixels'] = int(token[n])
-                        elif subkey == 'ROFF':
-                            h345['roff'] = float(token[n])
-                        elif subkey == 'TOFF':
-                            h345['toff'] = float(token[n])
-                        elif subkey == 'TIME':
-                            h345['type'] = 'TIME'
-                        elif subkey == 'DOSE':
-                            h345['type'] = 'DOSE'
-                        elif subkey == 'ADD_A':
-                            h345['adc_add'][0] = int(token[n])
-                        elif subkey == 'ADD_B':
-                            h345['adc_add'][1] = int(token[n])
-                        elif subkey == 'A' and key == 'ADC':
-                            h345['adc'][0] = int(token[n])
-                        elif subkey == 'B' and key == 'ADC':
-                            h345['adc'][1] = int(token[n])
-                        elif subkey == 'X' and key == 'CENTER':
-                            h345['center'][0] = float(token[n])
-                        elif subkey == 'Y' and key == 'CENTER':
-                            h345['center'][1] = float(token[n])
-                        elif subkey == 'START' and key == 'PHI':
-                            h345['phibeg'] = float(token[n])
-                        elif subkey == 'END' and key == 'PHI':
-                            h345['phiend'] = float(token[n])
-                        elif subkey == 'OSC' and key == 'PHI':
-                            h345['phiosc'] = int(token[n])
-                        elif subkey == 'START' and key == 'OMEGA':
-                            h345['omebeg'] = float(token[n])
-                        elif subkey == 'END' and key == 'OMEGA':
-                            h345['omeend'] = float(token[n])
-                        elif subkey == 'OSC' and key == 'OMEGA':
-                            h345['omeosc'] = int(token[n])
-                        elif subkey == 'START' and key == 'HISTOGRAM':
-                            h345['histbeg'] = int(token[n])
-                        elif subkey == 'END' and key == 'HISTOGRAM':
-                            h345['histend'] = int(token[n])
-                        elif subkey == 'MAX' and key == 'HISTOGRAM':
-                            h345['histmax'] = int(token[n])
-                        elif subkey == 'MAX' and key == 'INTENSITY':
-                            h345['valmax'] = int(token[n])
-                        elif subkey == 'MIN' and key == 'INTENSITY':
-                            h345['valmin'] = int(token[n])
-                        elif subkey == 'AVE' and key == 'INTENSITY':
-                            h345['valavg'] = float(token[n])
-                        elif subkey == 'SIG' and key == 'INTENSITY':
-                            h345['valsig'] = float(token[n])
-                        elif subkey == 'SIG' and key == 'COUNTS':
-                            h345['dosesig'] = float(token[n])
-                        elif subkey == 'AVE' and key == 'COUNTS':
-                            h345['doseavg'] = float(token[n])
-                        elif subkey == 'MIN' and key == 'COUNTS':
-                            h345['dosemin'] = float(token[n])
-                        elif subkey == 'MAX' and key == 'COUNTS':
-                            h345['dosemax'] = float(token[n])
-                        elif subkey == 'START' and key == 'COUNTS':
-                            h345['dosebeg'] = float(token[n])
-                        elif subkey == 'END' and key == 'COUNTS':
-                            h345['doseend'] = float(token[n])
-                        elif subkey == 'NMEAS' and key == 'COUNTS':
-                            h345['dose_n'] = int(token[n])
-                        elif subkey == 'LENGTH' and key == 'PIXEL':
-                            h345['pixelsize'][0] = int(token[n])
-                        elif subkey == 'HEIGHT' and key == 'PIXEL':
-                            h345['pixelsize'][1] = int(token[n])
-            # End of:  for x in h345_keys:
-        # End of: while fp.tell()  < 4096:
+            if key == 'REMARK':
+                h['extra'] = " ".join(token[1:])
+                h['remark'].append( h['extra'] )
+                remarks += 1
+                continue
+            # Keyword alone and keyword with subkeywords
+            p = h345_parse.get( (key, '') )
+            if p != None and ( len(token) > 1 or p[0] == str ):
+                self._parsevalue( h, p, " ".join(token[1:]) if p[0] == str else token[1] )
+            for n in range( 1, len(token) ):
+                p = h345_parse.get( (key, token[n]) )
+                if p == None: continue
+                if self.verbose > 2: print("Found key %s subkey %s" % ( key, token[n] ))
+                if p[0] == None:
+                    self._parsevalue( h, p, token[n] )
+                elif n+1 < len(token):
+                    self._parsevalue( h, p, token[n+1] )
+        # End of: for pos in range( 192, 4096, 64 ):
         # We come here if either END OF HEADER has been seen or if
         # 4096 bytes have been read
         if self.verbose > 1:
-            print(60*'+', "\nByte %4d: END OF HEADER reached with %d remarks\n" % ( fp.tell(), remarks ), 60*'+')
+            print(60*'+', "\nByte %4d: END OF HEADER reached with %d remarks\n" % ( pos+64, remarks ), 60*'+')
 
-        where   = h345['program'].find( "Version" )
-        if ( where > 0 ): h345['version'] = h345['program'][ where+8: ]
+        where   = h['program'].find( "Version" )
+        if ( where > 0 ): h['version'] = h['program'][ where+8: ]
 
         # Something wrong with x, y ?
-        if h345['x'] == 0 and h345['y'] == 0 and h345['pixels'] > 0:
-            h345['x'] = h345['y'] = int( math.sqrt( h345['pixels'] ) )
+        if h['x'] == 0 and h['y'] == 0 and h['pixels'] > 0:
+            h['x'] = h['y'] = int( math.sqrt( h['pixels'] ) )
 
         # Non-square images:
-        if h345['x'] * h345['y'] != h345['pixels'] and h345['pixels'] > 0:
-            h345['y'] = int(h345['pixels'] / h345['x']) # Version 1.0.1 bug fix
+        if h['x'] * h['y'] != h['pixels'] and h['pixels'] > 0:
+            h['y'] = int(h['pixels'] / h['x']) # Version 1.0.1 bug fix
 
         # Convert pixelsize into mm
-        if h345['pixelsize'][0] <=0.0:
-            if h345['x'] == 1200 or h345['x'] == 1600 or  h345['x'] == 2000 or  h345['x'] == 2300:
-                h345['pixelsize'][0] = 150.
+        if h['pixelsize'][0] <=0.0:
+            if h['x'] == 1200 or h['x'] == 1600 or  h['x'] == 2000 or  h['x'] == 2300:
+                h['pixelsize'][0] = 150.
             else:
-                h345['pixelsize'][0] = 100.
-        if h345['pixelsize'][1] <=0.0:
-            h345['pixelsize'][1] = h345['pixelsize'][0]
-        if h345['pixelsize'][0] > 1.0: h345['pixelsize'][0] /= 1000.
-        if h345['pixelsize'][1] > 1.0: h345['pixelsize'][1] /= 1000.
+                h['pixelsize'][0] = 100.
+        if h['pixelsize'][1] <=0.0:
+            h['pixelsize'][1] = h['pixelsize'][0]
+        if h['pixelsize'][0] > 1.0: h['pixelsize'][0] /= 1000.
+        if h['pixelsize'][1] > 1.0: h['pixelsize'][1] /= 1000.
 
         # For debugging, print stuff
         if self.verbose > 2:
-            K = list(h345.keys())
-            V = list(h345.values())
+            K = list(h.keys())
+            V = list(h.values())
             print(list(K))
             print(list(V))
 
         # For debugging, print stuff
         if self.verbose > 1:
-            print("Program:                 \t %s" % h345['program'])
-            print("Version:                 \t %s" % h345['version'])
-            print("Date:                    \t %s" % h345['date'])
-            print("Detector:                \t %s" % h345['detector'])
-            print("Serial:                  \t %d" % h345['serial'])
-            print("ADC A/B                  \t %d / %d " % (h345['adc'][0], h345['adc'][1]))
-            print("ADC ADD_A/B              \t %d / %d " % (h345['adc_add'][0], h345['adc_add'][1]))
-            print("Radial/tangential offset \t %d / %d " % (h345['roff'], h345['toff']))
-            print("Gaps                     \t ", str(h345['gaps']).strip('[]'))
-            print("Number of pixels in x,y: \t %d x %d = %d" % ( h345['x'], h345['y'], h345['pixels'] ))
-            print("Number of 32-bit values: \t %d" % h345['high'])
-            print("Pixelsize in x,y:        \t %1.3f %1.3f" % (h345['pixelsize'][0],h345['pixelsize'][1]))
-            print("Center in x,y:           \t %1.3f %1.3f" % (h345['center'][0],h345['center'][1]))
-
-            print("Exposure time:           \t %1.1f in %s mode" % (h345['time'],h345['type']))
-            print("Phi:                     \t %-7.3f -> %1.3f\t x %d" % ( h345['phibeg'],h345['phiend'],h345['phiosc']))
-            print("Omega:                   \t %-7.3f -> %1.3f\t x %d" % ( h345['omebeg'],h345['omeend'],h345['omeosc']))
-            print("Distance:                \t %1.3f" % h345['distance'])
-            print("Wavelength:              \t %1.5f" % h345['wavelength'])
-            print("Chi:                     \t %1.3f" % h345['chi'])
-            print("Two-theta:               \t %1.1f" % h345['theta'])
-            print("Counts min/max:          \t %1.0f\t%1.0f" % ( h345['dosemin'], h345['dosemax'] ))
-            print("Counts avg/sig:          \t %1.0f +/- %1.2f" % ( h345['doseavg'],h345['dosesig']))
-            print("Counts start/end/N:      \t %1.0f\t%1.0f\t#=%d" % ( h345['dosebeg'], h345['doseend'],h345['dose_n']))
-            print("Histogram start/end/max  \t %d\t%d\t%d" % ( h345['histbeg'], h345['histend'],h345['histmax']))
-            print("Intensity min/max:       \t %d\t%d" % ( h345['valmin'], h345['valmax']))
-            print("Intensity avg/sig:       \t %1.1f +/- %1.1f" % ( h345['valavg'], h345['valsig']))
-            print("Generator:               \t %s" % h345['source'])
-            print("Generator kV / mA        \t %1.1f \t %1.1f" % ( h345['kV'], h345['mA']))
-            print("Monochromator:           \t %s" % h345['filter'])
-            print("Polarization:            \t %s" % h345['polarization'])
-            for x in h345['remark']:
+            print("Program:                 \t %s" % h['program'])
+            print("Version:                 \t %s" % h['version'])
+            print("Date:                    \t %s" % h['date'])
+            print("Detector:                \t %s" % h['detector'])
+            print("Serial:                  \t %d" % h['serial'])
+            print("ADC A/B                  \t %d / %d " % (h['adc'][0], h['adc'][1]))
+            print("ADC ADD_A/B              \t %d / %d " % (h['adc_add'][0], h['adc_add'][1]))
+            print("Radial/tangential offset \t %d / %d " % (h['roff'], h['toff']))
+            print("Gaps                     \t ", str(h['gaps']).strip('[]'))
+            print("Number of pixels in x,y: \t %d x %d = %d" % ( h['x'], h['y'], h['pixels'] ))
+            print("Number of 32-bit values: \t %d" % h['high'])
+            print("Pixelsize in x,y:        \t %1.3f %1.3f" % (h['pixelsize'][0],h['pixelsize'][1]))
+            print("Center in x,y:           \t %1.3f %1.3f" % (h['center'][0],h['center'][1]))
+
+            print("Exposure time:           \t %1.1f in %s mode" % (h['time'],h['type']))
+            print("Phi:                     \t %-7.3f -> %1.3f\t x %d" % ( h['phibeg'],h['phiend'],h['phiosc']))
+            print("Omega:                   \t %-7.3f -> %1.3f\t x %d" % ( h['omebeg'],h['omeend'],h['omeosc']))
+            print("Distance:                \t %1.3f" % h['distance'])
+            print("Wavelength:              \t %1.5f" % h['wavelength'])
+            print("Chi:                     \t %1.3f" % h['chi'])
+            print("Two-theta:               \t %1.1f" % h['theta'])
+            print("Counts min/max:          \t %1.0f\t%1.0f" % ( h['dosemin'], h['dosemax'] ))
+            print("Counts avg/sig:          \t %1.0f +/- %1.2f" % ( h['doseavg'],h['dosesig']))
+            print("Counts start/end/N:      \t %1.0f\t%1.0f\t#=%d" % ( h['dosebeg'], h['doseend'],h['dose_n']))
+            print("Histogram start/end/max  \t %d\t%d\t%d" % ( h['histbeg'], h['histend'],h['histmax']))
+            print("Intensity min/max:       \t %d\t%d" % ( h['valmin'], h['valmax']))
+            print("Intensity avg/sig:       \t %1.1f +/- %1.1f" % ( h['valavg'], h['valsig']))
+            print("Generator:               \t %s" % h['source'])
+            print("Generator kV / mA        \t %1.1f \t %1.1f" % ( h['kV'], h['mA']))
+            print("Monochromator:           \t %s" % h['filter'])
+            print("Polarization:            \t %s" % h['polarization'])
+            for x in h['remark']:
                 print("Remark:                  \t %s" % x)
             if self.verbose > 1: print(60*'+')
 
         # Put some important stuff into self
-        self.x          = int(h345['x'])
-        self.y          = int(h345['y'])
-        self.pixels     = int(h345['pixels'])
-        self.high       = int(h345['high'])
+        self.x          = int(h['x'])
+        self.y          = int(h['y'])
+        self.pixels     = int(h['pixels'])
+        self.high       = int(h['high'])
 
         # Put the mar345 header into self
-        self.header     = h345
+        self.header     = h
 
-        # Go back to start of file and keep a copy of the raw header
-        fp.seek( 0 )
-        self.raw_header = fp.read(4096)
+        # Keep a copy of the raw header
+        self.raw_header = bytes( buf[:4096] )
         del h32         # Version 2.1.0: free memory
         return self.raw_header
 
@@ -775,6 +1963,263 @@ class Mar345( ):
 # Class/end:    Mar345
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
+# File names of mar345 images: xxx.mar1200, xxx.mar2300, ...
+mar345_name = re.compile( r'\.mar\d{4}$' )
+
+###########################################################################
+## Function:    find
+## Arguments:   args:       list of directories, glob patterns or files
+##              recursive:  descend into subdirectories, default=False
+###########################################################################
+def find(args, recursive=False):
+    '''find: returns sorted list of mar345 images given by args'''
+    names = set()
+    for a in args:
+        if os.path.isdir(a):
+            if recursive:
+                for root, dirs, files in os.walk(a):
+                    names.update( os.path.join(root, f) for f in files if mar345_name.search(f) )
+            else:
+                names.update( os.path.join(a, f) for f in os.listdir(a) if mar345_name.search(f) )
+        elif os.path.isfile(a):
+            names.add( a )
+        else:
+            names.update( f for f in glob.glob(a, recursive=recursive) if os.path.isfile(f) )
+    return sorted( names )
+
+###########################################################################
+## Function:    read_many
+## Arguments:   names:      list of filenames
+##              workers:    number of threads, default: number of CPUs
+##              onlyheader: default=False
+##              verbose:    default=0
+###########################################################################
+def read_many(names, workers=None, onlyheader=False, verbose=0, compact=False):
+    '''read_many: reads mar345 images in parallel threads.
+    Returns a list of Mar345 objects in the same order as names'''
+    # Decoding in _libmar345 runs without the GIL (cffi releases it for
+    # every call into the library), so threads scale with the cores
+    if workers == None: workers = os.cpu_count() or 1
+    def _read(name):
+        return Mar345(verbose=verbose).read(name, onlyheader, compact=compact)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_read, names))
+
+###########################################################################
+## Class:       Mar345Series
+## Arguments:   pattern:   glob pattern or list of file names
+##              sort:      'number' (in file name), 'phi' (phibeg in header)
+##                         or None (as given)
+##              prefetch:  max. number of images decoded ahead, default:
+##                         2 per worker
+##              workers:   number of threads, default: number of CPUs
+##              **kw:      passed on to Mar345.read, e.g. compact=True
+###########################################################################
+class Mar345Series( ):
+    '''Iterator over a series of images in order. The next images are
+    decoded in background threads while the current one is processed'''
+    def __init__(self, pattern, sort='number', prefetch=None, workers=None, verbose=0, **kw):
+        self.verbose    = verbose
+        self.workers    = workers if workers != None else ( os.cpu_count() or 1 )
+        self.prefetch   = prefetch if prefetch != None else 2 * self.workers
+        self.kw         = kw
+        self.wait       = 0.0       # Time spent waiting for the next image
+        self.compute    = 0.0       # Time spent by the caller on the images
+        self.decode     = 0.0       # Time spent reading images in workers
+        self.frames     = 0
+        self._pending   = deque()
+        names = sorted( glob.glob(pattern) ) if isinstance(pattern, str) else list(pattern)
+        if sort == 'number':
+            names.sort( key=_framenumber )
+        elif sort == 'phi':
+            phi = [ img.header['phibeg'] if img.success else 0. for img in read_many(names, self.workers, onlyheader=True) ]
+            names = [ n for p, n in sorted( zip(phi, names), key=lambda t: t[0] ) ]
+        elif sort != None:
+            raise ValueError("Mar345Series: sort must be 'number', 'phi' or None, not '{}'".format(sort))
+        self.names      = names
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def depth(self):
+        '''Mar345Series::depth: number of decoded images waiting in the queue'''
+        return sum( 1 for f in list(self._pending) if f.done() )
+
+    def _read(self, name):
+        t = time.perf_counter()
+        img = Mar345(verbose=self.verbose).read(name, **self.kw)
+        return img, time.perf_counter() - t
+
+    def __iter__(self):
+        self.wait = self.compute = self.decode = 0.0
+        self.frames = 0
+        todo = iter(self.names)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for name in todo:
+                self._pending.append( pool.submit(self._read, name) )
+                if len(self._pending) >= self.prefetch: break
+            while self._pending:
+                t = time.perf_counter()
+                img, dt = self._pending.popleft().result()
+                self.wait   += time.perf_counter() - t
+                self.decode += dt
+                for name in todo:       # Keep the queue filled
+                    self._pending.append( pool.submit(self._read, name) )
+                    break
+                self.frames += 1
+                t = time.perf_counter()
+                yield img
+                self.compute += time.perf_counter() - t
+        finally:
+            for f in self._pending: f.cancel()
+            self._pending.clear()
+            pool.shutdown(wait=True)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''Mar345Series::stats: dict with number of images, queue depth and
+        the time spent waiting, computing (caller) and decoding (workers)'''
+        return { 'frames' : self.frames, 'depth' : self.depth, 'prefetch' : self.prefetch,
+                 'wait' : self.wait, 'compute' : self.compute, 'decode' : self.decode }
+
+###########################################################################
+## Class:       Mar345Accumulator
+## Arguments:   dtype:     of the sum, np.int64 (default) or np.float64
+##              workers:   number of threads for decoding, default: number
+##                         of CPUs
+##              prefetch:  max. number of images decoded ahead, see
+##                         Mar345Series
+###########################################################################
+class Mar345Accumulator( ):
+    '''Sum of a series of images, each multiplied by a scale factor. The
+    images are decoded in threads into arrays from a BufferPool and added
+    in place, so memory does not grow with the number of images, e.g.
+        acc = Mar345Accumulator()
+        acc.add_many(names, scales=[ 1./t for t in dose ])
+        acc.write("sum.mar2300")'''
+    def __init__(self, dtype=np.int64, workers=None, prefetch=None, verbose=0):
+        self.dtype      = np.dtype(dtype)
+        if not self.dtype in ( np.int64, np.float64 ):
+            raise ValueError("Mar345Accumulator: dtype must be int64 or float64, not {}".format(self.dtype))
+        self.workers    = workers
+        self.prefetch   = prefetch
+        self.verbose    = verbose
+        self.sum        = None      # Sum of the images, shape (y, x)
+        self.raw_header = None      # Header of the first image
+        self.frames     = 0
+        self.wait       = 0.0       # Time spent waiting for decoded images
+        self.add_time   = 0.0       # Time spent adding
+        self._tmp       = None      # Scaled image (scale factors != 1)
+
+    def __len__(self):
+        return self.frames
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         add
+    # Arguments:        img: Mar345, file name or array, scale: factor
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def add(self, img, scale=1.0):
+        '''Mar345Accumulator::add: adds scale * image to the sum. Returns the
+        image as Mar345 (None for arrays)'''
+        if isinstance(img, str):
+            img = Mar345(verbose=self.verbose).read(img)
+        if isinstance(img, Mar345):
+            if not img.success:
+                raise IOError("Mar345Accumulator: cannot read '{}'".format(img.filename))
+            data = img.data.reshape( img.y, img.x )
+            if self.raw_header == None: self.raw_header = img.raw_header
+        else:
+            data = np.asarray( img )
+            if data.ndim != 2:
+                raise ValueError("Mar345Accumulator: arrays must have shape (y, x), not {}".format(data.shape))
+            img  = None
+        if self.sum is None:
+            self.sum = np.zeros( data.shape, dtype=self.dtype )
+        elif data.shape != self.sum.shape:
+            raise ValueError("Mar345Accumulator: image has {} x {} pixels, sum has {} x {}".format(
+                             data.shape[1], data.shape[0], self.sum.shape[1], self.sum.shape[0]))
+
+        t = time.perf_counter()
+        if scale == 1:
+            np.add( self.sum, data, out=self.sum, casting='unsafe' )
+        else:
+            # One scratch array for all images, not a new one per image
+            if self._tmp is None: self._tmp = np.empty( data.shape, dtype=np.float64 )
+            np.multiply( data, scale, out=self._tmp )
+            if self.dtype == np.int64: np.rint( self._tmp, out=self._tmp )
+            np.add( self.sum, self._tmp, out=self.sum, casting='unsafe' )
+        self.add_time += time.perf_counter() - t
+        self.frames   += 1
+        return img
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         add_many
+    # Arguments:        names: glob pattern or list of file names (in the
+    #                   order given), scales: None (all 1), list of factors
+    #                   or function of the image (Mar345) returning its factor
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def add_many(self, names, scales=None):
+        '''Mar345Accumulator::add_many: adds a series of images, decoded in
+        parallel while the previous ones are added'''
+        pool   = BufferPool()
+        series = Mar345Series( names, sort=None, prefetch=self.prefetch, workers=self.workers,
+                               verbose=self.verbose, out=pool )
+        if scales is not None and not callable(scales) and len(scales) != len(series):
+            raise ValueError("Mar345Accumulator: {} scale factors for {} images".format(len(scales), len(series)))
+        for i, img in enumerate(series):
+            scale = 1.0 if scales is None else scales(img) if callable(scales) else scales[i]
+            self.add( img, scale )
+            img.release()           # Array goes back into the pool
+        self.wait += series.wait
+        return self
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         result
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def result(self):
+        '''Mar345Accumulator::result: returns the sum as int32 image as it
+        is written: rounded and clipped to 0...2^31-1'''
+        if self.sum is None:
+            raise ValueError("Mar345Accumulator: no images added")
+        a = np.rint( self.sum ) if self.dtype == np.float64 else self.sum
+        return np.clip( a, 0, np.iinfo(np.int32).max ).astype(np.int32)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         write
+    # Arguments:        name: file name or file-like object
+    #                   header: None (header of the first image), h345 dict
+    #                   or 4k header as bytes
+    #                   **kw: passed on to Mar345.write, e.g. atomic=True
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def write(self, name, header=None, **kw):
+        '''Mar345Accumulator::write: writes the sum as mar345 image. Pixels
+        > 16 bits go into the high intensity records, the intensity
+        statistics of the header are those of the sum'''
+        data = self.result()
+        out  = Mar345( verbose=self.verbose )
+        out.y, out.x = data.shape
+        kw.setdefault( 'imagestats', True )
+        out.write( name, data, header if header != None else self.raw_header, **kw )
+        return out
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''Mar345Accumulator::stats: dict with number of images and the time
+        spent waiting for decoded images and adding them'''
+        return { 'frames' : self.frames, 'wait' : self.wait, 'add' : self.add_time }
+
+# Sort key for file names with frame numbers: xtal_2.mar2300 < xtal_10.mar2300
+def _framenumber(name):
+    base = os.path.splitext( os.path.basename(name) )[0]
+    m = re.search( r'(\d+)\D*$', base )
+    return ( os.path.dirname(name), base[:m.start()], int(m.group(1)) ) if m else ( os.path.dirname(name), base, -1 )
+
 ###########################################################################
 ## If this python file is called by itself, run the main program ...
 ###########################################################################
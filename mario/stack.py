@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:		    stack
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:	Decodes a series of mar345 images once into a 3D array file
+                (frames x y x, .npy) with a sidecar index (.json) of the
+                source files and their headers. Later runs open the file as
+                np.memmap without decoding. Frames whose source file changed
+                (size, mtime) are decoded again, the others are kept.
+
+                python -m mario.stack [options] stack.npy dir|glob|file ...
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:		    Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, json, optparse
+import concurrent.futures
+import numpy as np
+from   mario import mar345
+from   mario.mar345 import find
+
+# Version of the sidecar index
+VERSION = 1
+
+###########################################################################
+## Function:    _stat
+## Description: Returns what identifies a version of a file
+###########################################################################
+def _stat(name):
+    st = os.stat(name)
+    return [ st.st_size, st.st_mtime_ns ]
+
+###########################################################################
+## Function:    _decode
+## Description: Runs in a worker thread. Decodes one image into its
+##              frame of the stack and returns the header
+###########################################################################
+def _decode(name, out):
+    img = mar345.Mar345().read(name, out=out)
+    if not img.success or ( img.y, img.x ) != out.shape:
+        raise IOError("Cannot decode '{}' into a frame of {} x {} pixels".format(name, out.shape[1], out.shape[0]))
+    return img.header
+
+###########################################################################
+## Function:    _load
+## Description: Returns the sidecar index of a stack or None
+###########################################################################
+def _load(name):
+    try:
+        with open(name + '.json') as fp:
+            idx = json.load(fp)
+        if idx.get('version') != VERSION: return None
+        shape = np.load(name, mmap_mode='r').shape
+        if list(shape) != idx['shape'] or len(idx['frames']) != shape[0]: return None
+        return idx
+    except (OSError, ValueError, KeyError):
+        return None
+
+###########################################################################
+## Function:    _save
+## Description: Writes the sidecar index (temporary file + rename)
+###########################################################################
+def _save(name, idx):
+    tmp = name + '.json.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(idx, fp)
+    os.replace(tmp, name + '.json')
+
+###########################################################################
+## Class:       Stack
+## Arguments:   name:      filename of the stack (.npy)
+##              mode:      'r' (default) or 'r+', see np.memmap
+###########################################################################
+class Stack( ):
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         __init__
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def __init__(self, name, mode='r'):
+        '''Stack::__init__: opens a stack made by materialize'''
+        idx = _load(name)
+        if idx == None:
+            raise IOError("'{}' is not a stack of mar345 images".format(name))
+        self.filename   = name
+        self.frames     = idx['frames']
+        self.data       = np.load(name, mmap_mode=mode)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    @property
+    def names(self):
+        '''Stack::names: source images of the frames'''
+        return [ f['path'] for f in self.frames ]
+
+    @property
+    def headers(self):
+        '''Stack::headers: headers of the source images'''
+        return [ f['header'] for f in self.frames ]
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stale
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stale(self):
+        '''Stack::stale: returns indices of frames whose source image changed
+        or does not exist any more'''
+        todo = [ ]
+        for i, f in enumerate(self.frames):
+            try:
+                if _stat( f['path'] ) != f['stat']: todo.append(i)
+            except OSError:
+                todo.append(i)
+        return todo
+
+###########################################################################
+## Function:    materialize
+## Arguments:   names:      list of mar345 images (all of the same size)
+##              name:       filename of the stack (.npy)
+##              workers:    number of threads, default: number of CPUs
+##              verbose:    default=0
+###########################################################################
+def materialize(names, name, workers=None, verbose=0):
+    '''materialize: decodes images into the stack file if it does not exist
+    or is out of date. Only new and changed images are decoded.
+    Returns the Stack (read-only)'''
+    t0      = time.perf_counter()
+    names   = [ os.path.abspath(n) for n in names ]
+    if len(names) == 0:
+        raise ValueError("materialize: no images given")
+    if workers == None: workers = os.cpu_count() or 1
+    stat    = [ _stat(n) for n in names ]
+    idx     = _load(name)
+    old     = { } if idx == None else { f['path'] : (i, f) for i, f in enumerate(idx['frames']) }
+
+    # Frames that can be kept
+    keep    = { }
+    for i, n in enumerate(names):
+        if n in old and old[n][1]['stat'] == stat[i]: keep[i] = old[n][0]
+
+    if idx != None and [ f['path'] for f in idx['frames'] ] == names:
+        # Same series: decode changed frames in place
+        todo  = [ i for i in range(len(names)) if not i in keep ]
+        if len(todo) == 0:
+            if verbose: print("materialize: '{}' is up to date".format(name))
+            return Stack(name)
+        frames = idx['frames']
+        shape  = tuple( idx['shape'] )
+        # The frames to decode are marked stale in the index first, so a
+        # crash in between or a reader of the stack never takes them for
+        # the frames of the old images. The others are kept on the next run
+        for i in todo:
+            frames[i] = { 'path' : names[i], 'stat' : None, 'header' : None }
+        _save(name, { 'version' : VERSION, 'shape' : list(shape), 'frames' : frames })
+        out    = np.lib.format.open_memmap(name, mode='r+')
+        tmp    = None
+    else:
+        # New or different series: make a new file and copy frames that
+        # are still valid from the old one
+        h      = mar345.Mar345().read(names[0], onlyheader=True)
+        if not h.success:
+            raise IOError("Cannot read header of '{}'".format(names[0]))
+        shape  = ( len(names), h.y, h.x )
+        if idx == None or tuple( idx['shape'][1:] ) != shape[1:]: keep = { }
+        todo   = [ i for i in range(len(names)) if not i in keep ]
+        frames = [ None ] * len(names)
+        tmp    = name + '.tmp'
+        out    = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32, shape=shape)
+        if keep:
+            src = np.load(name, mmap_mode='r')
+            for i, j in keep.items():
+                out[i]    = src[j]
+                frames[i] = idx['frames'][j]
+            del src
+
+    # Decode what is left directly into the frames of the stack
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        headers = list( pool.map( lambda i: _decode( names[i], out[i] ), todo ) )
+    for i, h in zip(todo, headers):
+        frames[i] = { 'path' : names[i], 'stat' : stat[i], 'header' : h }
+    out.flush()
+    del out
+
+    # Without index, a crash in between leaves an invalid stack that is
+    # built again, never a stack with frames that do not match the index
+    if tmp != None:
+        if os.path.exists(name + '.json'): os.remove(name + '.json')
+        os.replace(tmp, name)
+    _save(name, { 'version' : VERSION, 'shape' : list(shape), 'frames' : frames })
+
+    if verbose:
+        print("materialize: {} frames decoded, {} kept in {:.2f} s".format( len(todo), len(names)-len(todo), time.perf_counter()-t0 ))
+    return Stack(name)
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="python -m mario.stack [options] stack.npy dir|glob|file ...")
+    p.add_option('-j', '--workers', default=None, type="int", help="Number of threads (default: number of CPUs)")
+    p.add_option('-r', '--recursive', default=False, action="store_true", help="Descend into subdirectories")
+    p.add_option('-v', '--verbose', default=0, action="count", help="Increase verbosity level")
+    p.add_option('--prg',default="stack")
+    o,r  = p.parse_args()
+    if len(r) < 2:
+        p.print_usage()
+        sys.exit(1)
+
+    names = find( r[1:], o.recursive )
+    if len(names) == 0:
+        print("{}: no mar345 images found".format(o.prg))
+        sys.exit(1)
+
+    t = time.perf_counter()
+    s = materialize( names, r[0], o.workers, o.verbose )
+    t = time.perf_counter() - t
+    print("{}: {} frames of {} x {} pixels in '{}' || {:.2f} s".format( o.prg, len(s), s.data.shape[2], s.data.shape[1], r[0], t ))
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Module:		    watch
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Description:	Live ingest of mar345 images written into a directory by the
+                scanner. New files are taken only when they are complete:
+                size and mtime did not change for a while, the header is
+                valid and the pck stream decodes to the last pixel. Every
+                image is decoded once and handed to a callback or a queue.
+
+                The directory is listed only when its mtime changed (a file
+                has been added) and every rescan seconds, files waiting to
+                be complete are checked with stat only.
+
+                python -m mario.watch [options] dir
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+Author:		    Claudio Klein
+                marXperts GmbH
+                Werkstr.3
+                22844 Norderstedt / Germany
+                Claudio.Klein@marxperts.com
+                www.marxperts.com
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+"""
+import os, sys, time, threading, optparse
+from   mario import mar345
+
+###########################################################################
+## Class:       Mar345Watcher
+## Arguments:   directory:  directory the images are written into
+##              callback:   function called with every new image (Mar345)
+##              queue:      queue.Queue new images are put into (blocks if
+##                          the queue is full)
+##              settle:     seconds size and mtime must not change
+##              interval:   seconds between polls (run, start)
+##              timeout:    seconds after which a file that does not become
+##                          complete is given up
+##              rescan:     seconds between full listings of the directory
+##              existing:   also take images that are there at the start
+##              verbose:    default=0
+##              **kw:       passed on to Mar345.decode, e.g. compact=True
+###########################################################################
+class Mar345Watcher( ):
+    '''Hands the images that appear in a directory to a callback or queue,
+    each once and only when it has been written completely. A new image is
+    handed on at most settle + interval seconds after it has been written'''
+    def __init__(self, directory, callback=None, queue=None, settle=0.5, interval=0.2,
+                 timeout=60., rescan=10., existing=True, verbose=0, **kw):
+        self.directory  = directory
+        self.callback   = callback
+        self.queue      = queue
+        self.settle     = settle
+        self.interval   = interval
+        self.timeout    = timeout
+        self.rescan     = rescan
+        self.verbose    = verbose
+        self.kw         = kw
+        self.frames     = 0
+        self.failed     = [ ]       # Files given up: (name, reason)
+        self.scans      = 0         # Listings of the directory
+        self.latency    = 0.0       # Sum and maximum of the time from the
+        self.latency_max= 0.0       # last write to handing on
+        self._pending   = { }       # name: [ size, mtime, first seen, last change, decoded, new ]
+        self._done      = set()
+        self._dirmtime  = None
+        self._listed    = 0.
+        self._again     = False     # List again, see _new
+        self._newframes = 0         # Images that came after the start
+        self._stop      = threading.Event()
+        self._thread    = None
+        if not existing:
+            self._done.update( self._list() )
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _list
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _list(self):
+        '''Mar345Watcher::_list: names of the mar345 images in the directory'''
+        self.scans += 1
+        self._listed = time.monotonic()
+        with os.scandir( self.directory ) as it:
+            return [ e.path for e in it if mar345.mar345_name.search( e.name ) and e.is_file() ]
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _new
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _new(self):
+        '''Mar345Watcher::_new: adds files not seen before to the pending ones.
+        The directory is only listed if its mtime changed'''
+        try:
+            m = os.stat( self.directory ).st_mtime_ns
+        except OSError:
+            return
+        if m == self._dirmtime and not self._again and time.monotonic() - self._listed < self.rescan:
+            return
+        # A file added right after the listing, within the resolution of
+        # the mtime of the directory, does not change it: list once more
+        self._again    = time.time_ns() - m < 1e8
+        self._dirmtime = m
+        now = time.monotonic()
+        new = self.scans > 0        # Images there at the start have no latency
+        for name in self._list():
+            if not name in self._done and not name in self._pending:
+                self._pending[name] = [ -1, -1, now, now, False, new ]
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         _check
+    # Arguments:        name: pending file, p: its entry in _pending
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def _check(self, name, p, now):
+        '''Mar345Watcher::_check: returns the decoded image if name is
+        complete, otherwise None'''
+        try:
+            st = os.stat( name )
+        except OSError:             # Removed or renamed by the scanner
+            del self._pending[name]
+            return None
+        if ( st.st_size, st.st_mtime_ns ) != ( p[0], p[1] ):
+            p[0], p[1], p[3], p[4] = st.st_size, st.st_mtime_ns, now, False
+            return None
+        if now - p[3] < self.settle or p[4] or st.st_size < 4096:
+            return None
+
+        # Stable: read and decode. If the image is not complete, it is
+        # tried again only after it changed
+        p[4] = True
+        try:
+            with open( name, 'rb' ) as fp: buf = fp.read()
+        except OSError:
+            return None
+        img = mar345.Mar345( verbose=self.verbose ).decode( buf, **self.kw )
+        if not img.success:
+            return None
+        img.filename = name
+        if p[5]:
+            self.latency_max = max( self.latency_max, time.time() - st.st_mtime )
+            self.latency    += time.time() - st.st_mtime
+            self._newframes += 1
+        return img
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         poll
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def poll(self):
+        '''Mar345Watcher::poll: looks once for new complete images, hands
+        them on in the order of their frame numbers and returns them'''
+        self._new()
+        now  = time.monotonic()
+        imgs = [ ]
+        for name in sorted( self._pending, key=mar345._framenumber ):
+            p   = self._pending[name]
+            img = self._check( name, p, now )
+            if img != None:
+                del self._pending[name]
+                self._done.add( name )
+                imgs.append( img )
+            elif name in self._pending and now - p[3] > self.timeout:
+                reason = "not complete {:.0f} s after the last change".format( now - p[3] )
+                if self.verbose: print("WARNING (Mar345Watcher::poll): {} {}".format(name, reason))
+                del self._pending[name]
+                self._done.add( name )
+                self.failed.append( ( name, reason ) )
+        for img in imgs:
+            self.frames += 1
+            if self.callback != None: self.callback( img )
+            if self.queue != None: self.queue.put( img )
+        return imgs
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         run
+    # Arguments:        count: stop after count images (None: until stop)
+    #                   idle: stop if no new image came for idle seconds
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def run(self, count=None, idle=None):
+        '''Mar345Watcher::run: polls until stop() is called, count images
+        have been handed on or nothing happened for idle seconds'''
+        last = time.monotonic()
+        while not self._stop.is_set():
+            if self.poll() or self._pending: last = time.monotonic()
+            if count != None and self.frames >= count: break
+            if idle != None and time.monotonic() - last > idle: break
+            self._stop.wait( self.interval )
+        return self
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         start, stop
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def start(self):
+        '''Mar345Watcher::start: polls in a background thread'''
+        self._stop.clear()
+        self._thread = threading.Thread( target=self.run, name="Mar345Watcher", daemon=True )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Mar345Watcher::stop: stops run and the background thread'''
+        self._stop.set()
+        if self._thread != None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function:         stats
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stats(self):
+        '''Mar345Watcher::stats: dict with number of images handed on, given
+        up and pending, listings of the directory and latency in seconds'''
+        return { 'frames' : self.frames, 'failed' : len(self.failed), 'pending' : len(self._pending),
+                 'scans' : self.scans, 'latency_avg' : self.latency / self._newframes if self._newframes else 0.,
+                 'latency_max' : self.latency_max }
+
+###########################################################################
+## If this python file is called by itself, run the main program ...
+###########################################################################
+def start():
+    p= optparse.OptionParser(usage="python -m mario.watch [options] dir")
+    p.add_option('-n', '--count',   default=None, type="int", help="Stop after this number of images")
+    p.add_option('-i', '--idle',    default=None, type="float", help="Stop if no image came for this number of seconds")
+    p.add_option('-s', '--settle',  default=0.5, type="float", help="Seconds a file must not change (default: 0.5)")
+    p.add_option('-t', '--timeout', default=60., type="float", help="Seconds after which incomplete files are given up (default: 60)")
+    p.add_option('--new',           default=False, action="store_true", help="Skip images that are there at the start")
+    p.add_option('-v', '--verbose', default=0, action="count", help="Increase verbosity level")
+    p.add_option('--prg',default="watch")
+    o,r  = p.parse_args()
+    if len(r) != 1 or not os.path.isdir(r[0]):
+        p.print_usage()
+        sys.exit(1)
+
+    def show(img):
+        h = img.header
+        print("{}: {} || {}x{} pixels || phi {:.2f}...{:.2f} || {} > 16 bits".format(
+              o.prg, img.filename, img.x, img.y, h['phibeg'], h['phiend'], h['high'] ), flush=True)
+
+    w = Mar345Watcher( r[0], callback=show, settle=o.settle, timeout=o.timeout, existing=not o.new, verbose=o.verbose )
+    try:
+        w.run( o.count, o.idle )
+    except KeyboardInterrupt:
+        pass
+    s = w.stats()
+    print("{}: {} images, {} failed || latency {:.2f} s (max. {:.2f} s) || {} listings of '{}'".format(
+          o.prg, s['frames'], s['failed'], s['latency_avg'], s['latency_max'], s['scans'], r[0] ))
+    for name, reason in w.failed:
+        print("{}: FAILED {}: {}".format(o.prg, name, reason))
+
+if __name__ == "__main__":
+    start()